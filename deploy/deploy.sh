@@ -38,6 +38,9 @@ ssh ${SSH_USER}@${SSH_HOST} bash << ENDSSH
   DEPLOY_PATH="${DEPLOY_PATH:-/opt/sbook}"
   BACKEND_PATH="\${DEPLOY_PATH}/backend"
   BACKEND_PORT="${BACKEND_PORT:-8000}"
+  # ASGI worker processes; one per CPU core unless set
+  BACKEND_WORKERS="${BACKEND_WORKERS:-}"
+  BACKEND_WORKERS="\${BACKEND_WORKERS:-\$(nproc)}"
   
   echo "Checking system dependencies..."
   
@@ -148,19 +151,20 @@ ssh ${SSH_USER}@${SSH_HOST} bash << ENDSSH
     DEPLOY_PATH="\${DEPLOY_PATH}" \
     BACKEND_HOST="\${BACKEND_HOST_VAL}" \
     BACKEND_PORT="\${BACKEND_PORT_VAL}" \
+    BACKEND_WORKERS="\${BACKEND_WORKERS}" \
     UV_PATH="\${UV_PATH_VAL}" \
-    envsubst '\$DEPLOY_PATH \$BACKEND_HOST \$BACKEND_PORT \$UV_PATH' \
+    envsubst '\$DEPLOY_PATH \$BACKEND_HOST \$BACKEND_PORT \$BACKEND_WORKERS \$UV_PATH' \
       < deploy/sbook-backend.supervisor.conf.template \
       > \${DEPLOY_PATH}/conf/sbook-backend.supervisor.conf
     
     sudo ln -sf \${DEPLOY_PATH}/conf/sbook-backend.supervisor.conf /etc/supervisor/conf.d/sbook-backend.conf
-    echo "Supervisor configuration updated from template (BACKEND_HOST=\${BACKEND_HOST_VAL}, BACKEND_PORT=\${BACKEND_PORT_VAL}, UV_PATH=\${UV_PATH_VAL})"
+    echo "Supervisor configuration updated from template (BACKEND_HOST=\${BACKEND_HOST_VAL}, BACKEND_PORT=\${BACKEND_PORT_VAL}, BACKEND_WORKERS=\${BACKEND_WORKERS}, UV_PATH=\${UV_PATH_VAL})"
   elif [ -f deploy/sbook-backend.supervisor.conf ]; then
     # Fallback: use sed for backward compatibility
     BACKEND_PORT_VAL="\${BACKEND_PORT:-8000}"
     BACKEND_HOST_VAL="\${BACKEND_HOST:-127.0.0.1}"
     
-    sed "s|BACKEND_HOST=\"127.0.0.1\"|BACKEND_HOST=\"\${BACKEND_HOST_VAL}\"|g; s|BACKEND_PORT=\"8000\"|BACKEND_PORT=\"\${BACKEND_PORT_VAL}\"|g" \
+    sed "s|BACKEND_HOST=\"127.0.0.1\"|BACKEND_HOST=\"\${BACKEND_HOST_VAL}\"|g; s|BACKEND_PORT=\"8000\"|BACKEND_PORT=\"\${BACKEND_PORT_VAL}\"|g; s|tcp://127.0.0.1:8000|tcp://\${BACKEND_HOST_VAL}:\${BACKEND_PORT_VAL}|; s|^numprocs=2$|numprocs=\${BACKEND_WORKERS}|" \
       deploy/sbook-backend.supervisor.conf > \${DEPLOY_PATH}/conf/sbook-backend.supervisor.conf
     
     sudo ln -sf \${DEPLOY_PATH}/conf/sbook-backend.supervisor.conf /etc/supervisor/conf.d/sbook-backend.conf
@@ -172,7 +176,16 @@ ssh ${SSH_USER}@${SSH_HOST} bash << ENDSSH
   echo "Restarting supervisor..."
   sudo supervisorctl reread
   sudo supervisorctl update
-  sudo supervisorctl restart sbook-backend || sudo supervisorctl start sbook-backend
+  # Rolling restart: supervisord keeps the listening socket open, so the
+  # other workers serve while each one reloads
+  if sudo supervisorctl status 'sbook-backend:*' | grep -q RUNNING; then
+    for process in \$(sudo supervisorctl status 'sbook-backend:*' | awk '{print \$1}'); do
+      sudo supervisorctl restart "\${process}"
+    done
+  else
+    sudo supervisorctl start 'sbook-backend:*'
+  fi
+  sudo supervisorctl restart sbook-renditions || sudo supervisorctl start sbook-renditions
   
   echo "Waiting for service to start..."
   sleep 3
@@ -0,0 +1,142 @@
+"""
+Shared (Redis) cache of what ChatConsumer checks for every message it
+receives: the id behind a recipient's username and whether the two users
+block each other. ChatConsumer keeps a per-connection copy on top. The
+websocket handshake (chat.jwt_middleware) looks its user up here as well.
+
+Readers fill missing keys with cache.add(), writers overwrite them with
+cache.set() once their transaction commits (see chat.signals), so a reader
+that loaded a value before a block changed can't put it back afterwards.
+"""
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Q
+
+from marketplace.models import Block
+
+User = get_user_model()
+
+USER_KEY = 'chat:user:{}'
+BLOCK_KEY = 'chat:block:{}:{}'
+PRINCIPAL_KEY = 'chat:principal:{}'
+
+
+def lookup_timeout():
+    return getattr(settings, 'CHAT_LOOKUP_CACHE_TIMEOUT', 300)
+
+
+def block_key(user_id, other_id):
+    return BLOCK_KEY.format(*sorted((user_id, other_id)))
+
+
+def user_id_for(username):
+    """ Id of the user called `username`, None if there is none. """
+    key = USER_KEY.format(username)
+    user_id = cache.get(key)
+    if user_id is None:
+        user_id = User.objects.filter(username=username).values_list(
+            'pk', flat=True
+        ).first()
+        if user_id is not None:
+            cache.add(key, user_id, timeout=lookup_timeout())
+    return user_id
+
+
+def user_ids_for(usernames):
+    """ {username: id} of the users called `usernames`, leaving out those
+    there is none of. One query for all of them that are not cached. """
+    keys = {USER_KEY.format(username): username for username in usernames}
+    user_ids = {keys[key]: user_id
+                for key, user_id in cache.get_many(list(keys)).items()}
+    missing = set(keys.values()) - set(user_ids)
+    if missing:
+        for username, user_id in User.objects.filter(
+                username__in=missing).values_list('username', 'pk'):
+            user_ids[username] = user_id
+            cache.add(USER_KEY.format(username), user_id,
+                      timeout=lookup_timeout())
+    return user_ids
+
+
+def cached_recipient(user_id, username):
+    """ What recipient_of() asks, from the cache alone: the id of the user
+    called `username` and whether the two users block each other. None for
+    what is not cached. """
+    recipient_id = cache.get(USER_KEY.format(username))
+    if recipient_id is None:
+        return None, None
+    return recipient_id, cache.get(block_key(user_id, recipient_id))
+
+
+def cached_principal(user_id):
+    return cache.get(PRINCIPAL_KEY.format(user_id))
+
+
+def principal_for(user_id):
+    """ {'id', 'username', 'is_active'} of user `user_id`, None if there
+    is none. """
+    key = PRINCIPAL_KEY.format(user_id)
+    principal = cache.get(key)
+    if principal is None:
+        principal = User.objects.filter(pk=user_id).values(
+            'id', 'username', 'is_active'
+        ).first()
+        if principal is not None:
+            cache.add(key, principal, timeout=lookup_timeout())
+    return principal
+
+
+def blocked_in_db(user_id, other_id):
+    return Block.objects.filter(
+        Q(initiator_user=user_id, blocked_user=other_id) |
+        Q(initiator_user=other_id, blocked_user=user_id)
+    ).exists()
+
+
+def is_blocked(user_id, other_id):
+    """ Whether either user blocks the other. """
+    key = block_key(user_id, other_id)
+    blocked = cache.get(key)
+    if blocked is None:
+        blocked = blocked_in_db(user_id, other_id)
+        cache.add(key, blocked, timeout=lookup_timeout())
+    return bool(blocked)
+
+
+def blocked_among(user_id, other_ids):
+    """ The users of `other_ids` that block user `user_id` or that it
+    blocks. One query for all of them that are not cached. """
+    keys = {block_key(user_id, other_id): other_id for other_id in other_ids}
+    cached = cache.get_many(list(keys))
+    blocked = {keys[key] for key, value in cached.items() if value}
+    missing = {other_id for key, other_id in keys.items()
+               if key not in cached}
+    if missing:
+        in_db = set()
+        for initiator, target in Block.objects.filter(
+                Q(initiator_user=user_id, blocked_user__in=missing) |
+                Q(initiator_user__in=missing, blocked_user=user_id)
+        ).values_list('initiator_user', 'blocked_user'):
+            in_db.add(target if initiator == user_id else initiator)
+        for other_id in missing:
+            cache.add(block_key(user_id, other_id), other_id in in_db,
+                      timeout=lookup_timeout())
+        blocked |= in_db
+    return blocked
+
+
+def refresh_block(user_id, other_id):
+    """ Stores the committed block state of the pair and returns it. """
+    blocked = blocked_in_db(user_id, other_id)
+    cache.set(block_key(user_id, other_id), blocked, timeout=lookup_timeout())
+    return blocked
+
+
+def forget_user(username):
+    cache.delete(USER_KEY.format(username))
+
+
+def forget_principal(user_id):
+    cache.delete(PRINCIPAL_KEY.format(user_id))
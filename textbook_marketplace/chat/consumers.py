@@ -1,119 +1,596 @@
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q, ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 
-import json
+import asyncio
+import time
 from typing import List
 
-from .models import Message
-from .serializers import MessageSerializer
-from marketplace.models import Block
+from . import caching, presence, protocol
+from .inbox import mark_seen, record_message, users_of
+from .journal import get_journal
+from .jwt_middleware import Principal
+from .models import Conversation, Message
+from .serializers import ConversationSerializer, MessageSerializer
 
 User = get_user_model()
 
+# Entries a connection keeps in each of its lookup caches
+CONNECTION_CACHE_SIZE = 1000
+# Frames relayed or applied without touching the database, see
+# receive_ephemeral()
+EPHEMERAL = {'typing', 'stopped_typing', 'ping'}
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     """ Consumer for chat system. """
 
     async def connect(self):
         """ Adds connection to channel layer. """
-        self.user: User = self.scope['user']
+        self.user: User | Principal = self.scope['user']
         if not self.user.is_authenticated:
             await self.close(code=4003)
             return
         self.room_group_name: str = f'personal_{self.user.username}'
+        # username -> (user id, expiry) and user id -> (blocked, expiry),
+        # see recipient_of(); blocks are updated by block_changed()
+        self.user_ids: dict[str, tuple[int, float]] = {}
+        self.blocks: dict[int, tuple[bool, float]] = {}
+        # presence groups of the users whose status this connection follows
+        self.presence_groups: set[str] = set()
+        # receipts waiting for the next flush, per other user:
+        # user id -> (up to message id, username), see receive_receipt()
+        self.seen: dict[int, tuple[int, str]] = {}
+        self.delivered: dict[int, tuple[int, str]] = {}
+        self.receipts_flush: asyncio.Task | None = None
+        # username -> when 'typing' was last relayed to them, the users
+        # shown self.user typing, and the token bucket of ephemeral
+        # events, see receive_ephemeral()
+        self.typing: dict[str, float] = {}
+        self.typing_to: set[str] = set()
+        self.ephemeral_tokens: float = settings.CHAT_EPHEMERAL_BURST
+        self.ephemeral_at: float = time.monotonic()
         await self.channel_layer.group_add(channel=self.channel_name,
                                            group=self.room_group_name)
-        await self.accept()
-        unseen_messages: List[Message] = await self.retrieve_unseen_messages(
-            self.user
-        )
-        await self.send(text_data=json.dumps(
-            {'type': 'notification',
-             'new_messages': unseen_messages}
-        ))
+        self.codec = protocol.negotiate(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol=self.codec.subprotocol)
+        # Registered before the unseen messages are read: a sender that
+        # found self.user offline and skipped the fan-out stored (or
+        # journaled) its message first, so send_unseen() delivers it
+        self.renewed_at: float = time.monotonic()
+        if await presence.connect(self.user.pk, self.channel_name):
+            await self.announce_presence(True)
+        self.heartbeat = asyncio.create_task(self.keep_alive())
+        await self.send_unseen()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # also when the server cancels the connection without
+            # disconnect(); its presence then expires
+            if hasattr(self, 'heartbeat'):
+                self.heartbeat.cancel()
+            if getattr(self, 'receipts_flush', None) is not None:
+                self.receipts_flush.cancel()
 
     async def disconnect(self, close_code):
+        if hasattr(self, 'seen'):
+            if self.receipts_flush is not None:
+                self.receipts_flush.cancel()
+                self.receipts_flush = None
+            await self.flush_receipts()
+        for username in getattr(self, 'typing_to', ()):
+            await self.relay_typing(username, False)
+        if hasattr(self, 'heartbeat'):
+            self.heartbeat.cancel()
+            if await presence.disconnect(self.user.pk, self.channel_name):
+                await self.announce_presence(False)
+        for group in getattr(self, 'presence_groups', ()):
+            await self.channel_layer.group_discard(channel=self.channel_name,
+                                                   group=group)
         if hasattr(self, 'room_group_name'):
             await self.channel_layer.group_discard(channel=self.channel_name,
                                                    group=self.room_group_name)
 
+    async def send_frame(self, frame: dict) -> None:
+        """ Sends `frame` in the format the client negotiated (see
+        chat.protocol). """
+        await self.send(**self.codec.encode(frame))
+
+    async def keep_alive(self) -> None:
+        """ Renews this connection's presence while it is open. """
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_HEARTBEAT_INTERVAL)
+            await self.renew_presence()
+
+    async def renew_presence(self) -> None:
+        self.renewed_at = time.monotonic()
+        if await presence.connect(self.user.pk, self.channel_name):
+            # it had expired, e.g. while Redis was unreachable
+            await self.announce_presence(True)
+
+    async def announce_presence(self, online: bool) -> None:
+        await self.channel_layer.group_send(
+            presence.GROUP.format(self.user.pk),
+            {'type': 'presence_changed',
+             'user': self.user.username,
+             'online': online}
+        )
+
+    async def send_unseen(self) -> None:
+        """ Sends what arrived while the user was away: a notification with
+        the conversations holding unread messages and the oldest unseen
+        messages, then further notifications with the following ones.
+
+        Each frame holds at most CHAT_UNSEEN_CHUNK_SIZE messages and at most
+        CHAT_UNSEEN_MAX_MESSAGES are sent in total. `has_more` tells the
+        client to fetch the rest lazily, from /api/chat/?since_id= with the
+        id of the last message it received.
+
+        With CHAT_WRITE_BEHIND the last frame also holds the messages still
+        in the journal. A message may then arrive both here and live;
+        clients tell them apart by id. """
+        chunk_size: int = settings.CHAT_UNSEEN_CHUNK_SIZE
+        remaining: int = settings.CHAT_UNSEEN_MAX_MESSAGES
+        journaled = []
+        if settings.CHAT_WRITE_BEHIND:
+            # read before the database: a message flushed in between is
+            # stored by the time the database is read
+            journaled = await self.retrieve_journaled_messages()
+        conversations = await self.retrieve_unread_conversations(self.user)
+        messages, has_more = await self.retrieve_unseen_messages(
+            self.user, limit=min(chunk_size, remaining)
+        )
+        frame = {'type': 'notification', 'conversations': conversations}
+        sent_ids = set()
+        while True:
+            remaining -= len(messages)
+            sent_ids.update(message['id'] for message in messages)
+            if not has_more and journaled:
+                journaled = [message for message in journaled
+                             if message['id'] not in sent_ids]
+                has_more = len(journaled) > remaining
+                messages = messages + journaled[:remaining]
+                journaled = []
+            await self.send_frame(
+                {**frame, 'new_messages': messages, 'has_more': has_more}
+            )
+            if not has_more or remaining <= 0:
+                return
+            messages, has_more = await self.retrieve_unseen_messages(
+                self.user, limit=min(chunk_size, remaining),
+                after=messages[-1]
+            )
+            frame = {'type': 'notification'}
+
+    async def retrieve_journaled_messages(self) -> List[dict]:
+        """ Messages to self.user the journal has not stored yet, as
+        MessageSerializer renders them. """
+        messages = await get_journal().unflushed(self.user.pk)
+        if not messages:
+            return []
+        return await self.serialize_journaled(messages)
+
+    @database_sync_to_async
+    def serialize_journaled(self, messages: List[dict]) -> List[dict]:
+        # left in the journal's index by a crashed flusher, and possibly
+        # seen since
+        stored = set(Message.objects.filter(
+            pk__in=[message['id'] for message in messages]
+        ).values_list('pk', flat=True))
+        messages = [message for message in messages
+                    if message['id'] not in stored]
+        usernames = {}
+        for message in messages:
+            if message['sender_id'] not in usernames:
+                principal = caching.principal_for(message['sender_id'])
+                usernames[message['sender_id']] = \
+                    principal and principal['username']
+        recipient = User(pk=self.user.pk, username=self.user.username)
+        serializer = MessageSerializer([
+            Message(id=message['id'],
+                    sender=User(pk=message['sender_id'],
+                                username=usernames[message['sender_id']]),
+                    recipient=recipient,
+                    text=message['text'],
+                    sent_at=parse_datetime(message['sent_at']))
+            for message in messages
+        ], many=True)
+        return serializer.data
+
     @database_sync_to_async
-    def retrieve_unseen_messages(self, user: User) -> List[Message]:
-        query = user.message_recipient.filter(seen=False)
-        serializer = MessageSerializer(query, many=True)
+    def retrieve_unread_conversations(self, user: User | Principal
+                                      ) -> List[dict]:
+        """ Conversations with messages unseen by `user`, most recently
+        active first, at most CHAT_UNREAD_CONVERSATIONS_LIMIT. """
+        query = Conversation.objects.filter(
+            Q(user1=user.pk, user1_unread__gt=0) |
+            Q(user2=user.pk, user2_unread__gt=0)
+        ).order_by('-last_message_at', '-id')
+        conversations = list(query[:settings.CHAT_UNREAD_CONVERSATIONS_LIMIT])
+        serializer = ConversationSerializer(conversations, many=True, context={
+            'user': user,
+            'users': users_of(conversations),
+        })
         return serializer.data
 
     @database_sync_to_async
-    def save_message(self, text: str, recipient: User) -> None:
-        """ Creates message in db. """
-        Message.objects.create(text=text,
-                               sender=self.user,
-                               recipient=recipient)
+    def retrieve_unseen_messages(self, user: User | Principal, limit: int,
+                                 after: dict | None = None
+                                 ) -> tuple[List[dict], bool]:
+        """ Up to `limit` messages unseen by `user`, oldest first, following
+        the serialized message `after`; and whether more follow. """
+        query = Message.objects.filter(
+            recipient=user.pk, seen=False
+        ).select_related(
+            'sender', 'recipient'
+        ).order_by('sent_at', 'id')
+        if after is not None:
+            query = query.filter(
+                Q(sent_at__gt=after['sent_at']) |
+                Q(sent_at=after['sent_at'], id__gt=after['id'])
+            )
+        messages = list(query[:limit + 1])
+        serializer = MessageSerializer(messages[:limit], many=True)
+        return serializer.data, len(messages) > limit
 
     @database_sync_to_async
-    def is_blocked(self, recipient: User) -> bool:
-        """Check if sender blocked recipient OR recipient blocked sender."""
-        return Block.objects.filter(
-            Q(initiator_user=recipient, blocked_user=self.user) |
-            Q(initiator_user=self.user, blocked_user=recipient)
-        ).exists()
+    def save_message(self, text: str, recipient_id: int) -> int:
+        """ Creates message in db and updates the conversation's inbox
+        entry in the same transaction. Returns the message's id. """
+        with transaction.atomic():
+            message = Message.objects.create(text=text,
+                                             sender_id=self.user.pk,
+                                             recipient_id=recipient_id)
+            record_message(message)
+        return message.pk
+
+    @database_sync_to_async
+    def apply_seen(self, up_to: dict[int, int]) -> dict[int, int]:
+        """ Marks the messages each sender in `up_to` sent self.user, up to
+        the given message id, as seen with one UPDATE. Returns how many
+        each sender had unseen. """
+        query = Q()
+        for sender_id, message_id in up_to.items():
+            query |= Q(sender=sender_id, id__lte=message_id)
+        with transaction.atomic():
+            return mark_seen(self.user, Message.objects.filter(query))
+
+    async def recipient_of(self, username: str) -> tuple[int | None, bool]:
+        """ Id of the user called `username` (None if there is none) and
+        whether they and self.user block each other.
+
+        Answered from this connection's own cache while its entries are
+        fresh, so a conversation in progress costs no lookup; otherwise
+        with one thread hop to the shared cache and the database. """
+        now = time.monotonic()
+        user_id, expires = self.user_ids.get(username, (None, 0))
+        if expires > now:
+            blocked, expires = self.blocks.get(user_id, (None, 0))
+            if expires > now:
+                return user_id, blocked
+        user_id, blocked = await self.lookup_recipient(username)
+        if user_id is not None:
+            expires = now + caching.lookup_timeout()
+            self.remember(self.user_ids, username, user_id, expires)
+            self.remember(self.blocks, user_id, blocked, expires)
+        return user_id, blocked
 
     @staticmethod
+    def remember(entries: dict, key, value, expires: float) -> None:
+        if len(entries) >= CONNECTION_CACHE_SIZE and key not in entries:
+            entries.clear()
+        entries[key] = (value, expires)
+
     @database_sync_to_async
-    def get_user_by_username(username: str) -> User | None:
-        try:
-            return User.objects.get(username=username)
-        except ObjectDoesNotExist:
-            return None
+    def lookup_recipient(self, username: str) -> tuple[int | None, bool]:
+        user_id = caching.user_id_for(username)
+        if user_id is None:
+            return None, False
+        return user_id, caching.is_blocked(self.user.pk, user_id)
+
+    async def ephemeral_target(self, username: str) -> int | None:
+        """ Id of the user called `username` if ephemeral events may go to
+        them: known to this connection's cache or the shared one, and no
+        block between them and self.user. Never queries the database, so
+        events to users not looked up lately are dropped. """
+        now = time.monotonic()
+        user_id, expires = self.user_ids.get(username, (None, 0))
+        blocked, block_expires = self.blocks.get(user_id, (None, 0))
+        if min(expires, block_expires) <= now:
+            user_id, blocked = await sync_to_async(
+                caching.cached_recipient, thread_sensitive=False
+            )(self.user.pk, username)
+            if user_id is None or blocked is None:
+                return None
+            expires = now + caching.lookup_timeout()
+            self.remember(self.user_ids, username, user_id, expires)
+            self.remember(self.blocks, user_id, blocked, expires)
+        return None if blocked else user_id
 
-    async def receive(self, text_data: str):
+    @database_sync_to_async
+    def lookup_users(self, usernames: List[str]) -> dict[str, int]:
+        """ Ids of the users called `usernames`, leaving out unknown
+        usernames and the users that block self.user or that it blocks. """
+        user_ids = caching.user_ids_for(usernames)
+        blocked = caching.blocked_among(self.user.pk, user_ids.values())
+        return {username: user_id for username, user_id in user_ids.items()
+                if user_id not in blocked}
+
+    async def subscribe_presence(self, usernames: List[str]) -> None:
+        """ Sends whether the users called `usernames` are online and
+        follows their status from now on (see presence_changed()), for at
+        most CHAT_PRESENCE_QUERY_LIMIT users per connection. """
+        limit: int = settings.CHAT_PRESENCE_QUERY_LIMIT
+        user_ids = {}
+        if len(usernames) <= limit:
+            user_ids = await self.lookup_users(usernames)
+        groups = {presence.GROUP.format(user_id)
+                  for user_id in user_ids.values()} - self.presence_groups
+        if len(usernames) > limit or \
+                len(self.presence_groups) + len(groups) > limit:
+            await self.send_frame({
+                'type': 'error',
+                'message': f'Presence of at most {limit} users can be '
+                           f'followed.',
+                'sender': self.user.username
+            })
+            return
+        for group in groups:
+            self.presence_groups.add(group)
+            await self.channel_layer.group_add(channel=self.channel_name,
+                                               group=group)
+        online = await presence.online(list(user_ids.values()))
+        await self.send_frame({
+            'type': 'presence',
+            'users': {username: online[user_id]
+                      for username, user_id in user_ids.items()}
+        })
+
+    async def receive(self, text_data: str | None = None,
+                      bytes_data: bytes | None = None):
         """ Receives message, then sends it to the group and calls
         save_message() method if self.user is allowed to send messages.
-        Just sends notification about block otherwise. """
-        text_data_json: dict[str: str] = json.loads(text_data)
-        message: str = text_data_json['message']
-        recipient_username: str = text_data_json['recipient']
-        recipient = await self.get_user_by_username(username=recipient_username)
-        
-        if recipient is None:
-            await self.send(text_data=json.dumps(
+        Just sends notification about block otherwise.
+
+        {"type": "presence", "users": [...]} subscribes to the presence of
+        users instead (see subscribe_presence()); "seen" and "ack" frames
+        are receipts (see receive_receipt()); "typing", "stopped_typing"
+        and "ping" are ephemeral (see receive_ephemeral()). """
+        try:
+            frame: dict = self.codec.decode(text_data, bytes_data)
+        except (TypeError, ValueError):
+            frame = None
+        if self.malformed(frame):
+            await self.send_frame({
+                'type': 'error',
+                'message': 'Malformed frame.',
+                'sender': self.user.username
+            })
+            return
+        if frame.get('type') in EPHEMERAL:
+            await self.receive_ephemeral(frame['type'], frame.get('user'))
+            return
+        if frame.get('type') == 'presence':
+            await self.subscribe_presence(frame['users'])
+            return
+        if frame.get('type') in ('seen', 'ack'):
+            await self.receive_receipt(frame['type'], frame['user'],
+                                       protocol.message_id(frame['up_to']))
+            return
+        message: str = frame['message']
+        recipient_username: str = frame['recipient']
+        recipient_id, blocked = await self.recipient_of(recipient_username)
+
+        if recipient_id is None:
+            await self.send_frame(
                 {'type': 'error',
                  'message': f'No such user found with username '
                             f'{recipient_username}.',
                  'sender': self.user.username}
-            ))
+            )
             return
         
-        if await self.is_blocked(recipient):
-            await self.send(text_data=json.dumps({
+        if blocked:
+            await self.send_frame({
                 'type': 'error',
                 'message': 'You cannot message this user due to a block.',
                 'sender': self.user.username
-            }))
+            })
             return
         
-        await self.save_message(text=message,
-                                recipient=recipient)
+        if settings.CHAT_WRITE_BEHIND:
+            # stored by the journal's flusher after the fan-out below
+            message_id = (await get_journal().append(
+                self.user.pk, recipient_id, message
+            ))['id']
+        else:
+            message_id = await self.save_message(text=message,
+                                                 recipient_id=recipient_id)
 
-        # send message to recipient ws room
-        await self.channel_layer.group_send(
-            f'personal_{recipient_username}',
-            {'type': 'chat_message',
-             'message': message,
-             'sender': self.user.username,
-             'recipient': recipient_username,
-             }
-        )
-        await self.send(text_data=json.dumps(
+        # the recipient's client stops showing self.user as typing
+        self.typing.pop(recipient_username, None)
+        self.typing_to.discard(recipient_username)
+        # send message to recipient ws room, unless nobody is in it: the
+        # recipient gets it with the unseen messages on connect
+        if (await presence.online([recipient_id]))[recipient_id]:
+            await self.channel_layer.group_send(
+                f'personal_{recipient_username}',
+                {'type': 'chat_message',
+                 'message': message,
+                 'sender': self.user.username,
+                 'recipient': recipient_username,
+                 'id': message_id,
+                 }
+            )
+        if self.codec.compact:
+            await self.send_frame({'type': 'sent', 'ref': frame.get('ref'),
+                                   'id': message_id})
+            return
+        await self.send_frame(
                 {'type': 'message',
                  'message': message,
                  'sender': self.user.username,
                  'recipient': recipient_username,
+                 'id': message_id,
                  }
-            ))
+            )
+
+    @staticmethod
+    def malformed(frame) -> bool:
+        """ Whether `frame` lacks a field receive() needs for its type, or
+        has one of the wrong type. """
+        if not isinstance(frame, dict):
+            return True
+        kind = frame.get('type')
+        if kind == 'ping':
+            return False
+        if kind in EPHEMERAL:
+            return not isinstance(frame.get('user'), str)
+        if kind == 'presence':
+            users = frame.get('users')
+            return not isinstance(users, list) or \
+                not all(isinstance(username, str) for username in users)
+        if kind in ('seen', 'ack'):
+            return not isinstance(frame.get('user'), str) or \
+                protocol.message_id(frame.get('up_to')) is None
+        return not isinstance(frame.get('message'), str) or \
+            not isinstance(frame.get('recipient'), str)
+
+    async def receive_ephemeral(self, frame_type: str,
+                                username: str | None) -> None:
+        """ Takes {"type": "typing", "user": ...} or "stopped_typing"
+        frames, relayed to that user's connections, and {"type": "ping"},
+        which renews self.user's presence. None of them is stored.
+
+        Coalesced per connection: 'typing' to the same user is relayed at
+        most once per CHAT_EPHEMERAL_INTERVAL_MS (clients show it for
+        twice as long) and 'stopped_typing' only after a relayed 'typing';
+        a ping renews presence at most once per interval. What is left is
+        limited to CHAT_EPHEMERAL_RATE events per second, with bursts of
+        CHAT_EPHEMERAL_BURST. Events over the limits are dropped. """
+        now = time.monotonic()
+        interval = settings.CHAT_EPHEMERAL_INTERVAL_MS / 1000
+        if frame_type == 'ping':
+            if now - self.renewed_at >= interval and self.take_token(now):
+                await self.renew_presence()
+            return
+        if frame_type == 'stopped_typing':
+            # bounded by the 'typing' relays, so not counted against the
+            # rate: a typing indicator is never left on by the limit. The
+            # relay time is kept, so 'typing' right after is coalesced
+            if username in self.typing_to:
+                self.typing_to.discard(username)
+                await self.relay_typing(username, False)
+            return
+        if now - self.typing.get(username, float('-inf')) < interval or \
+                not self.take_token(now):
+            return
+        if await self.ephemeral_target(username) is None:
+            return
+        if len(self.typing) >= CONNECTION_CACHE_SIZE:
+            # their indicators expire on the clients
+            self.typing.clear()
+            self.typing_to.clear()
+        self.typing[username] = now
+        self.typing_to.add(username)
+        await self.relay_typing(username, True)
+
+    def take_token(self, now: float) -> bool:
+        """ Takes one ephemeral event off this connection's token bucket;
+        False if it is empty. """
+        self.ephemeral_tokens = min(
+            settings.CHAT_EPHEMERAL_BURST,
+            self.ephemeral_tokens
+            + (now - self.ephemeral_at) * settings.CHAT_EPHEMERAL_RATE
+        )
+        self.ephemeral_at = now
+        if self.ephemeral_tokens < 1:
+            return False
+        self.ephemeral_tokens -= 1
+        return True
+
+    async def relay_typing(self, username: str, typing: bool) -> None:
+        await self.channel_layer.group_send(
+            f'personal_{username}',
+            {'type': 'typing_changed',
+             'user': self.user.username,
+             'typing': typing}
+        )
+
+    async def receive_receipt(self, kind: str, username: str, up_to: int
+                              ) -> None:
+        """ Takes {"type": "seen", "user": ..., "up_to": N}: self.user has
+        read the messages from `user` up to id N; or an "ack" frame of the
+        same shape: they have reached this device.
+
+        Receipts are coalesced per conversation, keeping the highest id,
+        and applied every CHAT_RECEIPT_FLUSH_MS (see flush_receipts()), so a
+        client may send one for each message it shows. """
+        sender_id, blocked = await self.recipient_of(username)
+        if sender_id is None or blocked:
+            await self.send_frame({
+                'type': 'error',
+                'message': f'No conversation with {username} to '
+                           f'acknowledge.',
+                'sender': self.user.username
+            })
+            return
+        pending = self.seen if kind == 'seen' else self.delivered
+        known, _ = pending.get(sender_id, (0, username))
+        pending[sender_id] = (max(known, up_to), username)
+        if self.receipts_flush is None:
+            self.receipts_flush = asyncio.create_task(
+                self.flush_receipts_later()
+            )
+
+    async def flush_receipts_later(self) -> None:
+        await asyncio.sleep(settings.CHAT_RECEIPT_FLUSH_MS / 1000)
+        self.receipts_flush = None
+        await self.flush_receipts()
+
+    async def flush_receipts(self) -> None:
+        """ Marks the messages of all pending 'seen' receipts as seen in
+        one UPDATE and sends 'receipt' frames to the senders' connections:
+        kind 'seen' when messages were marked, 'delivered' for acks.
+
+        With CHAT_WRITE_BEHIND the messages may still be in the journal,
+        so 'seen' receipts are journaled after them instead; the flusher
+        marks them and sends the receipts once they are stored. """
+        seen, self.seen = self.seen, {}
+        delivered, self.delivered = self.delivered, {}
+        receipts = [('delivered', sender_id, up_to, username)
+                    for sender_id, (up_to, username) in delivered.items()]
+        if seen and settings.CHAT_WRITE_BEHIND:
+            await get_journal().append_receipts(self.user.pk,
+                                                self.user.username, seen)
+        elif seen:
+            marked = await self.apply_seen(
+                {sender_id: up_to for sender_id, (up_to, _) in seen.items()}
+            )
+            receipts += [('seen', sender_id, up_to, username)
+                         for sender_id, (up_to, username) in seen.items()
+                         if marked.get(sender_id)]
+        if not receipts:
+            return
+        online = await presence.online(list({sender_id for _, sender_id, _, _
+                                             in receipts}))
+        for kind, sender_id, up_to, username in receipts:
+            if online[sender_id]:
+                await self.channel_layer.group_send(
+                    f'personal_{username}',
+                    {'type': 'receipt',
+                     'kind': kind,
+                     'user': self.user.username,
+                     'up_to': up_to}
+                )
 
     async def chat_message(self, event) -> None:
         """ Sends chat message to user in group. """
@@ -121,9 +598,50 @@ class ChatConsumer(AsyncWebsocketConsumer):
         sender: str = event['sender']
         recipient: str = event['recipient']
 
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'message',
             'message': message,
             'sender': sender,
-            'recipient': recipient
-        }))
+            # always self.user, left out of compact frames
+            'recipient': None if self.codec.compact else recipient,
+            'id': event.get('id'),
+        })
+
+    async def receipt(self, event) -> None:
+        """ Sends that another user has read ('seen') or received
+        ('delivered') self.user's messages up to a message id. """
+        await self.send_frame({
+            'type': 'receipt',
+            'kind': event['kind'],
+            'user': event['user'],
+            'up_to': event['up_to'],
+        })
+
+    async def typing_changed(self, event) -> None:
+        """ Sends that another user started or stopped typing to
+        self.user. """
+        await self.send_frame({
+            'type': 'typing' if event['typing'] else 'stopped_typing',
+            'user': event['user']
+        })
+
+    async def presence_changed(self, event) -> None:
+        """ Sends the new status of a followed user. """
+        await self.send_frame({
+            'type': 'presence',
+            'users': {event['user']: event['online']}
+        })
+
+    async def block_changed(self, event) -> None:
+        """ Updates this connection's copy of a block between self.user and
+        another user (sent by chat.signals). """
+        other_id = next((user_id for user_id in event['users']
+                         if user_id != self.user.pk), self.user.pk)
+        self.remember(self.blocks, other_id, event['blocked'],
+                      time.monotonic() + caching.lookup_timeout())
+        group = presence.GROUP.format(other_id)
+        if event['blocked'] and group in self.presence_groups:
+            # no longer follows their status
+            self.presence_groups.discard(group)
+            await self.channel_layer.group_discard(channel=self.channel_name,
+                                                   group=group)
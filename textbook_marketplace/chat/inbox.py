@@ -0,0 +1,114 @@
+"""
+Conversation summaries (chat.models.Conversation) behind the inbox.
+
+record_message() and mark_seen() are called inside the transaction that
+writes the messages, so a summary never disagrees with committed messages.
+"""
+
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .models import Conversation, Message
+
+User = get_user_model()
+
+
+def pair(user_id, other_id):
+    """ (user1_id, user2_id) of a conversation, lower id first. """
+    return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+
+def unread_field(user1_id, user_id):
+    return 'user1_unread' if user_id == user1_id else 'user2_unread'
+
+
+def users_of(conversations):
+    """ {id: user} of everyone ConversationSerializer shows for
+    `conversations`, in one query. """
+    user_ids = set()
+    for conversation in conversations:
+        user_ids.update((conversation.user1_id, conversation.user2_id,
+                         conversation.last_sender_id))
+    return User.objects.in_bulk(user_ids)
+
+
+def record_message(message, unread=None):
+    """ Makes `message` the last one of its conversation and counts it as
+    unread for the recipient; `unread` maps user ids to how many unread
+    messages to add instead. """
+    sender_id, recipient_id = message.sender_id, message.recipient_id
+    user1_id, user2_id = pair(sender_id, recipient_id)
+    if unread is None:
+        unread = {recipient_id: 1} if sender_id != recipient_id else {}
+    counts = {unread_field(user1_id, user_id): count
+              for user_id, count in unread.items() if count}
+    increments = {field: F(field) + count for field, count in counts.items()}
+    last = {
+        'last_message': message,
+        'last_message_text': message.text,
+        'last_message_at': message.sent_at,
+        'last_sender_id': sender_id,
+    }
+    conversation = Conversation.objects.filter(user1=user1_id, user2=user2_id)
+    if conversation.filter(last_message_at__lte=message.sent_at).update(
+            **last, **increments):
+        return
+    # Either the first message of the pair, or a newer one is recorded
+    # already (this one committed out of order) and it is only counted.
+    if conversation.exists():
+        if increments:
+            conversation.update(**increments)
+        return
+    try:
+        with transaction.atomic():
+            Conversation.objects.create(
+                user1_id=user1_id, user2_id=user2_id, **last, **counts
+            )
+    except IntegrityError:
+        # created concurrently by the other participant
+        record_message(message, unread)
+
+
+def record_messages(messages):
+    """ record_message() for a batch, with one update per conversation. """
+    latest, unread = {}, {}
+    for message in messages:
+        key = pair(message.sender_id, message.recipient_id)
+        last = latest.get(key)
+        if last is None or (message.sent_at, message.pk) > (last.sent_at,
+                                                            last.pk):
+            latest[key] = message
+        counts = unread.setdefault(key, {})
+        if message.sender_id != message.recipient_id:
+            counts[message.recipient_id] = counts.get(
+                message.recipient_id, 0) + 1
+    for key, message in latest.items():
+        record_message(message, unread[key])
+
+
+def mark_seen(user, messages):
+    """ Marks `messages` received by `user` as seen, with one UPDATE, and
+    takes them off the unread counters. Returns {sender id: how many were
+    unseen}.
+
+    The unseen rows are locked before they are counted, so concurrent
+    calls for the same messages (another device, the HTTP view and
+    websocket receipts) don't both count them: the later one finds them
+    seen once the first commits. """
+    unseen = list(messages.filter(recipient=user.pk, seen=False)
+                  .select_for_update().values_list('pk', 'sender'))
+    if not unseen:
+        return {}
+    Message.objects.filter(pk__in=[pk for pk, _ in unseen]).update(seen=True)
+    per_sender = Counter(sender_id for _, sender_id in unseen)
+    for sender_id, count in per_sender.items():
+        user1_id, user2_id = pair(user.pk, sender_id)
+        field = unread_field(user1_id, user.pk)
+        Conversation.objects.filter(user1=user1_id, user2=user2_id).update(
+            **{field: Greatest(F(field) - count, 0)}
+        )
+    return dict(per_sender)
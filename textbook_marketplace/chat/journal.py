@@ -0,0 +1,386 @@
+"""
+Write-behind persistence of chat messages (CHAT_WRITE_BEHIND).
+
+ChatConsumer appends every message to a Redis stream, the journal, and fans
+it out right away. A flusher task in each server process reads the journal
+through a consumer group and stores what it read with one bulk_create
+every CHAT_FLUSH_INTERVAL_MS, or as soon as CHAT_FLUSH_BATCH_SIZE messages
+are waiting.
+
+Durability: the sender gets its message back only after XADD returned, so
+an accepted message is as durable as Redis' append-only file (run Redis
+with appendonly yes, as docker-compose.yml does). Entries leave the
+journal only after the transaction storing them committed. Entries read
+by a process that crashed before storing them stay pending in the group
+and are claimed by another flusher after CHAT_JOURNAL_CLAIM_IDLE_MS, or by
+`manage.py flush_chat_journal`. Storing is idempotent: message ids are
+reserved from the database before the messages are journaled, and ids
+already stored are skipped.
+
+Each recipient's journaled messages are also kept in a hash,
+<CHAT_JOURNAL_STREAM>:to:<recipient id>, until they are flushed, so the
+unseen messages sent on connect include them without reading the stream.
+
+Each message takes its id from the table's sequence as it is sent, one
+nextval at a time, so ids keep following send order across server
+processes; 'seen up to id N' receipts and the history rely on it.
+
+A message that can't be stored, e.g. to a user deleted since it was sent,
+is logged and moved to the stream <CHAT_JOURNAL_STREAM>:dead rather than
+holding up the entries read with it.
+
+Read receipts ('seen' frames, see ChatConsumer.receive_receipt()) are
+journaled as well, after the messages they cover, and applied once those
+are stored: the flusher marks them seen and only then sends the receipt
+to the sender. A receipt whose messages are not stored yet, e.g. still
+pending with a crashed flusher, is journaled again until they are, for at
+most twice the time after which stale entries are claimed.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import weakref
+
+import redis.asyncio as redis
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db import (DataError, IntegrityError, connections, router,
+                       transaction)
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .inbox import mark_seen, record_messages
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+GROUP = 'chat-writers'
+
+
+def reserve_ids(count):
+    """ `count` unused Message ids, taken from the table's id sequence so
+    rows inserted without the journal never get them. """
+    using = router.db_for_write(Message)
+    connection = connections[using]
+    table = Message._meta.db_table
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                "FROM generate_series(1, %s)", [table, count]
+            )
+            return [row[0] for row in cursor.fetchall()]
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT tables keep their high-water mark here
+            cursor.execute(
+                f'INSERT INTO sqlite_sequence (name, seq) '
+                f'SELECT %s, COALESCE(MAX(id), 0) FROM {table} WHERE NOT '
+                f'EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                [table, table]
+            )
+            cursor.execute(
+                'UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s',
+                [count, table]
+            )
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s',
+                           [table])
+            end = cursor.fetchone()[0]
+            return list(range(end - count + 1, end + 1))
+    raise ImproperlyConfigured(
+        'CHAT_WRITE_BEHIND needs PostgreSQL or SQLite.'
+    )
+
+
+def store(messages):
+    """ Inserts the journaled `messages` not stored yet and records them
+    in their conversations, in one transaction. A concurrent flusher
+    storing the same ids makes it fail; the entries are then retried. """
+    by_id = {message['id']: message for message in messages}
+    with transaction.atomic():
+        stored = set(Message.objects.filter(pk__in=by_id).values_list(
+            'pk', flat=True
+        ))
+        new = [
+            Message(id=message['id'],
+                    sender_id=message['sender_id'],
+                    recipient_id=message['recipient_id'],
+                    text=message['text'],
+                    sent_at=parse_datetime(message['sent_at']))
+            for message in by_id.values() if message['id'] not in stored
+        ]
+        Message.objects.bulk_create(new)
+        record_messages(new)
+    return len(new)
+
+
+def apply_receipts(receipts):
+    """ Marks the messages covered by journaled read receipts as seen, one
+    UPDATE per reader. Returns the receipts that marked messages, and
+    those whose last message is not stored yet. """
+    latest = {}
+    for receipt in receipts:
+        key = (receipt['reader_id'], receipt['sender_id'])
+        if key not in latest or latest[key]['up_to'] < receipt['up_to']:
+            latest[key] = receipt
+    stored = set(Message.objects.filter(
+        pk__in=[receipt['up_to'] for receipt in latest.values()]
+    ).values_list('pk', flat=True))
+    by_reader = {}
+    for (reader_id, _), receipt in latest.items():
+        by_reader.setdefault(reader_id, []).append(receipt)
+    marked, waiting = [], []
+    for reader_id, reader_receipts in by_reader.items():
+        query = Q()
+        for receipt in reader_receipts:
+            query |= Q(sender=receipt['sender_id'], id__lte=receipt['up_to'])
+        with transaction.atomic():
+            counts = mark_seen(User(pk=reader_id),
+                               Message.objects.filter(query))
+        for receipt in reader_receipts:
+            if receipt['up_to'] not in stored:
+                waiting.append(receipt)
+            elif counts.get(receipt['sender_id']):
+                marked.append(receipt)
+    return marked, waiting
+
+
+class Journal:
+    """ The journal stream of one event loop, with its flusher task. """
+
+    def __init__(self, client, stream, consumer=None):
+        self.redis = client
+        self.stream = stream
+        self.dead_letters = f'{stream}:dead'
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        self.group_created = False
+        self.task = None
+
+    @classmethod
+    def from_settings(cls, **kwargs):
+        return cls(redis.Redis.from_url(settings.CHAT_JOURNAL_REDIS_URL),
+                   settings.CHAT_JOURNAL_STREAM, **kwargs)
+
+    async def append(self, sender_id, recipient_id, text):
+        """ Journals a new message and returns it, id included. """
+        message = {
+            'id': (await database_sync_to_async(reserve_ids)(1))[0],
+            'sender_id': sender_id,
+            'recipient_id': recipient_id,
+            'text': text,
+            'sent_at': timezone.now().isoformat(),
+        }
+        encoded = json.dumps(message)
+        pipe = self.redis.pipeline()
+        pipe.xadd(self.stream, {'message': encoded})
+        pipe.hset(self.index_key(recipient_id), message['id'], encoded)
+        await pipe.execute()
+        return message
+
+    async def append_receipts(self, reader_id, reader, seen):
+        """ Journals that user `reader_id` (username `reader`) has read the
+        messages of each sender in `seen`, {sender id: (up to message id,
+        sender's username)}. """
+        pipe = self.redis.pipeline(transaction=False)
+        for sender_id, (up_to, sender) in seen.items():
+            pipe.xadd(self.stream, {'seen': json.dumps({
+                'reader_id': reader_id, 'reader': reader,
+                'sender_id': sender_id, 'sender': sender,
+                'up_to': up_to, 'at': time.time(),
+            })})
+        await pipe.execute()
+
+    def index_key(self, recipient_id):
+        return f'{self.stream}:to:{recipient_id}'
+
+    async def unflushed(self, recipient_id):
+        """ Journaled messages to user `recipient_id` not flushed yet,
+        oldest first. A flusher that crashed after storing some may leave
+        them here until another one flushes their entries again. """
+        values = await self.redis.hvals(self.index_key(recipient_id))
+        return sorted((json.loads(value) for value in values),
+                      key=lambda message: message['id'])
+
+    async def create_group(self):
+        if self.group_created:
+            return
+        try:
+            await self.redis.xgroup_create(self.stream, GROUP, id='0',
+                                           mkstream=True)
+        except redis.ResponseError as error:
+            if 'BUSYGROUP' not in str(error):
+                raise
+        self.group_created = True
+
+    async def read(self, count, entry_id='>'):
+        """ New entries ('>') or those this consumer read before and did
+        not acknowledge ('0'), as (entry id, message or None). """
+        await self.create_group()
+        response = await self.redis.xreadgroup(
+            GROUP, self.consumer, {self.stream: entry_id}, count=count
+        )
+        return [(entry, self.decode(fields))
+                for _, entries in response for entry, fields in entries]
+
+    async def claim(self, count, min_idle_ms):
+        """ Entries other consumers read at least `min_idle_ms` ago without
+        acknowledging them. """
+        await self.create_group()
+        response = await self.redis.xautoclaim(
+            self.stream, GROUP, self.consumer, min_idle_time=min_idle_ms,
+            start_id='0-0', count=count
+        )
+        return [(entry, self.decode(fields)) for entry, fields in response[1]]
+
+    @staticmethod
+    def decode(fields):
+        """ The journaled message, {'seen': receipt} for a read receipt, or
+        None for an entry deleted while it was pending. """
+        if not fields:
+            return None
+        if b'seen' in fields:
+            return {'seen': json.loads(fields[b'seen'])}
+        return json.loads(fields[b'message'])
+
+    async def flush(self, count, claim_idle_ms):
+        """ Stores and removes up to `count` entries: this consumer's own
+        unacknowledged ones first, then stale ones of other consumers, then
+        new ones. Returns how many entries were handled. """
+        entries = (await self.read(count, entry_id='0')
+                   or await self.claim(count, claim_idle_ms)
+                   or await self.read(count))
+        if not entries:
+            return 0
+        decoded = [message for _, message in entries if message is not None]
+        await self.store([message for message in decoded
+                          if 'seen' not in message])
+        receipts = [message['seen'] for message in decoded
+                    if 'seen' in message]
+        if receipts:
+            await self.apply_receipts(receipts, claim_idle_ms)
+        # before XACK: entries of a crash in between are flushed again
+        pipe = self.redis.pipeline(transaction=False)
+        for message in decoded:
+            if 'seen' not in message:
+                pipe.hdel(self.index_key(message['recipient_id']),
+                          message['id'])
+        await pipe.execute()
+        ids = [entry for entry, _ in entries]
+        await self.redis.xack(self.stream, GROUP, *ids)
+        await self.redis.xdel(self.stream, *ids)
+        return len(entries)
+
+    async def store(self, messages):
+        """ store()s `messages`, one by one if a message makes the batch
+        fail; messages that fail on their own go to the dead letters.
+        Errors other than the data's, such as a lost connection, are
+        raised and the entries retried. """
+        try:
+            await database_sync_to_async(store)(messages)
+            return
+        except (DataError, IntegrityError):
+            if len(messages) == 1:
+                await self.bury(messages[0])
+                return
+        for message in messages:
+            try:
+                await database_sync_to_async(store)([message])
+            except (DataError, IntegrityError):
+                await self.bury(message)
+
+    async def apply_receipts(self, receipts, claim_idle_ms):
+        """ apply_receipts(), journaling the receipts that wait for their
+        messages again, and sends 'receipt' events to the senders of the
+        marked messages. """
+        marked, waiting = await database_sync_to_async(apply_receipts)(
+            receipts
+        )
+        expired = time.time() - claim_idle_ms / 500
+        for receipt in waiting:
+            if receipt['at'] < expired:
+                logger.warning('Read receipt of message %s dropped, the '
+                               'message was not stored', receipt['up_to'])
+            else:
+                await self.redis.xadd(self.stream,
+                                      {'seen': json.dumps(receipt)})
+        channel_layer = get_channel_layer()
+        for receipt in marked:
+            await channel_layer.group_send(
+                f'personal_{receipt["sender"]}',
+                {'type': 'receipt',
+                 'kind': 'seen',
+                 'user': receipt['reader'],
+                 'up_to': receipt['up_to']}
+            )
+
+    async def bury(self, message):
+        logger.exception('Chat message %s can not be stored, moved to %s',
+                         message['id'], self.dead_letters)
+        await self.redis.xadd(self.dead_letters,
+                              {'message': json.dumps(message)})
+
+    async def drain(self, claim_idle_ms=0):
+        """ Flushes until the journal is empty. """
+        flushed = 0
+        while count := await self.flush(settings.CHAT_FLUSH_BATCH_SIZE,
+                                        claim_idle_ms):
+            flushed += count
+        return flushed
+
+    async def run(self):
+        batch_size = settings.CHAT_FLUSH_BATCH_SIZE
+        interval = settings.CHAT_FLUSH_INTERVAL_MS / 1000
+        while True:
+            try:
+                flushed = await self.flush(batch_size,
+                                           settings.CHAT_JOURNAL_CLAIM_IDLE_MS)
+            except Exception:
+                # the entries stay pending and are retried
+                logger.exception('Flushing the chat journal failed')
+                flushed = 0
+            if flushed < batch_size:
+                await asyncio.sleep(interval)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.redis.aclose()
+
+
+# One journal per event loop: its Redis connections and flusher task
+# belong to the loop that created them.
+journals = weakref.WeakKeyDictionary()
+
+
+def get_journal():
+    """ The running loop's journal, its flusher started. """
+    loop = asyncio.get_running_loop()
+    journal = journals.get(loop)
+    if journal is None:
+        journal = journals[loop] = Journal.from_settings()
+        journal.start()
+    return journal
+
+
+async def close_journal():
+    journal = journals.pop(asyncio.get_running_loop(), None)
+    if journal is not None:
+        await journal.stop()
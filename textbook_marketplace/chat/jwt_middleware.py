@@ -1,22 +1,39 @@
 """
 Custom JWT authentication middleware for WebSocket connections.
 Based on django-channels-jwt-auth-middleware but with proper error handling.
+
+The connection's user is a Principal rather than a User instance: it is
+read from the shared cache (chat.caching), or with CHAT_WS_AUTH_FROM_CLAIMS
+built from the token's claims alone, so handshakes of reconnecting clients
+don't each query the database.
 """
 from urllib.parse import parse_qs
 
-from channels.auth import AuthMiddlewareStack
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from django.conf import settings
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
-from django.db import close_old_connections
 from jwt import decode as jwt_decode
 from jwt import InvalidSignatureError, ExpiredSignatureError, DecodeError
 import logging
 
+from . import caching
+
 logger = logging.getLogger(__name__)
 
-User = get_user_model()
+
+class Principal:
+    """ Authenticated user of a websocket connection: its id and username,
+    which is all ChatConsumer needs. """
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, pk, username):
+        self.pk = self.id = pk
+        self.username = username
+
+    def __repr__(self):
+        return f'<Principal {self.pk} {self.username}>'
 
 
 class CustomJWTAuthMiddleware:
@@ -29,14 +46,12 @@ class CustomJWTAuthMiddleware:
         self.app = app
 
     async def __call__(self, scope, receive, send):
-        close_old_connections()
         try:
             if(jwt_token_list := parse_qs(scope["query_string"].decode("utf8")).get('token', None)):
                 jwt_token = jwt_token_list[0]
                 try:
                     jwt_payload = self.get_payload(jwt_token)
-                    user_credentials = self.get_user_credentials(jwt_payload)
-                    user = await self.get_logged_in_user(user_credentials)
+                    user = await self.get_logged_in_user(jwt_payload)
                     scope['user'] = user
                 except ExpiredSignatureError:
                     logger.warning("WebSocket connection rejected: JWT token expired", exc_info=False)
@@ -68,18 +83,26 @@ class CustomJWTAuthMiddleware:
         user_id = payload['user_id']
         return user_id
 
-    async def get_logged_in_user(self, user_id):
-        user = await self.get_user(user_id)
-        return user
+    async def get_logged_in_user(self, payload):
+        user_id = self.get_user_credentials(payload)
+        if settings.CHAT_WS_AUTH_FROM_CLAIMS and 'username' in payload:
+            return Principal(user_id, payload['username'])
+        return await self.get_user(user_id)
 
-    @database_sync_to_async
-    def get_user(self, user_id):
-        try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
+    async def get_user(self, user_id):
+        # Cache hits don't queue behind the database thread
+        principal = await sync_to_async(caching.cached_principal,
+                                        thread_sensitive=False)(user_id)
+        if principal is None:
+            principal = await database_sync_to_async(caching.principal_for)(
+                user_id
+            )
+        if principal is None or not principal['is_active']:
             return AnonymousUser()
+        return Principal(principal['id'], principal['username'])
 
 
 def CustomJWTAuthMiddlewareStack(app):
-    return CustomJWTAuthMiddleware(AuthMiddlewareStack(app))
+    # No session or cookie middleware: websocket users come from the token
+    return CustomJWTAuthMiddleware(app)
 
@@ -0,0 +1,125 @@
+"""
+Management command comparing the websocket wire formats of ChatConsumer
+(see chat.protocol): plain JSON, compact JSON arrays and MessagePack.
+
+For each format it reports the bytes of a chat message as the recipient
+receives it plus what the sender gets back (the full echo in plain JSON,
+a 'sent' frame otherwise), the same after permessage-deflate (zlib with the
+context kept between frames, in the window and memory level websocket_server
+negotiates), and the CPU time to encode and decode a frame. No database or
+server needed.
+
+Usage:
+    python manage.py benchmark_chat_protocol
+    python manage.py benchmark_chat_protocol --length 20 200 --runs 20000
+"""
+
+import random
+import time
+import zlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.protocol import CompactCodec, JsonCodec, MsgpackCodec
+from textbook_marketplace.websocket_server import (DEFLATE_MEM_LEVEL,
+                                                   DEFLATE_WINDOW_BITS)
+
+SENDER = 'textbook_seller'
+RECIPIENT = 'second_book_reader'
+WORDS = ('добрый день учебник по матанализу ещё продаётся можно забрать '
+         'завтра у метро спасибо сколько стоит издание 2019 года '
+         'hi is the calculus book still available can we meet tomorrow '
+         'near the library thanks how much for the 3rd edition').split()
+MESSAGES_PER_DEFLATE_RUN = 200
+
+
+def text_of(length, seed):
+    words = random.Random(seed).choices(WORDS, k=length // 4 + 1)
+    return ' '.join(words)[:length]
+
+
+def frames_of(codec, text):
+    """ The frames one message costs: the recipient's and the echo. """
+    received = {'type': 'message', 'message': text, 'sender': SENDER,
+                'recipient': None if codec.compact else RECIPIENT}
+    if codec.compact:
+        echo = {'type': 'sent', 'ref': 1234}
+    else:
+        echo = {'type': 'message', 'message': text, 'sender': SENDER,
+                'recipient': RECIPIENT}
+    return received, echo
+
+
+def payload(encoded):
+    data = encoded.get('text_data')
+    return data.encode() if data is not None else encoded['bytes_data']
+
+
+class Command(BaseCommand):
+    help = 'Benchmark chat websocket wire formats: bytes and CPU per frame'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--length',
+            nargs='+',
+            type=int,
+            default=[20, 200, 2000],
+            help='Message lengths in characters (default: 20 200 2000)'
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=10000,
+            help='Frames encoded and decoded per row (default: 10000)'
+        )
+
+    def handle(self, *args, **options):
+        if options['runs'] < 1:
+            raise CommandError('--runs must be positive.')
+        codecs = [('json', JsonCodec()), ('compact', CompactCodec()),
+                  ('msgpack', MsgpackCodec())]
+        self.stdout.write(
+            f'{"chars":>6} {"format":>8} {"bytes/msg":>10} {"deflated":>9} '
+            f'{"encode us":>10} {"decode us":>10}'
+        )
+        for length in options['length']:
+            for name, codec in codecs:
+                frames = frames_of(codec, text_of(length, 0))
+                sizes = [len(payload(codec.encode(frame)))
+                         for frame in frames]
+                encode, decode = self.time(codec, frames[0], options['runs'])
+                self.stdout.write(
+                    f'{length:>6} {name:>8} {sum(sizes):>10} '
+                    f'{self.deflated(codec, length):>9.0f} '
+                    f'{encode:>10.2f} {decode:>10.2f}'
+                )
+
+    @staticmethod
+    def deflated(codec, length):
+        """ Average deflated bytes per message over a conversation of
+        different messages, as later frames reuse the compression context
+        of earlier ones. """
+        compressor = zlib.compressobj(wbits=-DEFLATE_WINDOW_BITS,
+                                      memLevel=DEFLATE_MEM_LEVEL)
+        total = 0
+        for seed in range(MESSAGES_PER_DEFLATE_RUN):
+            for frame in frames_of(codec, text_of(length, seed)):
+                total += len(compressor.compress(payload(codec.encode(frame))))
+                # RFC 7692 drops the 4 byte tail of each flush
+                total += len(compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+        return total / MESSAGES_PER_DEFLATE_RUN
+
+    @staticmethod
+    def time(codec, frame, runs):
+        """ Microseconds to encode `frame` and to decode it as received. """
+        started = time.perf_counter()
+        for _ in range(runs):
+            encoded = codec.encode(frame)
+        encode = (time.perf_counter() - started) / runs
+        text_data = encoded.get('text_data')
+        bytes_data = encoded.get('bytes_data')
+        started = time.perf_counter()
+        for _ in range(runs):
+            codec.decode(text_data, bytes_data)
+        decode = (time.perf_counter() - started) / runs
+        return encode * 1e6, decode * 1e6
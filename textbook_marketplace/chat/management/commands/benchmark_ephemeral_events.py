@@ -0,0 +1,159 @@
+"""
+Management command measuring what a flood of ephemeral events (typing,
+stopped_typing, see ChatConsumer.receive_ephemeral()) costs the chat
+messages of other users.
+
+A sender messages a recipient --messages times, once on a quiet server and
+once while a third user sends the recipient --events alternating typing and
+stopped_typing frames. It reports the median and p95 delivery latency of
+each run, the flood's frames per second and how many typing frames the
+recipient got. Connections are driven in process through the consumer, so
+the channel layer and database from the settings are used. Three users are
+created for the run and deleted after, with their messages.
+
+Usage:
+    python manage.py benchmark_ephemeral_events
+    python manage.py benchmark_ephemeral_events --messages 100 --events 50000
+"""
+
+import asyncio
+import statistics
+import time
+import uuid
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from chat.jwt_middleware import CustomJWTAuthMiddlewareStack
+from chat.models import Message
+from chat.routing import websocket_urlpatterns
+from marketplace.serializers import CustomTokenObtainPairSerializer
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark chat message latency under a flood of typing events'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=50,
+            help='Messages timed per run (default: 50)'
+        )
+        parser.add_argument(
+            '--events',
+            type=int,
+            default=10000,
+            help='Ephemeral frames sent during the flooded run '
+                 '(default: 10000)'
+        )
+
+    def handle(self, *args, **options):
+        if min(options['messages'], options['events']) < 1:
+            raise CommandError('--messages and --events must be positive.')
+        prefix = f'benchmark-typing-{uuid.uuid4().hex[:8]}'
+        names = [f'{prefix}-{role}'
+                 for role in ('sender', 'recipient', 'flooder')]
+        User.objects.bulk_create(User(username=name, is_seller=False)
+                                 for name in names)
+        users = {user.username: user
+                 for user in User.objects.filter(username__in=names)}
+        try:
+            tokens = [
+                str(CustomTokenObtainPairSerializer.get_token(users[name])
+                    .access_token)
+                for name in names
+            ]
+            results = asyncio.run(self.run(names, tokens, options['messages'],
+                                           options['events']))
+        finally:
+            # deleting the users would leave their messages without one
+            Message.objects.filter(
+                Q(sender__in=users.values()) | Q(recipient__in=users.values())
+            ).delete()
+            User.objects.filter(username__startswith=prefix).delete()
+        baseline, flooded, rate, typing = results
+        self.stdout.write(
+            f'{options["messages"]} messages per run, {options["events"]} '
+            f'ephemeral frames at {rate:.0f}/s, {typing} typing frames '
+            f'relayed'
+        )
+        self.stdout.write(f'{"run":>8} {"p50 ms":>8} {"p95 ms":>8}')
+        for name, latencies in (('quiet', baseline), ('flooded', flooded)):
+            latencies.sort()
+            p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+            self.stdout.write(
+                f'{name:>8} {statistics.median(latencies) * 1000:>8.2f} '
+                f'{p95 * 1000:>8.2f}'
+            )
+
+    async def run(self, names, tokens, messages, events):
+        app = CustomJWTAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+        sender, recipient, flooder = [
+            await self.connect(app, token) for token in tokens
+        ]
+        relayed = []
+        try:
+            # the flooder's connection has looked the recipient up
+            await flooder.send_json_to({'message': 'hi',
+                                        'recipient': names[1]})
+            await flooder.receive_json_from(timeout=5)
+            await recipient.receive_json_from(timeout=5)
+            baseline = await self.latencies(sender, recipient, names[1],
+                                            messages, relayed)
+            started = time.perf_counter()
+            flooded, _ = await asyncio.gather(
+                self.latencies(sender, recipient, names[1], messages,
+                               relayed),
+                self.flood(flooder, names[1], events)
+            )
+            rate = events / (time.perf_counter() - started)
+            while not await recipient.receive_nothing(timeout=0.5):
+                relayed.append(await recipient.receive_json_from())
+        finally:
+            for communicator in (sender, recipient, flooder):
+                await communicator.disconnect()
+        typing = sum(frame['type'] == 'typing' for frame in relayed)
+        return baseline, flooded, rate, typing
+
+    @staticmethod
+    async def connect(app, token):
+        communicator = WebsocketCommunicator(app, f'ws/chat/?token={token}')
+        connected, _ = await communicator.connect(timeout=5)
+        if not connected:
+            raise CommandError('Websocket connection rejected.')
+        await communicator.receive_json_from(timeout=5)
+        return communicator
+
+    @staticmethod
+    async def latencies(sender, recipient, username, messages, relayed):
+        """ Seconds from sending each message until the recipient has it;
+        other frames the recipient gets meanwhile go to `relayed`. """
+        latencies = []
+        for i in range(messages):
+            started = time.perf_counter()
+            await sender.send_json_to({'message': f'message {i}',
+                                       'recipient': username})
+            while True:
+                frame = await recipient.receive_json_from(timeout=5)
+                if frame['type'] == 'message':
+                    break
+                relayed.append(frame)
+            latencies.append(time.perf_counter() - started)
+            await sender.receive_json_from(timeout=5)
+        return latencies
+
+    @staticmethod
+    async def flood(flooder, username, events):
+        for i in range(events):
+            await flooder.send_json_to({
+                'type': 'stopped_typing' if i % 2 else 'typing',
+                'user': username
+            })
+            if i % 50 == 0:
+                await asyncio.sleep(0)
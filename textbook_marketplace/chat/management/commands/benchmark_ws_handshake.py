@@ -0,0 +1,171 @@
+"""
+Management command measuring websocket handshakes per second through the
+JWT middleware, as in a reconnect storm after a deploy:
+
+  database  the previous stack: session and cookie middleware plus a User
+            query per handshake
+  cached    CustomJWTAuthMiddlewareStack with the shared principal cache
+            (chat.caching), emptied for the benchmark users first
+  claims    CustomJWTAuthMiddlewareStack with CHAT_WS_AUTH_FROM_CLAIMS
+
+Handshakes are driven in process against an app that only accepts them, so
+the numbers compare authentication overhead, not the consumer. --users
+users are created for the run (the lookups run on other threads, which
+would not see uncommitted rows) and deleted after.
+
+Usage:
+    python manage.py benchmark_ws_handshake
+    python manage.py benchmark_ws_handshake --users 1000 --handshakes 5000
+"""
+
+import asyncio
+import statistics
+import time
+import uuid
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from chat import caching
+from chat.jwt_middleware import (CustomJWTAuthMiddleware,
+                                 CustomJWTAuthMiddlewareStack)
+from marketplace.serializers import CustomTokenObtainPairSerializer
+
+User = get_user_model()
+
+
+class DatabaseJWTAuthMiddleware(CustomJWTAuthMiddleware):
+    """ The user lookup before the principal cache. """
+
+    async def get_logged_in_user(self, payload):
+        return await self.get_user_from_db(self.get_user_credentials(payload))
+
+    @database_sync_to_async
+    def get_user_from_db(self, user_id):
+        try:
+            return User.objects.get(id=user_id)
+        except User.DoesNotExist:
+            return AnonymousUser()
+
+
+async def accept_app(scope, receive, send):
+    await receive()
+    if scope['user'].is_authenticated:
+        await send({'type': 'websocket.accept'})
+    else:
+        await send({'type': 'websocket.close', 'code': 4003})
+
+
+async def handshake(app, token):
+    """ Whether `app` accepted a handshake with `token`. """
+    scope = {
+        'type': 'websocket', 'path': '/ws/chat/', 'headers': [],
+        'query_string': f'token={token}'.encode(), 'subprotocols': [],
+    }
+    sent = []
+
+    async def receive():
+        return {'type': 'websocket.connect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]['type'] == 'websocket.accept'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark websocket handshake authentication'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=200,
+            help='Distinct users reconnecting (default: 200)'
+        )
+        parser.add_argument(
+            '--handshakes',
+            type=int,
+            default=2000,
+            help='Handshakes per mode (default: 2000)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=64,
+            help='Handshakes in flight (default: 64)'
+        )
+
+    def handle(self, *args, **options):
+        if min(options['users'], options['handshakes'],
+               options['concurrency']) < 1:
+            raise CommandError('--users, --handshakes and --concurrency must '
+                               'be positive.')
+        prefix = f'benchmark-ws-{uuid.uuid4().hex[:8]}'
+        User.objects.bulk_create(
+            User(username=f'{prefix}-{i}', is_seller=False)
+            for i in range(options['users'])
+        )
+        users = list(User.objects.filter(username__startswith=prefix))
+        try:
+            tokens = [
+                str(CustomTokenObtainPairSerializer.get_token(user)
+                    .access_token)
+                for user in users
+            ]
+            modes = [
+                ('database', DatabaseJWTAuthMiddleware(
+                    AuthMiddlewareStack(accept_app)), False),
+                ('cached', CustomJWTAuthMiddlewareStack(accept_app), False),
+                ('claims', CustomJWTAuthMiddlewareStack(accept_app), True),
+            ]
+            self.stdout.write(
+                f'{options["handshakes"]} handshakes of {len(users)} users '
+                f'per mode, concurrency {options["concurrency"]}'
+            )
+            self.stdout.write(
+                f'{"mode":>9} {"handshakes/s":>13} {"p50 ms":>8} '
+                f'{"p95 ms":>8}'
+            )
+            for name, app, from_claims in modes:
+                cache.delete_many([caching.PRINCIPAL_KEY.format(user.pk)
+                                   for user in users])
+                with override_settings(CHAT_WS_AUTH_FROM_CLAIMS=from_claims):
+                    elapsed, latencies = asyncio.run(self.run(
+                        app, tokens, options['handshakes'],
+                        options['concurrency']
+                    ))
+                latencies.sort()
+                p95 = latencies[int(len(latencies) * 0.95) - 1]
+                self.stdout.write(
+                    f'{name:>9} {len(latencies) / elapsed:>13.0f} '
+                    f'{statistics.median(latencies) * 1000:>8.2f} '
+                    f'{p95 * 1000:>8.2f}'
+                )
+        finally:
+            User.objects.filter(username__startswith=prefix).delete()
+            cache.delete_many([caching.PRINCIPAL_KEY.format(user.pk)
+                               for user in users])
+
+    @staticmethod
+    async def run(app, tokens, handshakes, concurrency):
+        queue = iter(range(handshakes))
+        latencies = []
+
+        async def worker():
+            for i in queue:
+                started = time.perf_counter()
+                if not await handshake(app, tokens[i % len(tokens)]):
+                    raise CommandError('Handshake rejected.')
+                latencies.append(time.perf_counter() - started)
+
+        await handshake(app, tokens[0])  # warm up imports and connections
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - started, latencies
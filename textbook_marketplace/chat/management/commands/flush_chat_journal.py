@@ -0,0 +1,44 @@
+"""
+Management command storing every message left in the chat journal (see
+chat.journal), including those read by server processes that are gone.
+
+Run it after turning CHAT_WRITE_BEHIND off, or to recover right away after
+a crash instead of waiting for CHAT_JOURNAL_CLAIM_IDLE_MS.
+
+Usage:
+    python manage.py flush_chat_journal
+    python manage.py flush_chat_journal --claim-idle-ms 30000
+"""
+
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from chat.journal import Journal
+
+
+class Command(BaseCommand):
+    help = 'Store all messages waiting in the chat journal'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--claim-idle-ms',
+            type=int,
+            default=0,
+            help='Only take over entries other processes read at least this '
+                 'long ago (default: 0, all of them)'
+        )
+
+    def handle(self, *args, **options):
+        flushed = asyncio.run(self.drain(options['claim_idle_ms']))
+        self.stdout.write(self.style.SUCCESS(
+            f'Flushed {flushed} journal entries'
+        ))
+
+    @staticmethod
+    async def drain(claim_idle_ms):
+        journal = Journal.from_settings()
+        try:
+            return await journal.drain(claim_idle_ms)
+        finally:
+            await journal.stop()
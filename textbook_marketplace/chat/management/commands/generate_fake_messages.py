@@ -1,9 +1,11 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
+from django.db import transaction
 
 from faker import Faker
 import random
 
+from chat.inbox import record_message
 from chat.models import Message
 
 
@@ -36,11 +38,13 @@ class Command(BaseCommand):
             sender, recipient = get_two_users()
             text: str = fake.text(max_nb_chars=255)
 
-            message_obj: Message = Message.objects.create(
-                sender=sender,
-                recipient=recipient,
-                text=text
-            )
+            with transaction.atomic():
+                message_obj: Message = Message.objects.create(
+                    sender=sender,
+                    recipient=recipient,
+                    text=text
+                )
+                record_message(message_obj)
 
             self.stdout.write(self.style.SUCCESS(
                 f'Successfully created message {message_obj.pk} '
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:27
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_message_recipient_alter_message_sender'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'sent_at', 'id'], name='chat_messag_sender__ed9d17_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['recipient', 'sent_at', 'id'], name='chat_messag_recipie_fc68e6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'recipient', 'sent_at', 'id'], name='chat_messag_sender__fcc205_idx'),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def backfill_conversations(apps, schema_editor):
+    """ One Conversation per pair that has exchanged messages, from a
+    single pass over the messages in (sent_at, id) order. """
+    Message = apps.get_model('chat', 'Message')
+    Conversation = apps.get_model('chat', 'Conversation')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    ids = dict(User.objects.values_list('username', 'pk'))
+    conversations = {}
+    messages = Message.objects.order_by('sent_at', 'id').values_list(
+        'pk', 'sender', 'recipient', 'text', 'sent_at', 'seen'
+    )
+    for pk, sender, recipient, text, sent_at, seen in messages.iterator(
+            chunk_size=BATCH_SIZE):
+        sender, recipient = ids.get(sender), ids.get(recipient)
+        if sender is None or recipient is None:
+            continue
+        user1, user2 = sorted((sender, recipient))
+        conversation = conversations.get((user1, user2))
+        if conversation is None:
+            conversation = conversations[user1, user2] = Conversation(
+                user1_id=user1, user2_id=user2
+            )
+        conversation.last_message_id = pk
+        conversation.last_message_text = text
+        conversation.last_message_at = sent_at
+        conversation.last_sender_id = sender
+        if not seen and sender != recipient:
+            field = 'user1_unread' if recipient == user1 else 'user2_unread'
+            setattr(conversation, field, getattr(conversation, field) + 1)
+    Conversation.objects.bulk_create(conversations.values(),
+                                     batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_history_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_text', models.TextField()),
+                ('last_message_at', models.DateTimeField()),
+                ('user1_unread', models.PositiveIntegerField(default=0)),
+                ('user2_unread', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('last_sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user1', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user2', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user1', 'last_message_at', 'id'], name='chat_conver_user1_i_70c77b_idx'), models.Index(fields=['user2', 'last_message_at', 'id'], name='chat_conver_user2_i_a331bc_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user1', 'user2'), name='chat_conversation_pair'), models.CheckConstraint(condition=models.Q(('user1__lte', models.F('user2'))), name='chat_conversation_pair_order')],
+            },
+        ),
+        migrations.RunPython(backfill_conversations,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,373 @@
+"""
+Message.sender and Message.recipient become integer foreign keys to User
+instead of pointing at User.username, without downtime:
+
+  1. sender_user_id / recipient_user_id are added as nullable columns
+     and the username columns (sender_id / recipient_id) become nullable.
+  2. On PostgreSQL a trigger fills whichever of the two columns an insert
+     leaves out, so workers still running the previous release (writing
+     usernames) and the new one (writing ids) see complete rows while
+     deploy.sh restarts them one by one.
+  3. Existing rows are backfilled in pk batches, each committing on its
+     own, then the id columns are made NOT NULL through a validated CHECK
+     constraint so no write-blocking table scan is needed.
+  4. The new indexes are built CONCURRENTLY.
+
+In the model state the id columns take over the sender/recipient fields;
+the username columns, their indexes and the trigger stay in the database
+for the previous release and are dropped by the next release's migration.
+"""
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.functions import Greatest, Least
+
+BATCH_SIZE = 1000
+
+TRIGGER_NAME = 'chat_message_sync_user_ids'
+
+INDEXES = [
+    models.Index(fields=['sender', 'sent_at', 'id'],
+                 name='chat_message_sender_sent_at'),
+    models.Index(fields=['recipient', 'sent_at', 'id'],
+                 name='chat_message_recipient_sent_at'),
+    models.Index(Least('sender', 'recipient'),
+                 Greatest('sender', 'recipient'),
+                 F('sent_at'), F('id'),
+                 name='chat_message_pair_sent_at'),
+    models.Index(fields=['recipient', 'seen'],
+                 condition=Q(seen=False),
+                 name='chat_message_unseen'),
+]
+
+
+def user_fk(column, related_name, null):
+    return models.ForeignKey(
+        on_delete=models.SET(None),
+        related_name=related_name,
+        to=settings.AUTH_USER_MODEL,
+        db_column=column,
+        db_index=False,
+        null=null,
+    )
+
+
+def add_user_id_column(name):
+    """ Adds the column of Message field `name`. On PostgreSQL the foreign
+    key is created NOT VALID and validated afterwards, which does not
+    block writes. """
+    def forwards(apps, schema_editor):
+        Message = apps.get_model('chat', 'Message')
+        field = Message._meta.get_field(name)
+        if schema_editor.connection.vendor != 'postgresql':
+            schema_editor.add_field(Message, field)
+            return
+        table = Message._meta.db_table
+        schema_editor.execute(
+            f'ALTER TABLE {table} ADD COLUMN {field.column} '
+            f'{field.db_type(schema_editor.connection)} NULL'
+        )
+        foreign_key = schema_editor._create_fk_sql(
+            Message, field, '_fk_%(to_table)s_%(to_column)s'
+        )
+        schema_editor.execute(f'{foreign_key} NOT VALID')
+        schema_editor.execute(
+            f'ALTER TABLE {table} VALIDATE CONSTRAINT '
+            f'{foreign_key.parts["name"]}'
+        )
+
+    def backwards(apps, schema_editor):
+        Message = apps.get_model('chat', 'Message')
+        schema_editor.remove_field(Message, Message._meta.get_field(name))
+
+    return migrations.RunPython(forwards, backwards)
+
+
+def with_null(Message, name, null):
+    """ Copy of Message field `name` that is (or is not) nullable. """
+    field = Message._meta.get_field(name)
+    altered = field.clone()
+    altered.null = null
+    altered.set_attributes_from_name(name)
+    altered.model = Message
+    altered.remote_field.model = field.remote_field.model
+    altered.remote_field.field_name = field.remote_field.field_name
+    return altered
+
+
+def alter_null(apps, schema_editor, fields, null):
+    """ Sets NULL / NOT NULL on the columns of Message `fields`.
+
+    On PostgreSQL this is done in SQL, as AlterField would also drop and
+    re-validate the foreign key constraints. SET NOT NULL is preceded by
+    a CHECK constraint validated without blocking writes, which lets it
+    skip its own scan. """
+    Message = apps.get_model('chat', 'Message')
+    table = Message._meta.db_table
+    for name in fields:
+        field = Message._meta.get_field(name)
+        if schema_editor.connection.vendor != 'postgresql':
+            schema_editor.alter_field(Message, field,
+                                      with_null(Message, name, null))
+        elif null:
+            schema_editor.execute(
+                f'ALTER TABLE {table} ALTER COLUMN {field.column} '
+                f'DROP NOT NULL'
+            )
+        else:
+            check = f'{table}_{field.column}_not_null'
+            schema_editor.execute(
+                f'ALTER TABLE {table} ADD CONSTRAINT {check} '
+                f'CHECK ({field.column} IS NOT NULL) NOT VALID'
+            )
+            schema_editor.execute(
+                f'ALTER TABLE {table} VALIDATE CONSTRAINT {check}'
+            )
+            schema_editor.execute(
+                f'ALTER TABLE {table} ALTER COLUMN {field.column} SET NOT NULL'
+            )
+            schema_editor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {check}')
+
+
+def allow_null_usernames(apps, schema_editor):
+    alter_null(apps, schema_editor, ['sender', 'recipient'], True)
+
+
+def require_usernames(apps, schema_editor):
+    alter_null(apps, schema_editor, ['sender', 'recipient'], False)
+
+
+def require_user_ids(apps, schema_editor):
+    alter_null(apps, schema_editor, ['sender_user', 'recipient_user'], False)
+
+
+def allow_null_user_ids(apps, schema_editor):
+    alter_null(apps, schema_editor, ['sender_user', 'recipient_user'], True)
+
+
+def create_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Message = apps.get_model('chat', 'Message')
+    users = apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table
+    sync = []
+    for role in ('sender', 'recipient'):
+        username = Message._meta.get_field(role).column
+        user_id = Message._meta.get_field(f'{role}_user').column
+        sync.append(f'''
+            IF NEW.{user_id} IS NULL AND NEW.{username} IS NOT NULL THEN
+                SELECT id INTO NEW.{user_id} FROM {users}
+                WHERE username = NEW.{username};
+            ELSIF NEW.{username} IS NULL AND NEW.{user_id} IS NOT NULL THEN
+                SELECT username INTO NEW.{username} FROM {users}
+                WHERE id = NEW.{user_id};
+            END IF;''')
+    schema_editor.execute(f'''
+        CREATE OR REPLACE FUNCTION {TRIGGER_NAME}() RETURNS trigger AS $$
+        BEGIN{''.join(sync)}
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    schema_editor.execute(
+        f'CREATE TRIGGER {TRIGGER_NAME} BEFORE INSERT ON '
+        f'{Message._meta.db_table} FOR EACH ROW EXECUTE FUNCTION '
+        f'{TRIGGER_NAME}()'
+    )
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Message = apps.get_model('chat', 'Message')
+    schema_editor.execute(
+        f'DROP TRIGGER IF EXISTS {TRIGGER_NAME} ON {Message._meta.db_table}'
+    )
+    schema_editor.execute(f'DROP FUNCTION IF EXISTS {TRIGGER_NAME}()')
+
+
+def backfill_user_ids(apps, schema_editor):
+    """ Copies the user ids of the username columns in pk batches, so each
+    batch commits on its own and no long lock is held on the table. """
+    Message = apps.get_model('chat', 'Message')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+
+    def user_id(field):
+        return Subquery(
+            User.objects.filter(username=OuterRef(field)).values('pk')[:1]
+        )
+
+    last_pk = 0
+    while True:
+        batch = list(
+            Message.objects.filter(pk__gt=last_pk)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        Message.objects.filter(pk__in=batch).filter(
+            Q(sender_user__isnull=True) | Q(recipient_user__isnull=True)
+        ).update(sender_user=user_id('sender'),
+                 recipient_user=user_id('recipient'))
+        last_pk = batch[-1]
+
+
+def restore_username_columns(Message, schema_editor):
+    """ Adds the username columns back, nullable, where they are gone.
+
+    The model state no longer has them after this migration, so on SQLite
+    any later migration that rebuilds the table drops them, and reversing
+    it does not bring them back. """
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        columns = {column.name for column in
+                   connection.introspection.get_table_description(
+                       cursor, Message._meta.db_table
+                   )}
+    for name in ('sender', 'recipient'):
+        if Message._meta.get_field(name).column not in columns:
+            schema_editor.add_field(Message, with_null(Message, name, True))
+
+
+def backfill_usernames(apps, schema_editor):
+    """ Reverse of backfill_user_ids, for rows written by the new release. """
+    Message = apps.get_model('chat', 'Message')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    if schema_editor.connection.vendor != 'postgresql':
+        restore_username_columns(Message, schema_editor)
+
+    def username(field):
+        return Subquery(
+            User.objects.filter(pk=OuterRef(field)).values('username')[:1]
+        )
+
+    Message.objects.filter(
+        Q(sender__isnull=True) | Q(recipient__isnull=True)
+    ).update(sender=username('sender_user'),
+             recipient=username('recipient_user'))
+
+
+def create_indexes(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    for index in INDEXES:
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.add_index(Message, index, concurrently=True)
+        else:
+            schema_editor.add_index(Message, index)
+
+
+def drop_indexes(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    for index in INDEXES:
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.remove_index(Message, index, concurrently=True)
+        else:
+            schema_editor.remove_index(Message, index)
+
+
+class Migration(migrations.Migration):
+    # Batches commit separately and CREATE INDEX CONCURRENTLY cannot run
+    # inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('chat', '0005_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # One column at a time, so that reversing on SQLite rebuilds the
+        # table from a state that matches it.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='message',
+                    name='sender_user',
+                    field=user_fk('sender_user_id', '+', null=True),
+                ),
+            ],
+        ),
+        add_user_id_column('sender_user'),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='message',
+                    name='recipient_user',
+                    field=user_fk('recipient_user_id', '+', null=True),
+                ),
+            ],
+        ),
+        add_user_id_column('recipient_user'),
+        # The username fields leave the model state below, so only the
+        # database needs to change here.
+        migrations.RunPython(allow_null_usernames, require_usernames),
+        migrations.RunPython(create_trigger, drop_trigger),
+        migrations.RunPython(backfill_user_ids, backfill_usernames),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(require_user_ids, allow_null_user_ids),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='message',
+                    name='sender_user',
+                    field=user_fk('sender_user_id', '+', null=False),
+                ),
+                migrations.AlterField(
+                    model_name='message',
+                    name='recipient_user',
+                    field=user_fk('recipient_user_id', '+', null=False),
+                ),
+            ],
+        ),
+        # The id columns take over sender/recipient; the username columns
+        # and their indexes are left in place for the previous release.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveIndex(
+                    model_name='message',
+                    name='chat_messag_sender__ed9d17_idx',
+                ),
+                migrations.RemoveIndex(
+                    model_name='message',
+                    name='chat_messag_recipie_fc68e6_idx',
+                ),
+                migrations.RemoveIndex(
+                    model_name='message',
+                    name='chat_messag_sender__fcc205_idx',
+                ),
+                migrations.RemoveField(model_name='message', name='sender'),
+                migrations.RemoveField(model_name='message', name='recipient'),
+                migrations.RenameField(model_name='message',
+                                       old_name='sender_user',
+                                       new_name='sender'),
+                migrations.RenameField(model_name='message',
+                                       old_name='recipient_user',
+                                       new_name='recipient'),
+                migrations.AlterField(
+                    model_name='message',
+                    name='sender',
+                    field=user_fk('sender_user_id', 'message_sender',
+                                  null=False),
+                ),
+                migrations.AlterField(
+                    model_name='message',
+                    name='recipient',
+                    field=user_fk('recipient_user_id', 'message_recipient',
+                                  null=False),
+                ),
+                migrations.AlterModelOptions(name='message', options={}),
+            ],
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_indexes, drop_indexes),
+            ],
+            state_operations=[
+                migrations.AddIndex(model_name='message', index=index)
+                for index in INDEXES
+            ],
+        ),
+    ]
@@ -0,0 +1,135 @@
+"""
+Contract step of 0006_message_user_ids: drops what it left in the database
+for the release before it, which wrote Message.sender / recipient as
+usernames. On PostgreSQL that is the trigger filling the other column, the
+foreign keys of the username columns to User.username, the indexes of
+0004_message_history_indexes and the columns themselves.
+
+Only apply it once no worker of that release runs any more. deploy.sh
+migrates before restarting the workers, so a server still on a release
+before 0006 is upgraded in two steps: `manage.py migrate chat 0007`, the
+restart, then `manage.py migrate`.
+
+On SQLite, 0006 already rebuilt the table from the model state, which
+left these columns out; it is rebuilt again only if they are still there.
+"""
+
+from django.conf import settings
+from django.db import migrations, models
+
+TRIGGER_NAME = 'chat_message_sync_user_ids'
+
+# name -> columns of the indexes 0004_message_history_indexes created
+LEGACY_INDEXES = {
+    'chat_messag_sender__ed9d17_idx': ('sender_id', 'sent_at', 'id'),
+    'chat_messag_recipie_fc68e6_idx': ('recipient_id', 'sent_at', 'id'),
+    'chat_messag_sender__fcc205_idx': ('sender_id', 'recipient_id',
+                                       'sent_at', 'id'),
+}
+
+# Message field -> the column that held it as a username
+LEGACY_COLUMNS = {'sender': 'sender_id', 'recipient': 'recipient_id'}
+
+
+def legacy_field(Message, User, role):
+    """ The username foreign key of Message field `role` as 0006 left it,
+    nullable. """
+    field = models.ForeignKey(
+        User,
+        on_delete=models.SET(None),
+        related_name='+',
+        to_field='username',
+        db_column=LEGACY_COLUMNS[role],
+        null=True,
+    )
+    field.set_attributes_from_name(f'legacy_{role}')
+    field.model = Message
+    return field
+
+
+def drop_usernames(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    table = Message._meta.db_table
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        with connection.cursor() as cursor:
+            columns = {column.name for column in
+                       connection.introspection.get_table_description(
+                           cursor, table
+                       )}
+        if columns & set(LEGACY_COLUMNS.values()):
+            # rebuilt from the model state, which lacks them
+            schema_editor._remake_table(Message)
+        return
+    schema_editor.execute(f'DROP TRIGGER IF EXISTS {TRIGGER_NAME} ON {table}')
+    schema_editor.execute(f'DROP FUNCTION IF EXISTS {TRIGGER_NAME}()')
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    for name, constraint in constraints.items():
+        if constraint['foreign_key'] and \
+                set(constraint['columns']) & set(LEGACY_COLUMNS.values()):
+            schema_editor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {name}')
+    for name in LEGACY_INDEXES:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    for column in LEGACY_COLUMNS.values():
+        schema_editor.execute(
+            f'ALTER TABLE {table} DROP COLUMN IF EXISTS {column}'
+        )
+
+
+def restore_usernames(apps, schema_editor):
+    """ Adds the username columns back, filled in, with their foreign keys,
+    indexes and trigger, for reversing 0006 on PostgreSQL. On SQLite,
+    0006 adds them back itself. """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Message = apps.get_model('chat', 'Message')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    table = Message._meta.db_table
+    users = User._meta.db_table
+    sync = []
+    for role, username in LEGACY_COLUMNS.items():
+        schema_editor.add_field(Message, legacy_field(Message, User, role))
+        user_id = Message._meta.get_field(role).column
+        schema_editor.execute(
+            f'UPDATE {table} SET {username} = {users}.username FROM {users} '
+            f'WHERE {users}.id = {table}.{user_id}'
+        )
+        sync.append(f'''
+            IF NEW.{user_id} IS NULL AND NEW.{username} IS NOT NULL THEN
+                SELECT id INTO NEW.{user_id} FROM {users}
+                WHERE username = NEW.{username};
+            ELSIF NEW.{username} IS NULL AND NEW.{user_id} IS NOT NULL THEN
+                SELECT username INTO NEW.{username} FROM {users}
+                WHERE id = NEW.{user_id};
+            END IF;''')
+    schema_editor.execute(f'''
+        CREATE OR REPLACE FUNCTION {TRIGGER_NAME}() RETURNS trigger AS $$
+        BEGIN{''.join(sync)}
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    schema_editor.execute(
+        f'CREATE TRIGGER {TRIGGER_NAME} BEFORE INSERT ON {table} '
+        f'FOR EACH ROW EXECUTE FUNCTION {TRIGGER_NAME}()'
+    )
+    for name, columns in LEGACY_INDEXES.items():
+        schema_editor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+            f'ON {table} ({", ".join(columns)})'
+        )
+
+
+class Migration(migrations.Migration):
+    # DROP / CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('chat', '0007_message_sent_at_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_usernames, restore_usernames),
+    ]
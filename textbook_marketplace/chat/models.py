@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models import F, Q
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 
@@ -7,22 +10,91 @@ User = get_user_model()
 
 class Message(models.Model):
     """ Model for messages in user chats. """
+    # The columns are named after the integer ids so that the previous
+    # username columns can live next to them while a release rolls out,
+    # see migration 0006_message_user_ids. The (sender, ...) and
+    # (recipient, ...) indexes below cover the foreign keys.
     sender = models.ForeignKey(User,
                                related_name='message_sender',
                                on_delete=models.SET(AnonymousUser.id),
-                               to_field="username")
+                               db_column='sender_user_id',
+                               db_index=False)
     recipient = models.ForeignKey(User,
                                   related_name='message_recipient',
                                   on_delete=models.SET(AnonymousUser.id),
-                                  to_field="username")
+                                  db_column='recipient_user_id',
+                                  db_index=False)
     text = models.TextField()
     seen = models.BooleanField(default=False)
-    sent_at = models.DateTimeField(auto_now_add=True)
+    # A default rather than auto_now_add, which would overwrite the time of
+    # messages persisted later from the journal (see chat.journal)
+    sent_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
-        ordering = ['sender', 'recipient']
+        indexes = [
+            # History pages per user and per conversation, newest first,
+            # see chat.pagination.MessagePagination
+            models.Index(fields=['sender', 'sent_at', 'id'],
+                         name='chat_message_sender_sent_at'),
+            models.Index(fields=['recipient', 'sent_at', 'id'],
+                         name='chat_message_recipient_sent_at'),
+            # Both directions of a conversation, see Message.between()
+            models.Index(Least('sender', 'recipient'),
+                         Greatest('sender', 'recipient'),
+                         F('sent_at'), F('id'),
+                         name='chat_message_pair_sent_at'),
+            # Undelivered and unread messages of a recipient
+            models.Index(fields=['recipient', 'seen'],
+                         condition=Q(seen=False),
+                         name='chat_message_unseen'),
+        ]
+
+    @classmethod
+    def between(cls, user, other):
+        """ Messages of user and other in both directions, matching the
+        chat_message_pair_sent_at index. """
+        low, high = sorted((user.pk, other.pk))
+        return cls.objects.alias(
+            user_low=Least('sender', 'recipient'),
+            user_high=Greatest('sender', 'recipient'),
+        ).filter(user_low=low, user_high=high)
 
     def __str__(self):
         return (f'Sender: {self.sender.username}; '
                 f'Recipient: {self.recipient.username}; '
                 f'Text: {self.text[:15]}')
+
+
+class Conversation(models.Model):
+    """ Inbox entry of two users: their last message and how many messages
+    each of them has not seen yet. Kept up to date by chat.inbox.
+
+    The pair is stored once, user1 being the one with the lower id. """
+    user1 = models.ForeignKey(User, related_name='+',
+                              on_delete=models.CASCADE)
+    user2 = models.ForeignKey(User, related_name='+',
+                              on_delete=models.CASCADE)
+    last_message = models.ForeignKey(Message, related_name='+', null=True,
+                                     on_delete=models.SET_NULL)
+    last_message_text = models.TextField()
+    last_message_at = models.DateTimeField()
+    last_sender = models.ForeignKey(User, related_name='+',
+                                    on_delete=models.CASCADE)
+    user1_unread = models.PositiveIntegerField(default=0)
+    user2_unread = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user1', 'user2'],
+                                    name='chat_conversation_pair'),
+            models.CheckConstraint(condition=models.Q(user1__lte=models.F('user2')),
+                                   name='chat_conversation_pair_order'),
+        ]
+        indexes = [
+            # Inbox pages, see chat.pagination.ConversationPagination
+            models.Index(fields=['user1', 'last_message_at', 'id']),
+            models.Index(fields=['user2', 'last_message_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f'{self.user1_id} - {self.user2_id}: {self.last_message_text[:15]}'
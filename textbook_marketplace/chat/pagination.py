@@ -0,0 +1,197 @@
+import heapq
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessagePagination(BasePagination):
+    """ Keyset pagination of chat history on (position_field, id).
+
+    History pages go backwards from the newest message; `next` links to
+    older messages. With ?since_id= the page holds the messages after that
+    one, oldest first, so a client catches up after reconnecting; `next`
+    then links to the following batch.
+
+    Views pass the history as branches, querysets that are OR-ed together
+    (sent and received messages, see MessageView). Each branch is read
+    from its own (..., sent_at, id) index and the results are merged,
+    instead of sorting every row matching the OR.
+    """
+    position_field = 'sent_at'
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    since_query_param = 'since_id'
+    invalid_cursor_message = 'Invalid cursor'
+    unknown_since_message = 'Unknown since_id'
+
+    @property
+    def newest_first(self):
+        return f'-{self.position_field}', '-id'
+
+    @property
+    def oldest_first(self):
+        return self.position_field, 'id'
+
+    def paginate_branches(self, branches, request):
+        self.request = request
+        self.limit = self.get_limit(request)
+        since = None
+        if self.since_query_param:
+            since = request.query_params.get(self.since_query_param)
+        if since is not None:
+            self.ordering = self.oldest_first
+            position = self.since_position(branches, since)
+        else:
+            self.ordering = self.newest_first
+            position = self.decode_cursor(request)
+
+        results = self.fetch(branches, position)
+        self.has_next = len(results) > self.limit
+        self.page = results[:self.limit]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        parameters = [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Opaque cursor from a previous next link.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': f'Page size (default {self.page_size}, '
+                               f'at most {self.max_page_size}).',
+                'schema': {'type': 'integer'},
+            },
+        ]
+        if self.since_query_param:
+            parameters.append({
+                'name': self.since_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Only messages after this one, oldest first.',
+                'schema': {'type': 'integer'},
+            })
+        return parameters
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(limit, self.max_page_size) if limit > 0 else self.page_size
+
+    def fetch(self, branches, position):
+        querysets = []
+        for branch in branches:
+            branch = branch.order_by(*self.ordering)
+            if position is not None:
+                branch = branch.filter(self.after(position))
+            querysets.append(branch)
+        if len(querysets) == 1:
+            return list(querysets[0][:self.limit + 1])
+
+        # every branch contributes at most a page plus the look-ahead row
+        features = connections[querysets[0].db].features
+        if not features.supports_slicing_ordering_in_compound:
+            # e.g. sqlite: a query per branch, merged here
+            pages = [list(branch[:self.limit + 1]) for branch in querysets]
+            return list(heapq.merge(
+                *pages, key=self.position,
+                reverse=self.ordering == self.newest_first
+            ))[:self.limit + 1]
+        queryset = querysets[0][:self.limit + 1].union(
+            *(branch[:self.limit + 1] for branch in querysets[1:]), all=True
+        )
+        return list(queryset.order_by(*self.ordering)[:self.limit + 1])
+
+    def position(self, instance):
+        return getattr(instance, self.position_field), instance.pk
+
+    def after(self, position):
+        """ Rows strictly after `position` (position_field, id) in
+        self.ordering; see marketplace.pagination.TextbookPagination.after. """
+        value, pk = position
+        name = self.position_field
+        op = 'lt' if self.ordering == self.newest_first else 'gt'
+        return Q(**{f'{name}__{op}e': value}) & (
+            Q(**{f'{name}__{op}': value}) | Q(**{f'id__{op}': pk})
+        )
+
+    def since_position(self, branches, since):
+        try:
+            since = int(since)
+        except ValueError:
+            raise NotFound(self.unknown_since_message)
+        for branch in branches:
+            value = branch.filter(pk=since).values_list(self.position_field,
+                                                        flat=True).first()
+            if value is not None:
+                return value, since
+        raise NotFound(self.unknown_since_message)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        if self.ordering == self.oldest_first:
+            return replace_query_param(url, self.since_query_param, last.pk)
+        url = remove_query_param(url, self.since_query_param)
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(last))
+
+    def encode_cursor(self, instance):
+        value, pk = self.position(instance)
+        token = json.dumps([value.isoformat(), pk], separators=(',', ':'))
+        return urlsafe_b64encode(token.encode()).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, request):
+        """ (position_field, id) of the cursor, None without one. """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            value, pk = json.loads(urlsafe_b64decode(padded.encode('ascii')))
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError(encoded)
+            return value, int(pk)
+        except (BinasciiError, UnicodeError, TypeError, ValueError,
+                ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class ConversationPagination(MessagePagination):
+    """ Inbox pages, most recently active conversation first. """
+    position_field = 'last_message_at'
+    since_query_param = None
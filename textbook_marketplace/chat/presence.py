@@ -0,0 +1,98 @@
+"""
+Who is connected to ChatConsumer, kept in Redis.
+
+Each connection of a user is a member of the sorted set
+chat:presence:<user id>, scored with the time it expires. ChatConsumer
+renews its member every CHAT_PRESENCE_HEARTBEAT_INTERVAL seconds and
+removes it on disconnect; members left by processes that died expire after
+CHAT_PRESENCE_TIMEOUT. A user is online while any member has not expired,
+so a user with several devices goes offline when the last one leaves.
+
+Connections subscribed to a user's status (see ChatConsumer) join the
+group presence_<user id>, which hears when the user comes online or goes
+offline through a disconnect. Expiry is not announced; subscribers ask
+again when they reconnect.
+"""
+
+import asyncio
+import time
+import weakref
+
+import redis
+import redis.asyncio as redis_async
+from django.conf import settings
+
+KEY = 'chat:presence:{}'
+GROUP = 'presence_{}'
+
+clients = weakref.WeakKeyDictionary()
+sync_client = None
+
+
+def get_client():
+    """ The running loop's Redis client. """
+    loop = asyncio.get_running_loop()
+    client = clients.get(loop)
+    if client is None:
+        client = clients[loop] = redis_async.Redis.from_url(
+            settings.CHAT_PRESENCE_REDIS_URL
+        )
+    return client
+
+
+def get_sync_client():
+    global sync_client
+    if sync_client is None:
+        sync_client = redis.Redis.from_url(settings.CHAT_PRESENCE_REDIS_URL)
+    return sync_client
+
+
+def register(pipe, user_id, connection, now):
+    key = KEY.format(user_id)
+    timeout = settings.CHAT_PRESENCE_TIMEOUT
+    pipe.zremrangebyscore(key, '-inf', now)
+    pipe.zcard(key)
+    pipe.zadd(key, {connection: now + timeout})
+    pipe.expire(key, timeout)
+    return pipe
+
+
+def count_online(pipe, user_ids, now):
+    for user_id in user_ids:
+        pipe.zcount(KEY.format(user_id), f'({now}', '+inf')
+    return pipe
+
+
+async def connect(user_id, connection):
+    """ Registers or renews `connection` of user `user_id`; True if the
+    user had no other live connection, i.e. just came online. """
+    pipe = register(get_client().pipeline(), user_id, connection, time.time())
+    _, others, _, _ = await pipe.execute()
+    return others == 0
+
+
+async def disconnect(user_id, connection):
+    """ Removes `connection`; True if it was the user's last one. """
+    key = KEY.format(user_id)
+    pipe = get_client().pipeline()
+    pipe.zrem(key, connection)
+    pipe.zremrangebyscore(key, '-inf', time.time())
+    pipe.zcard(key)
+    removed, _, left = await pipe.execute()
+    return bool(removed) and left == 0
+
+
+async def online(user_ids):
+    """ {user id: whether the user has a live connection}. """
+    pipe = count_online(get_client().pipeline(transaction=False), user_ids,
+                        time.time())
+    return {user_id: count > 0
+            for user_id, count in zip(user_ids, await pipe.execute())}
+
+
+def online_now(user_ids):
+    """ online() for synchronous callers. """
+    pipe = count_online(get_sync_client().pipeline(transaction=False),
+                        user_ids, time.time())
+    return {user_id: count > 0
+            for user_id, count in zip(user_ids, pipe.execute())}
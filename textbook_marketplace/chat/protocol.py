@@ -0,0 +1,108 @@
+"""
+Wire formats of ChatConsumer frames.
+
+Clients that ask for no subprotocol exchange JSON objects, as before.
+Clients may instead negotiate one of SUBPROTOCOLS, in which a frame is an
+array: its type's code, then its fields in FRAMES order, trailing empty
+fields left out. 'sbook.msgpack.v1' sends the arrays as MessagePack binary
+frames, 'sbook.compact.v1' as JSON text frames for clients without a
+MessagePack library. Both skip echoing a sent message back in full: the
+sender gets a 'sent' frame with the ref it gave the message instead.
+"""
+
+import json
+
+import msgpack
+
+# type -> (code, fields); codes and field order are the compact schema,
+# new fields are only ever appended
+FRAMES = {
+    'message': (0, ('message', 'recipient', 'sender', 'ref', 'id')),
+    'sent': (1, ('ref', 'id')),
+    'notification': (2, ('new_messages', 'has_more', 'conversations')),
+    'error': (3, ('message', 'sender')),
+    'presence': (4, ('users',)),
+    'seen': (5, ('user', 'up_to')),
+    'ack': (6, ('user', 'up_to')),
+    'receipt': (7, ('kind', 'user', 'up_to')),
+    'typing': (8, ('user',)),
+    'stopped_typing': (9, ('user',)),
+    'ping': (10, ()),
+}
+TYPES = {code: (frame_type, fields)
+         for frame_type, (code, fields) in FRAMES.items()}
+
+
+def message_id(value) -> int | None:
+    """ `value` as a message id, if it is an integer or a string of digits,
+    as clients give 'up_to'; None otherwise. """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isdecimal():
+        return int(value)
+    return None
+
+
+class JsonCodec:
+    """ JSON objects in text frames. """
+    subprotocol = None
+    compact = False
+
+    def encode(self, frame: dict) -> dict:
+        """ send() keyword arguments for `frame`. """
+        return {'text_data': json.dumps(frame)}
+
+    def decode(self, text_data: str | None, bytes_data: bytes | None
+               ) -> dict:
+        return json.loads(text_data)
+
+
+class CompactCodec(JsonCodec):
+    """ Arrays of the FRAMES schema in JSON text frames. """
+    subprotocol = 'sbook.compact.v1'
+    compact = True
+
+    def pack(self, frame: dict) -> list:
+        code, fields = FRAMES[frame['type']]
+        values = [frame.get(field) for field in fields]
+        while values and values[-1] is None:
+            values.pop()
+        return [code, *values]
+
+    def unpack(self, array: list) -> dict:
+        if not isinstance(array, list) or not array or array[0] not in TYPES:
+            raise ValueError('Unknown frame.')
+        frame_type, fields = TYPES[array[0]]
+        return {'type': frame_type, **dict(zip(fields, array[1:]))}
+
+    def encode(self, frame: dict) -> dict:
+        return {'text_data': json.dumps(self.pack(frame),
+                                        separators=(',', ':'),
+                                        ensure_ascii=False)}
+
+    def decode(self, text_data, bytes_data):
+        return self.unpack(json.loads(text_data))
+
+
+class MsgpackCodec(CompactCodec):
+    """ Arrays of the FRAMES schema in MessagePack binary frames. """
+    subprotocol = 'sbook.msgpack.v1'
+
+    def encode(self, frame):
+        return {'bytes_data': msgpack.packb(self.pack(frame))}
+
+    def decode(self, text_data, bytes_data):
+        return self.unpack(msgpack.unpackb(bytes_data))
+
+
+SUBPROTOCOLS = {codec.subprotocol: codec
+                for codec in (MsgpackCodec(), CompactCodec())}
+
+
+def negotiate(subprotocols: list[str]) -> JsonCodec:
+    """ The codec of the first of the client's `subprotocols` supported
+    here, plain JSON if none is. """
+    for subprotocol in subprotocols:
+        if subprotocol in SUBPROTOCOLS:
+            return SUBPROTOCOLS[subprotocol]
+    return JsonCodec()
@@ -1,11 +1,44 @@
 from rest_framework import serializers
 
-from .models import Message
+from .models import Conversation, Message
 
 
 class MessageSerializer(serializers.ModelSerializer):
     text = serializers.CharField(max_length=255)
+    # Views load the users with prefetch_related_objects() or
+    # select_related(), so this does not query a user per message.
+    sender = serializers.SlugRelatedField(slug_field='username',
+                                          read_only=True)
+    recipient = serializers.SlugRelatedField(slug_field='username',
+                                             read_only=True)
 
     class Meta:
         model = Message
         fields = '__all__'
+
+
+class ConversationSerializer(serializers.Serializer):
+    """ Inbox entry as seen by context['user']. context['users'] maps user
+    ids to users (see chat.inbox.users_of), so no user is queried per
+    conversation. """
+    id = serializers.IntegerField(read_only=True)
+    user = serializers.SerializerMethodField()
+    last_message_id = serializers.IntegerField(read_only=True)
+    last_message_text = serializers.CharField(read_only=True)
+    last_message_at = serializers.DateTimeField(read_only=True)
+    last_sender = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
+
+    def get_user(self, conversation: Conversation) -> str:
+        user = self.context['user']
+        other_id = (conversation.user2_id if conversation.user1_id == user.pk
+                    else conversation.user1_id)
+        return self.context['users'][other_id].username
+
+    def get_last_sender(self, conversation: Conversation) -> str:
+        return self.context['users'][conversation.last_sender_id].username
+
+    def get_unread(self, conversation: Conversation) -> int:
+        if conversation.user1_id == self.context['user'].pk:
+            return conversation.user1_unread
+        return conversation.user2_unread
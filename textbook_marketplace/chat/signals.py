@@ -0,0 +1,63 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .caching import forget_principal, forget_user, refresh_block
+from marketplace.models import Block
+
+User = get_user_model()
+
+
+@receiver([post_save, post_delete], sender=Block)
+def invalidate_block_cache(sender, instance, **kwargs):
+    """ Once a block (BlockView.post/delete) commits, stores the new state
+    of the pair in the shared cache and tells the consumers of both users,
+    which keep their own copy. """
+    pair = (instance.initiator_user_id, instance.blocked_user_id)
+    transaction.on_commit(lambda: publish_block_state(*pair))
+
+
+def publish_block_state(user_id, other_id):
+    blocked = refresh_block(user_id, other_id)
+    channel_layer = get_channel_layer()
+    usernames = User.objects.filter(pk__in=(user_id, other_id)).values_list(
+        'username', flat=True
+    )
+    for username in usernames:
+        async_to_sync(channel_layer.group_send)(
+            f'personal_{username}',
+            {'type': 'block_changed',
+             'users': [user_id, other_id],
+             'blocked': blocked}
+        )
+
+
+@receiver(post_init, sender=User)
+def remember_loaded_username(sender, instance, **kwargs):
+    """ Keeps the username the row was loaded with, so a rename also drops
+    the cached id of the old one. """
+    # __dict__ rather than getattr so a deferred username is not loaded
+    instance._chat_username = instance.__dict__.get('username')
+
+
+@receiver(post_save, sender=User)
+def invalidate_principal_cache(sender, instance, **kwargs):
+    """ Renamed or deactivated users are looked up again by the next
+    websocket handshake, and a renamed user's old username no longer
+    leads to them. """
+    user_id, username = instance.pk, instance._chat_username
+    if username is not None and \
+            username != instance.__dict__.get('username', username):
+        transaction.on_commit(lambda: forget_user(username))
+    instance._chat_username = instance.__dict__.get('username', username)
+    transaction.on_commit(lambda: forget_principal(user_id))
+
+
+@receiver(post_delete, sender=User)
+def invalidate_user_cache(sender, instance, **kwargs):
+    username, user_id = instance.username, instance.pk
+    transaction.on_commit(lambda: forget_user(username))
+    transaction.on_commit(lambda: forget_principal(user_id))
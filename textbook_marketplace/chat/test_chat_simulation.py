@@ -9,17 +9,23 @@ Covers the complete chat lifecycle:
 - Edge cases: self-messaging, empty input, long messages, rapid fire
 - Blocking: bidirectional block prevents messaging
 - Reconnection: unseen messages delivered on reconnect
+- Ephemeral events: typing indicators relayed without the database
 """
 import asyncio
 
 import pytest
 from asgiref.sync import sync_to_async
+from channels.layers import channel_layers, get_channel_layer
 from channels.routing import URLRouter
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.backends.utils import CursorWrapper
+from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework_simplejwt.tokens import AccessToken
 
+from . import caching, consumers, presence
 from .routing import websocket_urlpatterns
 from .models import Message
 from marketplace.models import Block
@@ -32,6 +38,21 @@ User = get_user_model()
 # Fixtures
 # ---------------------------------------------------------------------------
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Cached recipients and blocks (chat.caching) must not leak between tests
+    cache.clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def fresh_channel_layer():
+    # The channel layer's receive state is bound to the event loop that
+    # first used it, and every test runs in a loop of its own
+    channel_layers.backends.clear()
+    yield
+
+
 @pytest.fixture(scope='module')
 def application():
     yield CustomJWTAuthMiddlewareStack(
@@ -240,10 +261,12 @@ async def test_rest_conversation_history(ws_url, application, alice, bob,
     # REST: Alice fetches conversation with Bob
     resp = await sync_to_async(alice_client.get)('/api/chat/conversation/bob/')
     assert resp.status_code == 200
-    data = resp.data
+    # newest first
+    data = resp.data['results']
     assert len(data) == 2
-    assert data[0]['text'] == 'Первое'
-    assert data[1]['text'] == 'Второе'
+    assert data[0]['text'] == 'Второе'
+    assert data[1]['text'] == 'Первое'
+    assert resp.data['next'] is None
 
 
 # ---------------------------------------------------------------------------
@@ -493,3 +516,342 @@ async def test_reconnect_unseen_only(ws_url, application, alice, bob, bob_client
     assert init_bob['new_messages'][0]['text'] == 'Второе'
 
     await comm_bob2.disconnect()
+
+
+# ---------------------------------------------------------------------------
+# 13. Handshake user cached, dropped when the user changes
+# ---------------------------------------------------------------------------
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+@pytest.mark.asyncio
+async def test_handshake_user_cached_until_deactivated(ws_url, application,
+                                                       alice):
+    """The handshake caches its user; deactivating it drops the entry, so
+    the next handshake is rejected."""
+    key = caching.PRINCIPAL_KEY.format(alice.pk)
+    comm, _ = await connect_user(application, ws_url, alice)
+    await comm.disconnect()
+    assert cache.get(key)['username'] == 'alice'
+
+    alice.is_active = False
+    await sync_to_async(alice.save)()
+    assert cache.get(key) is None
+
+    token = AccessToken.for_user(alice)
+    communicator = WebsocketCommunicator(application, f'{ws_url}?token={token}')
+    connected, code = await communicator.connect(timeout=5)
+    assert not connected or code == 4003
+
+
+@pytest.mark.django_db
+def test_renamed_user_old_username_forgotten(alice, bob,
+                                             django_capture_on_commit_callbacks):
+    """Renaming a user drops the cached id of the old username, so it
+    no longer reaches them."""
+    assert caching.user_id_for('alice') == alice.pk
+    assert caching.user_id_for('bob') == bob.pk
+    with django_capture_on_commit_callbacks(execute=True):
+        alice.username = 'alicia'
+        alice.save()
+    assert caching.user_id_for('alice') is None
+    assert caching.user_id_for('alicia') == alice.pk
+    with django_capture_on_commit_callbacks(execute=True):
+        bob.first_name = 'Bob'
+        bob.save()
+    assert cache.get(caching.USER_KEY.format('bob')) == bob.pk
+
+
+# ---------------------------------------------------------------------------
+# 14. Handshake user built from token claims
+# ---------------------------------------------------------------------------
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_handshake_user_from_token_claims(ws_url, application, alice,
+                                                bob, settings):
+    """With CHAT_WS_AUTH_FROM_CLAIMS a token carrying the username needs no
+    lookup; tokens without it are still looked up."""
+    settings.CHAT_WS_AUTH_FROM_CLAIMS = True
+    token = AccessToken.for_user(alice)
+    token['username'] = 'alice'
+    communicator = WebsocketCommunicator(application, f'{ws_url}?token={token}')
+    connected, _ = await communicator.connect(timeout=5)
+    assert connected
+    assert (await communicator.receive_json_from(timeout=5))['type'] == \
+        'notification'
+    await communicator.send_json_to({'message': 'Привет', 'recipient': 'bob'})
+    resp = await communicator.receive_json_from(timeout=5)
+    assert resp['sender'] == 'alice'
+    await communicator.disconnect()
+    assert cache.get(caching.PRINCIPAL_KEY.format(alice.pk)) is None
+
+    comm_bob, init = await connect_user(application, ws_url, bob)
+    assert init['new_messages'][0]['text'] == 'Привет'
+    await comm_bob.disconnect()
+    assert cache.get(caching.PRINCIPAL_KEY.format(bob.pk)) is not None
+
+
+# ---------------------------------------------------------------------------
+# 15. Presence across devices
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def no_presence():
+    """Connections left registered by earlier tests (same user ids) are
+    forgotten."""
+    client = presence.get_sync_client()
+    for key in client.scan_iter(presence.KEY.format('*')):
+        client.delete(key)
+    yield
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_presence_across_devices(ws_url, application, alice, bob,
+                                       bob_client, no_presence):
+    """Bob follows Alice: she is online while any of her devices is
+    connected, and only the first connect and last disconnect are
+    announced."""
+    comm_bob, _ = await connect_user(application, ws_url, bob)
+    await comm_bob.send_json_to({'type': 'presence',
+                                 'users': ['alice', 'nobody']})
+    assert await comm_bob.receive_json_from(timeout=5) == {
+        'type': 'presence', 'users': {'alice': False}
+    }
+
+    phone, _ = await connect_user(application, ws_url, alice)
+    assert await comm_bob.receive_json_from(timeout=5) == {
+        'type': 'presence', 'users': {'alice': True}
+    }
+    laptop, _ = await connect_user(application, ws_url, alice)
+    await phone.disconnect()
+    assert await comm_bob.receive_nothing(timeout=0.5)
+
+    url = reverse('presence') + '?users=alice,bob,nobody'
+    response = await sync_to_async(bob_client.get)(url)
+    assert response.status_code == 200
+    assert response.data == {'alice': True, 'bob': True}
+
+    await laptop.disconnect()
+    assert await comm_bob.receive_json_from(timeout=5) == {
+        'type': 'presence', 'users': {'alice': False}
+    }
+    response = await sync_to_async(bob_client.get)(url)
+    assert response.data == {'alice': False, 'bob': True}
+    await comm_bob.disconnect()
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_presence_hidden_across_blocks(ws_url, application, alice, bob,
+                                             charlie, bob_client,
+                                             no_presence):
+    """Bob can't see or follow the status of users blocked either way,
+    including one that blocks him while he follows them."""
+    await sync_to_async(Block.objects.create)(
+        initiator_user=alice, blocked_user=bob
+    )
+    comm_alice, _ = await connect_user(application, ws_url, alice)
+    comm_bob, _ = await connect_user(application, ws_url, bob)
+    await comm_bob.send_json_to({'type': 'presence',
+                                 'users': ['alice', 'charlie']})
+    assert await comm_bob.receive_json_from(timeout=5) == {
+        'type': 'presence', 'users': {'charlie': False}
+    }
+    url = reverse('presence') + '?users=alice,charlie'
+    response = await sync_to_async(bob_client.get)(url)
+    assert response.data == {'charlie': False}
+
+    await sync_to_async(Block.objects.create)(
+        initiator_user=charlie, blocked_user=bob
+    )
+    comm_charlie, _ = await connect_user(application, ws_url, charlie)
+    assert await comm_bob.receive_nothing(timeout=0.5)
+    response = await sync_to_async(bob_client.get)(url)
+    assert response.data == {}
+    for communicator in (comm_alice, comm_bob, comm_charlie):
+        await communicator.disconnect()
+
+
+@pytest.mark.django_db
+def test_presence_blocks_looked_up_at_once(alice, bob, charlie, bob_client,
+                                           no_presence,
+                                           django_assert_num_queries):
+    """The presence endpoint reads the blocks of all asked users with one
+    query, and from the cache the next time."""
+    Block.objects.create(initiator_user=alice, blocked_user=bob)
+    url = reverse('presence') + '?users=alice,charlie'
+    with django_assert_num_queries(2):
+        response = bob_client.get(url)
+    assert response.data == {'charlie': False}
+    with django_assert_num_queries(1):
+        response = bob_client.get(url)
+    assert response.data == {'charlie': False}
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_message_to_offline_user_skips_fan_out(ws_url, application,
+                                                     alice, bob, monkeypatch,
+                                                     no_presence):
+    """No group_send for a recipient without connections; the message still
+    arrives with the unseen ones on connect."""
+    groups = []
+    layer_class = type(get_channel_layer())
+    group_send = layer_class.group_send
+
+    async def recording_group_send(self, group, message):
+        groups.append(group)
+        await group_send(self, group, message)
+
+    monkeypatch.setattr(layer_class, 'group_send', recording_group_send)
+    comm_alice, _ = await connect_user(application, ws_url, alice)
+    await comm_alice.send_json_to({'message': 'Ты тут?', 'recipient': 'bob'})
+    resp = await comm_alice.receive_json_from(timeout=5)
+    assert resp['type'] == 'message'
+    assert 'personal_bob' not in groups
+
+    comm_bob, init = await connect_user(application, ws_url, bob)
+    assert [m['text'] for m in init['new_messages']] == ['Ты тут?']
+    await comm_bob.disconnect()
+    await comm_alice.disconnect()
+
+
+# ---------------------------------------------------------------------------
+# 16. Typing indicators and other ephemeral events
+# ---------------------------------------------------------------------------
+
+class Clock:
+    """time.monotonic() for chat.consumers, moved on by the test."""
+    now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(consumers, 'time', clock)
+    yield clock
+
+
+async def receive_all(communicator, timeout=0.3):
+    """Frames received until none arrives for `timeout` seconds."""
+    frames = []
+    while not await communicator.receive_nothing(timeout=timeout):
+        frames.append(await communicator.receive_json_from())
+    return frames
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_typing_indicators_coalesced(ws_url, application, alice, bob,
+                                           charlie, settings, clock,
+                                           no_presence):
+    """Repeated typing frames reach Bob once per interval, stopped_typing
+    or not; stopped_typing only follows a relayed typing and a message ends
+    it. Typing to a user nobody looked up lately is dropped rather than
+    queried."""
+    settings.CHAT_EPHEMERAL_INTERVAL_MS = 3000
+    comm_alice, _ = await connect_user(application, ws_url, alice)
+    comm_bob, _ = await connect_user(application, ws_url, bob)
+    comm_charlie, _ = await connect_user(application, ws_url, charlie)
+    await comm_alice.send_json_to({'message': 'Привет', 'recipient': 'bob'})
+    await comm_alice.receive_json_from(timeout=5)
+    await comm_bob.receive_json_from(timeout=5)
+
+    for _ in range(5):
+        await comm_alice.send_json_to({'type': 'typing', 'user': 'bob'})
+    for _ in range(2):
+        await comm_alice.send_json_to({'type': 'stopped_typing',
+                                       'user': 'bob'})
+    await comm_alice.send_json_to({'type': 'typing', 'user': 'charlie'})
+    assert await receive_all(comm_bob) == [
+        {'type': 'typing', 'user': 'alice'},
+        {'type': 'stopped_typing', 'user': 'alice'},
+    ]
+    assert await comm_charlie.receive_nothing(timeout=0.3)
+
+    # within the interval of the last typing relayed
+    await comm_alice.send_json_to({'type': 'typing', 'user': 'bob'})
+    assert await comm_bob.receive_nothing(timeout=0.3)
+
+    clock.now += 3
+    await comm_alice.send_json_to({'type': 'typing', 'user': 'bob'})
+    await comm_alice.send_json_to({'message': 'Как дела?', 'recipient': 'bob'})
+    await comm_alice.receive_json_from(timeout=5)
+    await comm_alice.send_json_to({'type': 'stopped_typing', 'user': 'bob'})
+    assert [frame['type'] for frame in await receive_all(comm_bob)] == \
+        ['typing', 'message']
+    assert await Message.objects.acount() == 2
+
+    await comm_alice.send_json_to({'type': 'typing', 'user': 'bob'})
+    assert (await comm_bob.receive_json_from(timeout=5))['type'] == 'typing'
+    await comm_alice.disconnect()
+    assert await comm_bob.receive_json_from(timeout=5) == {
+        'type': 'stopped_typing', 'user': 'alice'
+    }
+    await comm_bob.disconnect()
+    await comm_charlie.disconnect()
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_ephemeral_flood_rate_limited(ws_url, application, alice, bob,
+                                            charlie, settings, monkeypatch,
+                                            clock, no_presence):
+    """Charlie floods Bob with typing and stopped_typing frames: no query
+    runs, alternating frames don't get around the per-user interval, and
+    Bob gets what the token bucket allows. benchmark_ephemeral_events
+    measures what the flood costs Alice's messages."""
+    settings.CHAT_EPHEMERAL_INTERVAL_MS = 100
+    settings.CHAT_EPHEMERAL_BURST = 20
+    settings.CHAT_EPHEMERAL_RATE = 4
+    comm_alice, _ = await connect_user(application, ws_url, alice)
+    comm_bob, _ = await connect_user(application, ws_url, bob)
+    comm_charlie, _ = await connect_user(application, ws_url, charlie)
+    await comm_charlie.send_json_to({'message': 'hi', 'recipient': 'bob'})
+    await comm_charlie.receive_json_from(timeout=5)
+    await comm_bob.receive_json_from(timeout=5)
+
+    queries = []
+    execute = CursorWrapper.execute
+
+    def counting_execute(self, sql, params=None):
+        queries.append(sql)
+        return execute(self, sql, params)
+
+    monkeypatch.setattr(CursorWrapper, 'execute', counting_execute)
+
+    async def flood(pairs):
+        for _ in range(pairs):
+            await comm_charlie.send_json_to({'type': 'typing', 'user': 'bob'})
+            await comm_charlie.send_json_to({'type': 'stopped_typing',
+                                             'user': 'bob'})
+        # answered once the frames before it are handled
+        await comm_charlie.send_json_to({'type': 'presence', 'users': []})
+        await comm_charlie.receive_json_from(timeout=5)
+
+    await flood(50)
+    assert await receive_all(comm_bob) == [
+        {'type': 'typing', 'user': 'charlie'},
+        {'type': 'stopped_typing', 'user': 'charlie'},
+    ]
+    # a pair every 125 ms for 12.5 s: the bucket's 19 tokens left and
+    # 4 a second, each 'typing' relayed with its 'stopped_typing'
+    for _ in range(100):
+        clock.now += 0.125
+        await flood(1)
+    relayed = await receive_all(comm_bob)
+    assert [frame['type'] for frame in relayed] == \
+        ['typing', 'stopped_typing'] * 69
+    assert queries == []
+
+    monkeypatch.setattr(CursorWrapper, 'execute', execute)
+    await comm_alice.send_json_to({'message': 'still here',
+                                   'recipient': 'bob'})
+    assert (await comm_bob.receive_json_from(timeout=5))['message'] == \
+        'still here'
+    for communicator in (comm_alice, comm_bob, comm_charlie):
+        await communicator.disconnect()
@@ -1,16 +1,30 @@
 import asyncio
+import importlib
+import threading
 import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
 
+import msgpack
 import pytest
 from asgiref.sync import async_to_sync, sync_to_async
+from autobahn.websocket.compress import (PerMessageDeflate,
+                                         PerMessageDeflateOffer)
+from daphne.ws_protocol import WebSocketFactory
 
+from channels.db import database_sync_to_async
 from channels.routing import URLRouter
 from channels.testing import WebsocketCommunicator
-from channels.layers import get_channel_layer
+from channels.layers import channel_layers, get_channel_layer
 
+from django.apps import apps
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connection, connections, transaction
 from django.urls import reverse
+from django.utils import timezone
 from django_channels_jwt_auth_middleware.auth import JWTAuthMiddlewareStack
 
 from rest_framework.response import Response
@@ -18,10 +32,14 @@ from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework.test import force_authenticate, APIRequestFactory, \
     APIClient
 
+from . import caching
+from .journal import Journal, close_journal, reserve_ids, store
 from .routing import websocket_urlpatterns
-from .models import Message
+from .inbox import mark_seen, record_message
+from .models import Conversation, Message
 from .views import MessageView
 from marketplace.models import Block
+from textbook_marketplace.websocket_server import DeflateServer, accept_deflate
 
 # TODO rewrite tests from api request factory to api client
 User = get_user_model()
@@ -46,6 +64,21 @@ async def test_call_group_send_twice_success(channel_layer):
                                    {'message': 'message'})
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Cached recipients and blocks (chat.caching) must not leak between tests
+    cache.clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def fresh_channel_layer():
+    # The channel layer's receive state is bound to the event loop that
+    # first used it, and every test runs in a loop of its own
+    channel_layers.backends.clear()
+    yield
+
+
 @pytest.fixture
 def ws_url() -> str:
     return 'ws/chat/'
@@ -245,6 +278,9 @@ async def test_websocket_with_token_get_new_message_success(
     )
     connected, subprotocol = await communicator_1.connect()
     assert connected
+    response_1_init = await communicator_1.receive_json_from(timeout=5)
+    assert response_1_init['type'] == 'notification'
+    assert len(response_1_init['new_messages']) == 0
 
     token_2 = AccessToken.for_user(second_user)
     communicator_2 = WebsocketCommunicator(
@@ -252,21 +288,19 @@ async def test_websocket_with_token_get_new_message_success(
     )
     connected, subprotocol = await communicator_2.connect()
     assert connected
+    # sent once user2 is online, so the message is fanned out to them
+    response_2_init = await communicator_2.receive_json_from(timeout=5)
+    assert response_2_init['type'] == 'notification'
+    assert len(response_2_init['new_messages']) == 0
 
     await communicator_1.send_json_to(
         data={'message': 'hi, user2',
               'sender': first_user.username,
               'recipient': second_user.username})
 
-    response_1_init = await communicator_1.receive_json_from(timeout=5)
-    assert response_1_init['type'] == 'notification'
-    assert len(response_1_init['new_messages']) == 0
     response_1 = await communicator_1.receive_json_from(timeout=5)
     assert response_1['message'] == 'hi, user2'
 
-    response_2_init = await communicator_2.receive_json_from(timeout=5)
-    assert response_2_init['type'] == 'notification'
-    assert len(response_2_init['new_messages']) == 0
     response_2 = await communicator_2.receive_json_from(timeout=5)
     assert response_2['type'] == 'message'
     assert response_2['message'] == 'hi, user2'
@@ -301,6 +335,43 @@ async def test_websocket_with_token_send_message_bad_recipient_failure(
     await communicator_1.disconnect()
 
 
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_websocket_malformed_frames_answered_with_error(
+        ws_url: str,
+        application: JWTAuthMiddlewareStack,
+        first_user: User,
+        second_user: User,
+):
+    communicator = WebsocketCommunicator(
+        application, f'{ws_url}?token={AccessToken.for_user(first_user)}'
+    )
+    connected, _ = await communicator.connect()
+    assert connected
+    await communicator.receive_json_from(timeout=5)  # init message
+
+    for frame in ({'type': 'seen', 'up_to': 1},
+                  {'type': 'ack', 'user': second_user.username,
+                   'up_to': 'latest'},
+                  {'type': 'presence'},
+                  {'type': 'typing', 'user': ['someone']},
+                  {'message': 'hello!'},
+                  ['not', 'an', 'object']):
+        await communicator.send_json_to(frame)
+        response = await communicator.receive_json_from(timeout=5)
+        assert response['type'] == 'error'
+    await communicator.send_to(text_data='{')
+    assert (await communicator.receive_json_from(timeout=5))['type'] == \
+        'error'
+
+    # the connection is still usable
+    await communicator.send_json_to({'message': 'hello!',
+                                     'recipient': second_user.username})
+    response = await communicator.receive_json_from(timeout=5)
+    assert response['type'] == 'message'
+    await communicator.disconnect()
+
+
 @pytest.mark.django_db(reset_sequences=True)
 @pytest.mark.asyncio
 async def test_websocket_with_token_send_message_to_blocked_user_failure(
@@ -342,3 +413,802 @@ async def test_websocket_with_token_send_message_to_blocked_user_failure(
 
     await communicator_1.disconnect()
     await communicator_2.disconnect()
+
+
+@pytest.fixture
+def history(first_user: User,
+            second_user: User,
+            third_user: User,
+            monkeypatch) -> list[Message]:
+    """ Ten messages of first_user, oldest first, one minute apart, plus
+    one between the other two users. """
+    monkeypatch.setattr(Message._meta.get_field('sent_at'),
+                        'auto_now_add', False)
+    start = timezone.now() - timedelta(days=1)
+    partners = [second_user, third_user]
+    messages = []
+    for index in range(10):
+        partner = partners[index % 2]
+        sender, recipient = ((first_user, partner) if index % 3
+                             else (partner, first_user))
+        messages.append(Message.objects.create(
+            text=f'message {index}', sender=sender, recipient=recipient,
+            sent_at=start + timedelta(minutes=index)
+        ))
+    Message.objects.create(text='not for user1', sender=second_user,
+                           recipient=third_user, sent_at=start)
+    yield messages
+
+
+@pytest.mark.django_db
+def test_message_history_paginated_newest_first(history: list[Message],
+                                                first_user: User,
+                                                client: APIClient):
+    client.force_authenticate(first_user)
+    url, texts = f"{reverse('chat')}?limit=4", []
+    while url:
+        response: Response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.data['results']) <= 4
+        texts += [message['text'] for message in response.data['results']]
+        url = response.data['next']
+    assert texts == [message.text for message in reversed(history)]
+
+
+@pytest.mark.django_db
+def test_message_history_since_id(history: list[Message],
+                                  first_user: User,
+                                  client: APIClient):
+    client.force_authenticate(first_user)
+    response: Response = client.get(
+        reverse('chat'), data={'since_id': history[5].pk, 'limit': 3}
+    )
+    assert [message['id'] for message in response.data['results']] == [
+        message.pk for message in history[6:9]
+    ]
+    response = client.get(response.data['next'])
+    assert [message['id'] for message in response.data['results']] == [
+        history[9].pk
+    ]
+    assert response.data['next'] is None
+
+    response = client.get(reverse('chat'),
+                          data={'since_id': history[-1].pk})
+    assert response.data == {'next': None, 'results': []}
+
+
+@pytest.mark.django_db
+def test_message_history_invalid_position(history: list[Message],
+                                          first_user: User,
+                                          client: APIClient):
+    client.force_authenticate(first_user)
+    other = Message.objects.get(text='not for user1')
+    for params in ({'cursor': 'not-a-cursor'}, {'since_id': 'x'},
+                   {'since_id': other.pk}):
+        response: Response = client.get(reverse('chat'), data=params)
+        assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_conversation_paginated(history: list[Message],
+                                first_user: User,
+                                second_user: User,
+                                client: APIClient):
+    client.force_authenticate(first_user)
+    url = reverse('conversation', args=[second_user.username])
+    response: Response = client.get(url, data={'limit': 2})
+    expected = [message.text for message in reversed(history)
+                if second_user.pk in (message.sender.pk, message.recipient.pk)]
+    assert [message['text'] for message in response.data['results']] == \
+        expected[:2]
+    response = client.get(response.data['next'])
+    assert [message['text'] for message in response.data['results']] == \
+        expected[2:4]
+
+
+@pytest.mark.django_db
+def test_message_history_latency_at_100k_messages(first_user: User,
+                                                  second_user: User,
+                                                  third_user: User,
+                                                  client: APIClient,
+                                                  monkeypatch):
+    """ Pages of a user with 100k messages stay fast at any depth. """
+    monkeypatch.setattr(Message._meta.get_field('sent_at'),
+                        'auto_now_add', False)
+    start = timezone.now() - timedelta(days=200)
+    partners = [second_user, third_user]
+    Message.objects.bulk_create(
+        Message(text='x' * 40,
+                sender=first_user if index % 2 else partners[index % 4 // 2],
+                recipient=partners[index % 4 // 2] if index % 2 else first_user,
+                sent_at=start + timedelta(seconds=index * 60))
+        for index in range(100_000)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'ANALYZE' if connection.vendor == 'sqlite' else
+            f'ANALYZE {Message._meta.db_table}'
+        )
+    client.force_authenticate(first_user)
+
+    def p95(url, **params):
+        timings = []
+        for _ in range(20):
+            started = time.perf_counter()
+            response: Response = client.get(url, data=params)
+            timings.append(time.perf_counter() - started)
+            assert response.status_code == 200
+            assert len(response.data['results']) == 50
+        return sorted(timings)[18]
+
+    history = reverse('chat')
+    deep = client.get(history, data={'since_id': Message.objects.filter(
+        sender=first_user).order_by('sent_at')[1000].pk}).data['next']
+    cursor = client.get(history).data['next']
+    since_id = Message.objects.order_by('id').values_list('pk', flat=True)[500]
+    timings = {
+        'newest page': p95(history),
+        'second page': p95(cursor),
+        'since_id': p95(history, since_id=since_id),
+        'deep since_id': p95(deep),
+        'conversation': p95(reverse('conversation',
+                                    args=[second_user.username])),
+    }
+    slow = {name: f'{timing * 1000:.1f} ms'
+            for name, timing in timings.items() if timing > 0.05}
+    assert not slow, slow
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_websocket_message_updates_inbox(
+        ws_url: str,
+        application: JWTAuthMiddlewareStack,
+        first_user: User,
+        second_user: User
+):
+    token = AccessToken.for_user(first_user)
+    communicator = WebsocketCommunicator(application, f'{ws_url}?token={token}')
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    await communicator.receive_json_from(timeout=5)
+    for text in ('first', 'second'):
+        await communicator.send_json_to(
+            data={'message': text, 'recipient': second_user.username}
+        )
+        await communicator.receive_json_from(timeout=5)
+    await communicator.disconnect()
+
+    conversation = await sync_to_async(Conversation.objects.get)()
+    assert (conversation.user1_id, conversation.user2_id) == \
+        (first_user.pk, second_user.pk)
+    assert conversation.last_message_text == 'second'
+    assert conversation.last_sender_id == first_user.pk
+    assert (conversation.user1_unread, conversation.user2_unread) == (0, 2)
+
+
+@pytest.fixture
+def inbox(history: list[Message]) -> list[Message]:
+    """ history recorded in Conversation rows, as ChatConsumer does. """
+    for message in Message.objects.order_by('sent_at', 'id'):
+        record_message(message)
+    yield history
+
+
+@pytest.mark.django_db
+def test_inbox_most_recent_first(inbox: list[Message],
+                                 first_user: User,
+                                 second_user: User,
+                                 third_user: User,
+                                 client: APIClient):
+    client.force_authenticate(first_user)
+    response: Response = client.get(reverse('inbox'), data={'limit': 1})
+    assert response.status_code == 200
+    # history[9] was sent by third_user, history[8] to second_user
+    assert response.data['results'] == [{
+        'id': response.data['results'][0]['id'],
+        'user': third_user.username,
+        'last_message_id': inbox[9].pk,
+        'last_message_text': 'message 9',
+        'last_message_at': response.data['results'][0]['last_message_at'],
+        'last_sender': third_user.username,
+        'unread': 2,
+    }]
+    response = client.get(response.data['next'])
+    assert [(entry['user'], entry['last_message_text'], entry['unread'])
+            for entry in response.data['results']] == \
+        [(second_user.username, 'message 8', 2)]
+    assert response.data['next'] is None
+
+
+@pytest.mark.django_db
+def test_mark_as_seen_updates_unread(inbox: list[Message],
+                                     first_user: User,
+                                     second_user: User,
+                                     third_user: User,
+                                     client: APIClient):
+    client.force_authenticate(first_user)
+    received = [message.pk for message in inbox
+                if message.recipient == first_user
+                and message.sender == second_user]
+    response: Response = client.post(reverse('read-messages'),
+                                     {'ids_to_mark': received}, format='json')
+    assert response.status_code == 200
+    response = client.post(reverse('read-messages'),
+                           {'ids_to_mark': received}, format='json')
+    assert response.status_code == 200
+    unread = {entry['user']: entry['unread']
+              for entry in client.get(reverse('inbox')).data['results']}
+    assert unread == {second_user.username: 0, third_user.username: 2}
+
+    client.force_authenticate(second_user)
+    unread = {entry['user']: entry['unread']
+              for entry in client.get(reverse('inbox')).data['results']}
+    assert unread == {first_user.username: 3, third_user.username: 0}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_mark_seen_counts_once(first_user: User,
+                                          second_user: User):
+    """ Two transactions marking the same messages take them off the
+    unread counter once. """
+    if connection.vendor != 'postgresql':
+        pytest.skip('Row locks require PostgreSQL.')
+    messages = []
+    for i in range(5):
+        message = Message.objects.create(sender=first_user,
+                                         recipient=second_user,
+                                         text=f'message {i}')
+        record_message(message)
+        messages.append(message)
+    marking = Message.objects.filter(pk__in=[messages[0].pk, messages[1].pk])
+    marked, results = threading.Event(), {}
+
+    def mark(name, hold):
+        try:
+            with transaction.atomic():
+                results[name] = mark_seen(second_user, marking)
+                if hold:
+                    marked.set()
+                    # the other transaction runs into the row locks
+                    time.sleep(0.5)
+        finally:
+            connections.close_all()
+
+    first = threading.Thread(target=mark, args=('first', True))
+    first.start()
+    marked.wait(timeout=5)
+    second = threading.Thread(target=mark, args=('second', False))
+    second.start()
+    first.join()
+    second.join()
+
+    assert results == {'first': {first_user.pk: 2}, 'second': {}}
+    conversation = Conversation.objects.get()
+    assert conversation.user2_unread == 3
+
+
+class UserIdsAsUsernames:
+    """ The models of the app registry for 0005_conversation's backfill,
+    which ran while Message.sender / recipient held usernames: the users'
+    username -> id mapping it reads maps ids to themselves instead. """
+
+    def get_model(self, app_label, model_name):
+        model = apps.get_model(app_label, model_name)
+        if model is not User:
+            return model
+        return SimpleNamespace(objects=SimpleNamespace(
+            values_list=lambda *fields: User.objects.values_list('pk', 'pk')
+        ))
+
+
+@pytest.mark.django_db
+def test_conversation_backfill_matches_record_message(inbox: list[Message]):
+    recorded = list(Conversation.objects.order_by('user1', 'user2').values())
+    Conversation.objects.all().delete()
+    migration = importlib.import_module('chat.migrations.0005_conversation')
+    migration.backfill_conversations(UserIdsAsUsernames(), None)
+    backfilled = list(Conversation.objects.order_by('user1', 'user2').values())
+    for row in recorded + backfilled:
+        del row['id']
+    assert backfilled == recorded
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_unseen_messages_sent_in_bounded_chunks(
+        ws_url: str,
+        application: JWTAuthMiddlewareStack,
+        first_user: User,
+        second_user: User,
+        third_user: User,
+        settings
+):
+    settings.CHAT_UNSEEN_CHUNK_SIZE = 2
+    settings.CHAT_UNSEEN_MAX_MESSAGES = 3
+
+    @sync_to_async
+    def send(sender, text):
+        message = Message.objects.create(text=text, sender=sender,
+                                         recipient=first_user)
+        record_message(message)
+        return message
+
+    sent = [await send(second_user, 'from user2 #1'),
+            await send(third_user, 'from user3'),
+            await send(second_user, 'from user2 #2'),
+            await send(second_user, 'from user2 #3')]
+
+    token = AccessToken.for_user(first_user)
+    communicator = WebsocketCommunicator(application, f'{ws_url}?token={token}')
+    connected, subprotocol = await communicator.connect()
+    assert connected
+
+    first = await communicator.receive_json_from(timeout=5)
+    assert first['type'] == 'notification'
+    assert [(entry['user'], entry['unread'])
+            for entry in first['conversations']] == \
+        [(second_user.username, 3), (third_user.username, 1)]
+    assert [message['id'] for message in first['new_messages']] == \
+        [message.pk for message in sent[:2]]
+    assert first['has_more']
+
+    second = await communicator.receive_json_from(timeout=5)
+    assert 'conversations' not in second
+    assert [message['id'] for message in second['new_messages']] == \
+        [sent[2].pk]
+    # the rest is left for /api/chat/?since_id=
+    assert second['has_more']
+    assert await communicator.receive_nothing()
+    await communicator.disconnect()
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_blocks_reach_cached_recipients(
+        ws_url: str,
+        application: JWTAuthMiddlewareStack,
+        first_user: User,
+        second_user: User,
+        client: APIClient,
+        monkeypatch
+):
+    """ A conversation in progress looks its recipient up once; blocking
+    and unblocking through the API still apply to the next message. """
+    lookups = []
+    user_id_for = caching.user_id_for
+
+    def counting_user_id_for(username):
+        lookups.append(username)
+        return user_id_for(username)
+
+    monkeypatch.setattr(caching, 'user_id_for', counting_user_id_for)
+    token = AccessToken.for_user(first_user)
+    communicator = WebsocketCommunicator(application, f'{ws_url}?token={token}')
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    await communicator.receive_json_from(timeout=5)
+
+    async def send():
+        await communicator.send_json_to(
+            data={'message': 'hi', 'recipient': second_user.username}
+        )
+        return (await communicator.receive_json_from(timeout=5))['type']
+
+    block_url = reverse('user-block', args=[first_user.username])
+    client.force_authenticate(second_user)
+    assert await send() == 'message'
+    assert await send() == 'message'
+    response = await sync_to_async(client.post)(block_url)
+    assert response.status_code == 201
+    assert await send() == 'error'
+    response = await sync_to_async(client.delete)(block_url)
+    assert response.status_code == 204
+    assert await send() == 'message'
+    assert lookups == [second_user.username]
+    await communicator.disconnect()
+
+
+@pytest.fixture
+def journal_settings(settings):
+    """ Write-behind on, with a journal stream of this test's own. """
+    settings.CHAT_WRITE_BEHIND = True
+    settings.CHAT_JOURNAL_STREAM = f'chat:journal:test:{uuid.uuid4().hex}'
+    yield settings
+
+    async def delete_stream():
+        journal = Journal.from_settings()
+        await journal.redis.delete(journal.stream, journal.dead_letters)
+        async for key in journal.redis.scan_iter(journal.index_key('*')):
+            await journal.redis.delete(key)
+        await journal.stop()
+
+    async_to_sync(delete_stream)()
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_write_behind_message_stored_after_fan_out(
+        ws_url: str,
+        application: JWTAuthMiddlewareStack,
+        first_user: User,
+        second_user: User,
+        journal_settings
+):
+    token = AccessToken.for_user(first_user)
+    communicator = WebsocketCommunicator(application, f'{ws_url}?token={token}')
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    await communicator.receive_json_from(timeout=5)
+
+    await communicator.send_json_to(
+        data={'message': 'hi', 'recipient': second_user.username}
+    )
+    response = await communicator.receive_json_from(timeout=5)
+    assert response['type'] == 'message'
+    await communicator.disconnect()
+    await close_journal()
+
+    journal = Journal.from_settings()
+    await journal.drain()
+    await journal.stop()
+
+    message = await Message.objects.aget()
+    assert (message.sender_id, message.recipient_id, message.text) == (
+        first_user.pk, second_user.pk, 'hi'
+    )
+    conversation = await Conversation.objects.aget()
+    assert conversation.last_message_id == message.pk
+    assert conversation.user2_unread == 1
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_write_behind_unflushed_message_sent_on_connect(
+        ws_url: str,
+        application: JWTAuthMiddlewareStack,
+        first_user: User,
+        second_user: User,
+        journal_settings,
+        monkeypatch
+):
+    """ A recipient connecting after the sender skipped the fan-out, but
+    before the flush, gets the message from the journal. """
+    async def stalled(journal):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(Journal, 'run', stalled)
+    stored = await Message.objects.acreate(sender=first_user,
+                                           recipient=second_user,
+                                           text='stored')
+    journal = Journal.from_settings()
+    journaled = await journal.append(first_user.pk, second_user.pk,
+                                     'journaled')
+    await journal.stop()
+
+    token = AccessToken.for_user(second_user)
+    communicator = WebsocketCommunicator(application, f'{ws_url}?token={token}')
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    init = await communicator.receive_json_from(timeout=5)
+    assert [(message['id'], message['text'], message['sender'])
+            for message in init['new_messages']] == [
+        (stored.pk, 'stored', first_user.username),
+        (journaled['id'], 'journaled', first_user.username),
+    ]
+    assert init['has_more'] is False
+    assert await communicator.receive_nothing(timeout=0.3)
+    await communicator.disconnect()
+    await close_journal()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_journal_recovers_messages_of_crashed_flusher(
+        first_user: User,
+        second_user: User,
+        journal_settings
+):
+    """ Entries read by a flusher that died before acknowledging them,
+    some of them stored already, are stored exactly once by another. """
+    crashed = Journal.from_settings(consumer='crashed')
+    await crashed.append(first_user.pk, second_user.pk, 'one')
+    await crashed.append(first_user.pk, second_user.pk, 'two')
+    last = await crashed.append(second_user.pk, first_user.pk, 'three')
+    entries = await crashed.read(10)
+    assert len(entries) == 3
+    # committed, but gone before XACK
+    await database_sync_to_async(store)([message
+                                         for _, message in entries[:2]])
+    await crashed.stop()
+
+    survivor = Journal.from_settings(consumer='survivor')
+    assert len(await survivor.unflushed(second_user.pk)) == 2
+    assert await survivor.drain() == 3
+    assert await survivor.drain() == 0
+    assert await survivor.redis.xlen(survivor.stream) == 0
+    assert await survivor.unflushed(second_user.pk) == []
+    assert await survivor.unflushed(first_user.pk) == []
+    await survivor.stop()
+
+    texts = [text async for text in
+             Message.objects.order_by('pk').values_list('text', flat=True)]
+    assert texts == ['one', 'two', 'three']
+    conversation = await Conversation.objects.aget()
+    assert conversation.last_message_id == last['id']
+    assert (conversation.user1_unread, conversation.user2_unread) == (1, 2)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_journal_moves_unstorable_message_aside(
+        first_user: User,
+        second_user: User,
+        journal_settings
+):
+    """ A message to a user deleted before the flush doesn't keep the
+    messages read with it, or after it, from being stored. """
+    gone = await User.objects.acreate(username='gone', is_seller=False)
+    journal = Journal.from_settings()
+    await journal.append(first_user.pk, second_user.pk, 'one')
+    lost = await journal.append(first_user.pk, gone.pk, 'lost')
+    await journal.append(second_user.pk, first_user.pk, 'two')
+    await gone.adelete()
+
+    assert await journal.drain() == 3
+    await journal.append(first_user.pk, second_user.pk, 'three')
+    assert await journal.drain() == 1
+    assert await journal.redis.xlen(journal.stream) == 0
+    dead = await journal.redis.xrange(journal.dead_letters)
+    assert [Journal.decode(fields) for _, fields in dead] == [lost]
+    await journal.stop()
+
+    texts = [text async for text in
+             Message.objects.order_by('pk').values_list('text', flat=True)]
+    assert texts == ['one', 'two', 'three']
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_journal_applies_receipt_once_message_stored(
+        first_user: User,
+        second_user: User,
+        journal_settings
+):
+    """ A 'seen' receipt for a message still pending with a crashed
+    flusher waits for it, and reaches the sender only once the message is
+    marked seen. """
+    channel_layer = get_channel_layer()
+    channel = await channel_layer.new_channel()
+    await channel_layer.group_add(f'personal_{first_user.username}', channel)
+
+    crashed = Journal.from_settings(consumer='crashed')
+    message = await crashed.append(first_user.pk, second_user.pk, 'one')
+    assert len(await crashed.read(10)) == 1
+    await crashed.stop()
+    receipt = {first_user.pk: (message['id'], first_user.username)}
+    survivor = Journal.from_settings(consumer='survivor')
+    await survivor.append_receipts(second_user.pk, second_user.username,
+                                   receipt)
+
+    # the message isn't claimed yet: the receipt is journaled again
+    assert await survivor.flush(10, claim_idle_ms=60000) == 1
+    assert not await Message.objects.filter(seen=True).aexists()
+    assert await survivor.redis.xlen(survivor.stream) == 2
+
+    assert await survivor.drain() == 2
+    stored = await Message.objects.aget()
+    assert stored.seen
+    assert await asyncio.wait_for(channel_layer.receive(channel), 5) == {
+        'type': 'receipt', 'kind': 'seen',
+        'user': second_user.username, 'up_to': message['id'],
+    }
+
+    # a receipt for messages seen already is not sent again
+    await survivor.append_receipts(second_user.pk, second_user.username,
+                                   receipt)
+    assert await survivor.drain() == 1
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(channel_layer.receive(channel), 0.3)
+    await channel_layer.group_discard(f'personal_{first_user.username}',
+                                      channel)
+    await survivor.stop()
+
+
+@pytest.mark.django_db
+def test_reserved_message_ids_not_reused(first_user: User,
+                                         second_user: User):
+    reserved = reserve_ids(5)
+    message = Message.objects.create(sender=first_user,
+                                     recipient=second_user,
+                                     text='hi')
+    assert len(set(reserved)) == 5
+    assert message.pk > max(reserved)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_journaled_message_ids_follow_send_order(
+        first_user: User,
+        second_user: User,
+        journal_settings
+):
+    """ Messages journaled by different server processes, in turn, get
+    increasing ids, so 'seen up to' receipts cover just the earlier ones. """
+    processes = [Journal.from_settings(consumer=name)
+                 for name in ('first', 'second')]
+    ids = [(await journal.append(first_user.pk, second_user.pk, 'hi'))['id']
+           for _ in range(2) for journal in processes]
+    assert ids == sorted(ids)
+    for journal in processes:
+        await journal.stop()
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_msgpack_subprotocol(
+        ws_url: str,
+        application: JWTAuthMiddlewareStack,
+        first_user: User,
+        second_user: User
+):
+    """ Compact clients get MessagePack arrays and a 'sent' frame instead
+    of their message echoed; JSON clients still get objects. """
+    communicator_1 = WebsocketCommunicator(
+        application, f'{ws_url}?token={AccessToken.for_user(first_user)}',
+        subprotocols=['sbook.unknown.v1', 'sbook.msgpack.v1']
+    )
+    connected, subprotocol = await communicator_1.connect()
+    assert connected
+    assert subprotocol == 'sbook.msgpack.v1'
+    init = msgpack.unpackb(await communicator_1.receive_from(timeout=5))
+    assert init == [2, [], False, []]
+
+    communicator_2 = WebsocketCommunicator(
+        application, f'{ws_url}?token={AccessToken.for_user(second_user)}'
+    )
+    connected, subprotocol = await communicator_2.connect()
+    assert connected
+    assert subprotocol is None
+    await communicator_2.receive_json_from(timeout=5)
+
+    await communicator_1.send_to(bytes_data=msgpack.packb(
+        [0, 'hi', second_user.username, None, 7]
+    ))
+    sent = msgpack.unpackb(await communicator_1.receive_from(timeout=5))
+    assert sent[:2] == [1, 7]
+    assert await communicator_2.receive_json_from(timeout=5) == {
+        'type': 'message',
+        'message': 'hi',
+        'sender': first_user.username,
+        'recipient': second_user.username,
+        'id': sent[2],
+    }
+
+    await communicator_2.send_json_to({'message': 'hello',
+                                       'recipient': first_user.username})
+    echo = await communicator_2.receive_json_from(timeout=5)
+    assert msgpack.unpackb(await communicator_1.receive_from(timeout=5)) == \
+        [0, 'hello', None, second_user.username, None, echo['id']]
+    await communicator_1.disconnect()
+    await communicator_2.disconnect()
+
+
+def test_websocket_server_accepts_deflate():
+    """ Production workers accept permessage-deflate in small windows. """
+    server = DeflateServer(application=None, endpoints=['tcp:port=0'])
+    server.ws_factory = WebSocketFactory(server, server='daphne')
+    assert server.ws_factory.perMessageCompressionAccept is accept_deflate
+    assert accept_deflate([]) is None
+    accepted = accept_deflate([PerMessageDeflateOffer()])
+    assert accepted.get_extension_string() == \
+        'permessage-deflate; client_max_window_bits=11'
+    deflate = PerMessageDeflate.create_from_offer_accept(True, accepted)
+    assert (deflate.server_max_window_bits, deflate.mem_level) == (11, 4)
+    # a client asking for a smaller window still gets it
+    accepted = accept_deflate([PerMessageDeflateOffer(
+        accept_max_window_bits=False, request_max_window_bits=9
+    )])
+    assert accepted.get_extension_string() == \
+        'permessage-deflate; server_max_window_bits=9'
+
+
+@pytest.mark.django_db(reset_sequences=True)
+@pytest.mark.asyncio
+async def test_receipts_coalesced_per_conversation(
+        ws_url: str,
+        application: JWTAuthMiddlewareStack,
+        first_user: User,
+        second_user: User,
+        settings
+):
+    """ Receipts for each message shown reach the sender as one 'seen'
+    and one 'delivered' receipt, and mark the messages seen. """
+    settings.CHAT_RECEIPT_FLUSH_MS = 100
+    communicator_1 = WebsocketCommunicator(
+        application, f'{ws_url}?token={AccessToken.for_user(first_user)}'
+    )
+    communicator_2 = WebsocketCommunicator(
+        application, f'{ws_url}?token={AccessToken.for_user(second_user)}'
+    )
+    for communicator in (communicator_1, communicator_2):
+        connected, _ = await communicator.connect()
+        assert connected
+        await communicator.receive_json_from(timeout=5)
+
+    ids = []
+    for text in ('one', 'two', 'three'):
+        await communicator_1.send_json_to({'message': text,
+                                           'recipient': second_user.username})
+        await communicator_1.receive_json_from(timeout=5)
+        ids.append((await communicator_2.receive_json_from(timeout=5))['id'])
+    for message_id in ids:
+        await communicator_2.send_json_to({'type': 'ack',
+                                           'user': first_user.username,
+                                           'up_to': message_id})
+    for message_id in ids[:2]:
+        await communicator_2.send_json_to({'type': 'seen',
+                                           'user': first_user.username,
+                                           'up_to': message_id})
+
+    receipts = [await communicator_1.receive_json_from(timeout=5)
+                for _ in range(2)]
+    assert sorted(receipts, key=lambda receipt: receipt['kind']) == [
+        {'type': 'receipt', 'kind': 'delivered',
+         'user': second_user.username, 'up_to': ids[2]},
+        {'type': 'receipt', 'kind': 'seen',
+         'user': second_user.username, 'up_to': ids[1]},
+    ]
+    assert await communicator_1.receive_nothing(timeout=0.3)
+    seen = [message_id async for message_id in Message.objects.filter(
+        seen=True).order_by('pk').values_list('pk', flat=True)]
+    assert seen == ids[:2]
+    conversation = await Conversation.objects.aget()
+    assert conversation.user2_unread == 1
+
+    # a receipt for messages seen already is not sent again
+    await communicator_2.send_json_to({'type': 'seen',
+                                       'user': first_user.username,
+                                       'up_to': ids[0]})
+    assert await communicator_1.receive_nothing(timeout=0.3)
+    await communicator_1.disconnect()
+    await communicator_2.disconnect()
+
+
+@pytest.mark.django_db
+def test_mark_as_seen_up_to(inbox: list[Message],
+                            first_user: User,
+                            second_user: User,
+                            client: APIClient):
+    client.force_authenticate(first_user)
+    received = [message.pk for message in inbox
+                if message.recipient == first_user
+                and message.sender == second_user]
+    response: Response = client.post(
+        reverse('read-messages'),
+        {'user': second_user.username, 'up_to': max(received)},
+        format='json'
+    )
+    assert response.status_code == 200
+    assert not Message.objects.filter(pk__in=received, seen=False).exists()
+    response = client.post(
+        reverse('read-messages'),
+        {'user': first_user.username, 'up_to': max(received)},
+        format='json'
+    )
+    assert response.status_code == 304
+
+
+@pytest.mark.django_db
+def test_mark_as_seen_malformed_request(first_user: User,
+                                        second_user: User,
+                                        client: APIClient):
+    client.force_authenticate(first_user)
+    for data in ({'up_to': 1},
+                 {'user': second_user.username, 'up_to': 'latest'},
+                 {'ids_to_mark': 1},
+                 {'ids_to_mark': [1, 'two']},
+                 {}):
+        response: Response = client.post(reverse('read-messages'), data,
+                                         format='json')
+        assert response.status_code == 400
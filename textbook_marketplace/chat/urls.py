@@ -1,9 +1,12 @@
 from django.urls import path
 
-from .views import MessageView, MessageMarkAsSeenView, ConversationView
+from .views import (MessageView, MessageMarkAsSeenView, ConversationView,
+                    InboxView, PresenceView)
 
 urlpatterns = [
     path('', MessageView.as_view(), name='chat'),
     path('conversation/<str:username>/', ConversationView.as_view(), name='conversation'),
+    path('conversations/', InboxView.as_view(), name='inbox'),
     path('mark/', MessageMarkAsSeenView.as_view(), name='read-messages'),
+    path('presence/', PresenceView.as_view(), name='presence'),
 ]
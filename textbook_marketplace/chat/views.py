@@ -2,55 +2,143 @@ from rest_framework.views import APIView
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from django.conf import settings
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from django.shortcuts import get_object_or_404
 
 from django.contrib.auth import get_user_model
-from django.db.models import Q
-
 from typing import List
 
-from .models import Message
-from .serializers import MessageSerializer
+from . import caching
+from .inbox import mark_seen, users_of
+from .presence import online_now
+from .models import Conversation, Message
+from .pagination import ConversationPagination, MessagePagination
+from .protocol import message_id
+from .serializers import ConversationSerializer, MessageSerializer
 
 User = get_user_model()
 
 
 class MessageView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = MessagePagination
 
     def get(self, request):
-        """ Returns list of messages request.user is member of. """
+        """ Returns messages request.user is member of, newest first,
+        paginated (see MessagePagination). """
         user = request.user
-        messages = Message.objects.filter(
-            Q(sender=user) | Q(recipient=user)
-        ).order_by('sent_at')
+        paginator = self.pagination_class()
+        messages = paginator.paginate_branches([
+            Message.objects.filter(sender=user),
+            Message.objects.filter(recipient=user).exclude(sender=user),
+        ], request)
+        prefetch_related_objects(messages, 'sender', 'recipient')
         serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class ConversationView(APIView):
     """Get message history with specific user."""
     permission_classes = [IsAuthenticated]
-    
+    pagination_class = MessagePagination
+
     def get(self, request, username):
         user = request.user
         other_user = get_object_or_404(User, username=username)
-        messages = Message.objects.filter(
-            Q(sender=user, recipient=other_user) |
-            Q(sender=other_user, recipient=user)
-        ).order_by('sent_at')
+        paginator = self.pagination_class()
+        messages = paginator.paginate_branches(
+            [Message.between(user, other_user).select_related('sender',
+                                                              'recipient')],
+            request
+        )
         serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class InboxView(APIView):
+    """ Conversations of request.user with their last message and unread
+    count, most recently active first, paginated (see
+    ConversationPagination). Reads one Conversation row per entry. """
+    permission_classes = [IsAuthenticated]
+    pagination_class = ConversationPagination
+
+    def get(self, request):
+        user = request.user
+        paginator = self.pagination_class()
+        conversations = paginator.paginate_branches([
+            Conversation.objects.filter(user1=user),
+            Conversation.objects.filter(user2=user).exclude(user1=user),
+        ], request)
+        serializer = ConversationSerializer(conversations, many=True, context={
+            'user': user,
+            'users': users_of(conversations),
+        })
+        return paginator.get_paginated_response(serializer.data)
 
 
 class MessageMarkAsSeenView(APIView):
+    """ Marks the messages in `ids_to_mark`, or those from `user` up to id
+    `up_to`, as seen. Websocket clients send a 'seen' frame instead (see
+    ChatConsumer.receive_receipt()). """
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        ids: List[int] = request.data['ids_to_mark']
-        messages = Message.objects.filter(id__in=ids, recipient=request.user)
-        if not messages.exists():
+        if 'up_to' in request.data:
+            username = request.data.get('user')
+            up_to = message_id(request.data['up_to'])
+            if not isinstance(username, str) or up_to is None:
+                return Response(
+                    {'error': '`up_to` takes a message id and `user` the '
+                              'username of its sender.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            messages = Message.objects.filter(
+                sender__username=username,
+                recipient=request.user,
+                id__lte=up_to
+            )
+        else:
+            ids: List[int | None] = request.data.get('ids_to_mark')
+            if isinstance(ids, list):
+                ids = [message_id(value) for value in ids]
+            if not isinstance(ids, list) or None in ids:
+                return Response(
+                    {'error': '`ids_to_mark` takes a list of message ids.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            messages = Message.objects.filter(id__in=ids,
+                                              recipient=request.user)
+        with transaction.atomic():
+            marked = mark_seen(request.user, messages)
+        if not marked and not messages.exists():
             return Response(status=status.HTTP_304_NOT_MODIFIED)
-        messages.update(seen=True)
         return Response(status=status.HTTP_200_OK)
 
+
+class PresenceView(APIView):
+    """ Whether the users in ?users= (comma separated usernames, at most
+    CHAT_PRESENCE_QUERY_LIMIT) are connected to the chat. Unknown
+    usernames, and users that block request.user or that it blocks, are
+    left out. """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        usernames = [username for username
+                     in request.query_params.get('users', '').split(',')
+                     if username]
+        limit = settings.CHAT_PRESENCE_QUERY_LIMIT
+        if len(usernames) > limit:
+            return Response(
+                {'error': f'Presence of at most {limit} users can be asked.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        users = dict(User.objects.filter(username__in=usernames).values_list(
+            'pk', 'username'
+        ))
+        for user_id in caching.blocked_among(request.user.pk, users):
+            del users[user_id]
+        online = online_now(list(users))
+        return Response({username: online[user_id]
+                         for user_id, username in users.items()})
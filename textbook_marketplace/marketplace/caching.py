@@ -0,0 +1,216 @@
+import hashlib
+import json
+import time
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from rest_framework.response import Response
+
+from .models import Textbook
+
+
+def queryset_signature(queryset):
+    """ Stable key for the rows a queryset selects, ignoring its ordering.
+
+    Built from the compiled SQL, so two requests with the same filters
+    (whatever their query-string order) and the same base queryset share a
+    signature. Returns None for querysets that can match nothing. """
+    try:
+        sql, params = queryset.order_by().query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    digest = hashlib.md5(f'{sql}|{params!r}'.encode()).hexdigest()
+    return f'{queryset.model._meta.label_lower}:{digest}'
+
+
+# Response cache for anonymous catalog reads.
+#
+# Cached responses are keyed on the request path, the normalized query
+# string and the current values of the generation counters the response
+# depends on. Bumping a counter (from the Textbook signals in
+# marketplace.signals) makes every key built with the old value
+# unreachable; the stale entries then expire through their TTL. Counters
+# expire too, some time after the responses built with them.
+
+GENERATION_KEY = 'catalog:generation:{}'
+HITS_KEY = 'catalog:metrics:hits'
+MISSES_KEY = 'catalog:metrics:misses'
+SCHOOL_CLASSES_KEY = 'catalog:school_classes'
+
+# Exact-match filters whose values get their own generation counter, so a
+# listing filtered on them is only invalidated by changes to its own rows.
+NAMESPACED_FILTERS = ['school_class', 'condition']
+
+
+def catalog_cache_enabled():
+    return getattr(settings, 'CATALOG_CACHE_ENABLED', True)
+
+
+def catalog_cache_timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+
+def generation_key(name):
+    # names hold filter values as sent, which are no valid cache key
+    return GENERATION_KEY.format(hashlib.md5(name.encode()).hexdigest())
+
+
+def generation_timeout():
+    return catalog_cache_timeout() * 2
+
+
+def get_generations(names):
+    """ Current counter values; a missing (never set, expired or evicted)
+    counter starts from a fresh value so it can't reuse an old key. """
+    keys = [generation_key(name) for name in names]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, time.time_ns(), timeout=generation_timeout())
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def bump_generations(names):
+    for name in names:
+        key = generation_key(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), timeout=generation_timeout())
+
+
+def record_cache_access(hit):
+    key = HITS_KEY if hit else MISSES_KEY
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def cache_metrics():
+    values = cache.get_many([HITS_KEY, MISSES_KEY])
+    return {'hits': values.get(HITS_KEY, 0),
+            'misses': values.get(MISSES_KEY, 0)}
+
+
+def known_school_classes():
+    """ School classes of the listed textbooks, as of at most
+    CATALOG_CACHE_TIMEOUT ago. """
+    classes = cache.get(SCHOOL_CLASSES_KEY)
+    if classes is None:
+        classes = set(Textbook.objects.order_by().values_list(
+            'school_class', flat=True
+        ).distinct())
+        cache.set(SCHOOL_CLASSES_KEY, classes, catalog_cache_timeout())
+    return classes
+
+
+def namespace_valid(field, value):
+    if field == 'condition':
+        return value in dict(Textbook.CONDITION_CHOICES)
+    return value in known_school_classes()
+
+
+def listing_generations(request, *args, **kwargs):
+    """ The counters of the namespaced filters of the request. Values no
+    textbook has (as far as known) get no counter of their own, so
+    requests can't create counters at will; their listings depend on
+    'list', which every change bumps. """
+    names = [f'{field}:{request.query_params[field]}'
+             for field in NAMESPACED_FILTERS
+             if field in request.query_params
+             and namespace_valid(field, request.query_params[field])]
+    return names or ['list']
+
+
+def detail_generations(request, *args, pk=None, **kwargs):
+    return [f'textbook:{pk}']
+
+
+def cache_anonymous_response(generations):
+    """ Caches the data of successful responses to anonymous GETs.
+
+    `generations(request, *args, **kwargs)` names the counters the response
+    depends on. Responses carry X-Cache: HIT/MISS; validators are stored with
+    the data, so conditional requests are answered from the cache too. """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            if not catalog_cache_enabled() or request.user.is_authenticated:
+                return method(view, request, *args, **kwargs)
+            query = urlencode(sorted(
+                (name, value) for name, values in request.query_params.lists()
+                for value in values
+            ))
+            counters = get_generations(generations(request, *args, **kwargs))
+            fingerprint = f'{request.get_host()}|{request.path}|{query}|{counters}'
+            key = 'catalog:response:' + hashlib.md5(
+                fingerprint.encode()
+            ).hexdigest()
+
+            cached = cache.get(key)
+            record_cache_access(hit=cached is not None)
+            if cached is not None:
+                data, headers = cached
+                response = not_modified(request, headers)
+                if response is None:
+                    response = Response(data, headers=headers)
+                response['X-Cache'] = 'HIT'
+                return response
+            response = method(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                headers = {name: response[name] for name in VALIDATOR_HEADERS
+                           if response.has_header(name)}
+                cache.set(key, (response.data, headers),
+                          catalog_cache_timeout())
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+# Conditional GET (ETag / Last-Modified) for textbook responses.
+
+VALIDATOR_HEADERS = ['ETag', 'Last-Modified']
+
+
+def textbook_etag(textbooks, *extra):
+    """ Strong ETag over the rows a textbook response is built from.
+
+    Every row contributes (id, updated_at) plus the seller's username,
+    which the serializer renders but does not touch updated_at. `extra`
+    covers the rest of the body, e.g. a page's count and links. """
+    rows = [(textbook.pk, textbook.updated_at.isoformat(),
+             textbook.seller.username) for textbook in textbooks]
+    digest = hashlib.md5(
+        json.dumps([rows, extra], separators=(',', ':')).encode()
+    ).hexdigest()
+    return quote_etag(digest)
+
+
+def validator_headers(etag, last_modified=None):
+    headers = {'ETag': etag}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified.timestamp())
+    return headers
+
+
+def not_modified(request, headers):
+    """ 304 (or 412) response when the request's conditional headers match
+    the validators in `headers`, None when a full response is needed. """
+    last_modified = headers.get('Last-Modified')
+    response = get_conditional_response(
+        request,
+        etag=headers['ETag'],
+        last_modified=last_modified and parse_http_date_safe(last_modified),
+    )
+    if response is not None:
+        for name, value in headers.items():
+            response[name] = value
+    return response
@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from .caching import get_generations, queryset_signature
+
+FACET_FIELDS = ['subject', 'school_class', 'condition', 'publisher']
+
+# (min, max) in the listing currency; max is exclusive, None is open-ended.
+PRICE_BUCKETS = [(0, 500), (500, 1000), (1000, 2000), (2000, None)]
+
+
+def facets_cache_timeout():
+    return getattr(settings, 'TEXTBOOK_FACETS_CACHE_TIMEOUT', 60)
+
+
+def textbook_facets(queryset, generations):
+    """ Per-value counts of FACET_FIELDS and PRICE_BUCKETS over `queryset`.
+
+    All facets come from one grouped query over the filtered rows, cached
+    per filter signature for TEXTBOOK_FACETS_CACHE_TIMEOUT seconds, or
+    until a textbook change bumps one of the catalog counters named in
+    `generations` (see caching.listing_generations()). """
+    signature = queryset_signature(queryset)
+    if signature is None:
+        return empty_facets()
+    counters = ':'.join(str(value) for value in get_generations(generations))
+    key = f'facets:{signature}:{counters}'
+    facets = cache.get(key)
+    if facets is None:
+        facets = compute_facets(queryset)
+        cache.set(key, facets, facets_cache_timeout())
+    return facets
+
+
+def empty_facets():
+    facets = {field: [] for field in FACET_FIELDS}
+    facets['price'] = [
+        {'min': low, 'max': high, 'count': 0} for low, high in PRICE_BUCKETS
+    ]
+    return facets
+
+
+def compute_facets(queryset):
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    base_sql, params = queryset.order_by().values(
+        *FACET_FIELDS, 'price'
+    ).query.sql_with_params()
+
+    bucket_cases = ' '.join(
+        f'WHEN {qn("price")} < {high} THEN {index}'
+        for index, (_, high) in enumerate(PRICE_BUCKETS) if high is not None
+    )
+    columns = [qn(field) for field in FACET_FIELDS] + [qn('price_bucket')]
+    rows_sql = (
+        f'SELECT {", ".join(columns[:-1])}, '
+        f'CASE {bucket_cases} ELSE {len(PRICE_BUCKETS) - 1} END '
+        f'AS {qn("price_bucket")} FROM ({base_sql}) AS filtered'
+    )
+
+    facets = empty_facets()
+    names = FACET_FIELDS + ['price']
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # One scan; GROUPING() has a bit set for every column the row
+            # is *not* grouped by, first column most significant.
+            cursor.execute(
+                f'SELECT {", ".join(columns)}, '
+                f'GROUPING({", ".join(columns)}), COUNT(*) '
+                f'FROM ({rows_sql}) AS facet_rows GROUP BY GROUPING SETS '
+                f'({", ".join(f"({column})" for column in columns)})',
+                params
+            )
+            all_bits = (1 << len(columns)) - 1
+            for *values, grouping, count in cursor.fetchall():
+                index = len(columns) - (all_bits ^ grouping).bit_length()
+                add_facet_value(facets, names[index], values[index], count)
+        else:
+            # No GROUPING SETS (e.g. sqlite): still a single round trip.
+            cursor.execute(
+                ' UNION ALL '.join(
+                    f'SELECT {index}, {column}, COUNT(*) '
+                    f'FROM ({rows_sql}) AS facet_rows GROUP BY {column}'
+                    for index, column in enumerate(columns)
+                ),
+                params * len(columns)
+            )
+            for index, value, count in cursor.fetchall():
+                add_facet_value(facets, names[index], value, count)
+
+    for field in FACET_FIELDS:
+        facets[field].sort(key=lambda item: (-item['count'], item['value']))
+    return facets
+
+
+def add_facet_value(facets, name, value, count):
+    if name == 'price':
+        facets['price'][value]['count'] = count
+    else:
+        facets[name].append({'value': value, 'count': count})
@@ -1,18 +1,27 @@
 import django_filters
-from django.db.models import Q
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, Q, TextField
+from django.db.models.functions import Cast, Upper
 
 from .models import Textbook
 
+# Text search configuration used by the search_vector trigger.
+# 'simple' does no stemming, which suits mixed Serbian/English titles.
+SEARCH_CONFIG = 'simple'
+
 
 class TextbookFilter(django_filters.FilterSet):
-    query = django_filters.CharFilter(method='in_title_or_desc',
+    query = django_filters.CharFilter(method='full_text_search',
                                       label='Search')
-    author = django_filters.CharFilter(lookup_expr='icontains',
+    fuzzy = django_filters.BooleanFilter(method='typo_tolerant',
+                                         label='Typo-tolerant matching')
+    author = django_filters.CharFilter(method='text_match',
                                        label='Author')
-    publisher = django_filters.CharFilter(lookup_expr='icontains',
+    publisher = django_filters.CharFilter(method='text_match',
                                           label='Publisher')
     school_class = django_filters.CharFilter(label='Grade')
-    subject = django_filters.CharFilter(lookup_expr='icontains',
+    subject = django_filters.CharFilter(method='text_match',
                                         label='Subject')
     min_price = django_filters.NumberFilter(field_name='price',
                                             lookup_expr='gte',
@@ -22,14 +31,44 @@ class TextbookFilter(django_filters.FilterSet):
                                             label='Maximal price')
     condition = django_filters.ChoiceFilter(choices=Textbook.CONDITION_CHOICES)
     seller = django_filters.CharFilter(field_name='seller__username',
-                                       lookup_expr='icontains',
+                                       method='text_match',
                                        label='Seller')
 
     class Meta:
         model = Textbook
-        fields = ['query', 'author', 'publisher', 'school_class',
+        fields = ['query', 'fuzzy', 'author', 'publisher', 'school_class',
                   'subject', 'price', 'condition', 'seller']
 
+    def full_text_search(self, queryset, name, value):
+        """ Ranked search over the GIN-indexed search_vector column.
+        Falls back to substring matching on databases without tsvector
+        support (e.g. the sqlite test database). """
+        if connection.vendor != 'postgresql':
+            return self.in_title_or_desc(queryset, name, value)
+        search_query = SearchQuery(value, config=SEARCH_CONFIG,
+                                   search_type='websearch')
+        return queryset.filter(search_vector=search_query).annotate(
+            rank=SearchRank(F('search_vector'), search_query)
+        ).order_by('-rank', '-created_at')
+
+    def typo_tolerant(self, queryset, name, value):
+        """ Switches text_match filters to trigram matching; applied there. """
+        return queryset
+
+    def text_match(self, queryset, name, value):
+        """ Substring match by default; with ?fuzzy=true on PostgreSQL,
+        word similarity (pg_trgm %> operator) so that e.g. "Petrovic"
+        finds "Petrović". Both forms are served by the trigram GIN indexes
+        on UPPER(column::text); the similarity threshold is the
+        pg_trgm.word_similarity_threshold connection setting. """
+        if (self.form.cleaned_data.get('fuzzy')
+                and connection.vendor == 'postgresql'):
+            alias = f"{name.replace('__', '_')}_upper"
+            return queryset.alias(
+                **{alias: Upper(Cast(name, output_field=TextField()))}
+            ).filter(**{f'{alias}__trigram_word_similar': value})
+        return queryset.filter(**{f'{name}__icontains': value})
+
     def in_title_or_desc(self, queryset, name, value):
         return queryset.filter(
             Q(title__icontains=value) | Q(description__icontains=value)
@@ -0,0 +1,168 @@
+import time
+from io import BytesIO
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.templatetags.static import static
+from PIL import Image, ImageOps
+from versatileimagefield.utils import (
+    build_versatileimagefield_url_set,
+    get_rendition_key_set,
+)
+
+from .models import Textbook
+
+# Rendition key set (settings.VERSATILEIMAGEFIELD_RENDITION_KEY_SETS)
+# served for textbook images.
+TEXTBOOK_RENDITIONS = 'marketplace'
+
+# Served instead of sized renditions that are still being generated.
+PLACEHOLDER_IMAGE = 'marketplace/rendition-placeholder.png'
+
+# Smaller encodings written next to every rendition, best first:
+# (mime type, Pillow format, extension, save options). Formats the
+# installed Pillow can't write (AVIF before Pillow 11.2) are skipped.
+MODERN_FORMATS = [
+    ('image/avif', 'AVIF', 'avif', {'quality': 55}),
+    ('image/webp', 'WEBP', 'webp', {'quality': 80, 'method': 5}),
+]
+MODERN_DIRNAME = '__modern__'
+
+
+def renditions_async():
+    return getattr(settings, 'IMAGE_RENDITIONS_ASYNC', True)
+
+
+def rendition_urls(image, sizes=TEXTBOOK_RENDITIONS, sources=False):
+    """ Absolute URLs of the `sizes` renditions of `image`, keyed by
+    rendition name. Missing renditions are created on the way, so this
+    belongs at upload time rather than in a serializer.
+
+    With `sources`, every rendition is also encoded in the supported
+    MODERN_FORMATS and 'sources' maps rendition name to {mime type: URL},
+    best format first, for <picture>/srcset markup. """
+    if isinstance(sizes, str):
+        sizes = get_rendition_key_set(sizes)
+    urls = build_versatileimagefield_url_set(image, sizes)
+    renditions = {key: urljoin(settings.MEDIA_HOST, url)
+                  for key, url in urls.items()}
+    if sources and image:
+        renditions['sources'] = {
+            key: modern_sources(image.storage,
+                                rendition_file(image, image_key))
+            for key, image_key in sizes
+        }
+    return renditions
+
+
+def rendition_file(image, image_key):
+    """ Storage name of a rendition key such as 'url' or 'crop__324x420'. """
+    if image_key == 'url':
+        return image.name
+    sizer, size = image_key.split('__', 1)
+    return getattr(image, sizer)[size].name
+
+
+def supported_formats():
+    Image.init()
+    return [spec for spec in MODERN_FORMATS if spec[1] in Image.SAVE]
+
+
+def encode_image(image, image_format, options):
+    buffer = BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def prepare_for_encoding(image):
+    """ Applies EXIF orientation (dropped by the re-encode) and converts
+    palette/CMYK images to a mode AVIF and WebP can store. """
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = (image.mode in ('LA', 'PA')
+                     or 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    return image
+
+
+def modern_sources(storage, name):
+    """ Encodes the file `name` on `storage` in each supported modern
+    format under MODERN_DIRNAME and returns {mime type: absolute URL}.
+    Existing encodings are reused, so reruns only fill in what is
+    missing. """
+    sources = {}
+    image = None
+    for mime_type, image_format, extension, options in supported_formats():
+        target = f'{MODERN_DIRNAME}/{name}.{extension}'
+        if not storage.exists(target):
+            if image is None:
+                with storage.open(name, 'rb') as source:
+                    image = prepare_for_encoding(Image.open(source))
+            target = storage.save(target, ContentFile(
+                encode_image(image, image_format, options)
+            ))
+        sources[mime_type] = urljoin(settings.MEDIA_HOST, storage.url(target))
+    return sources
+
+
+def interim_renditions(image, state, sizes=TEXTBOOK_RENDITIONS):
+    """ URLs served until renditions are ready: the original for 'url'
+    keys, and the placeholder (pending or processing) or the original
+    (failed) for the sized ones. Nothing is resolved against storage. """
+    if isinstance(sizes, str):
+        sizes = get_rendition_key_set(sizes)
+    original = urljoin(settings.MEDIA_HOST, image.url)
+    stand_in = original
+    if state in (Textbook.RENDITIONS_PENDING,
+                 Textbook.RENDITIONS_PROCESSING):
+        stand_in = urljoin(settings.MEDIA_HOST, static(PLACEHOLDER_IMAGE))
+    return {key: original if image_key == 'url' else stand_in
+            for key, image_key in sizes}
+
+
+def request_image_renditions(textbook):
+    """ Called after textbook.image changed. Queues the renditions for the
+    process_renditions worker, or builds them right away when
+    IMAGE_RENDITIONS_ASYNC is off. """
+    if textbook.image and not renditions_async():
+        update_image_renditions(textbook)
+        return
+    textbook.image_renditions = {}
+    textbook.image_renditions_state = (
+        Textbook.RENDITIONS_PENDING if textbook.image
+        else Textbook.RENDITIONS_READY
+    )
+    Textbook.objects.filter(pk=textbook.pk).update(
+        image_renditions=textbook.image_renditions,
+        image_renditions_state=textbook.image_renditions_state,
+    )
+
+
+def update_image_renditions(textbook):
+    """ Builds and stores textbook.image_renditions in this process,
+    without touching updated_at or sending save signals. """
+    textbook.image_renditions = (
+        rendition_urls(textbook.image, sources=True) if textbook.image else {}
+    )
+    textbook.image_renditions_state = Textbook.RENDITIONS_READY
+    Textbook.objects.filter(pk=textbook.pk).update(
+        image_renditions=textbook.image_renditions,
+        image_renditions_state=textbook.image_renditions_state,
+    )
+
+
+def build_renditions(pk, image_name, attempts=3):
+    """ Rendition job of the process_renditions worker. Runs in a pool
+    process without database access and returns the rendition URLs.
+
+    Renditions that already exist in storage are reused, so retried or
+    duplicated jobs only redo what is missing. """
+    image = Textbook(pk=pk, image=image_name).image
+    for attempt in range(1, attempts + 1):
+        try:
+            return rendition_urls(image, sources=True)
+        except Exception:
+            if attempt == attempts:
+                raise
+            time.sleep(attempt)
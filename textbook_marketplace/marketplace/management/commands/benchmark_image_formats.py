@@ -0,0 +1,110 @@
+"""
+Management command comparing the byte size of textbook cover renditions
+encoded as JPEG (current output, jpeg_resize_quality) against the
+modern formats of marketplace.images.MODERN_FORMATS.
+
+Renditions are built in memory from marketplace/fixtures/textbook_images
+(or --path) with the sizes of the 'marketplace' rendition key set;
+full_size is the source re-encoded, not the uploaded file as served;
+nothing is written to storage or the database.
+
+Usage:
+    python manage.py benchmark_image_formats
+    python manage.py benchmark_image_formats --path /some/covers
+"""
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from marketplace.images import (
+    MODERN_FORMATS,
+    TEXTBOOK_RENDITIONS,
+    encode_image,
+    prepare_for_encoding,
+    supported_formats,
+)
+
+FIXTURE_IMAGES = os.path.join(settings.BASE_DIR, 'marketplace', 'fixtures',
+                              'textbook_images')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark JPEG vs WebP/AVIF byte sizes of textbook cover renditions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default=FIXTURE_IMAGES,
+            help='Directory of source images (default: fixture covers)'
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isdir(path):
+            raise CommandError(f'{path} is not a directory.')
+        formats = [('image/jpeg', 'JPEG', 'jpg', {
+            'quality': settings.VERSATILEIMAGEFIELD_SETTINGS.get(
+                'jpeg_resize_quality', 70
+            ),
+        })] + supported_formats()
+        skipped = [spec[1] for spec in MODERN_FORMATS
+                   if spec not in formats]
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f'Pillow cannot write {", ".join(skipped)}; skipped.'
+            ))
+
+        sizes = settings.VERSATILEIMAGEFIELD_RENDITION_KEY_SETS[
+            TEXTBOOK_RENDITIONS
+        ]
+        totals = {(key, spec[1]): 0 for key, _ in sizes for spec in formats}
+        images = 0
+        for filename in sorted(os.listdir(path)):
+            try:
+                with Image.open(os.path.join(path, filename)) as source:
+                    image = prepare_for_encoding(source)
+            except (UnidentifiedImageError, IsADirectoryError):
+                continue
+            images += 1
+            for key, image_key in sizes:
+                rendition = self.render(image, image_key)
+                for _, image_format, _, save_options in formats:
+                    totals[key, image_format] += len(encode_image(
+                        rendition.convert('RGB') if image_format == 'JPEG'
+                        else rendition,
+                        image_format, save_options
+                    ))
+        if not images:
+            raise CommandError(f'No images found in {path}.')
+
+        header = f'{"rendition":>10}' + ''.join(
+            f'{image_format + " KiB":>12}' for _, image_format, _, _ in formats
+        )
+        self.stdout.write(f'{images} images')
+        self.stdout.write(header)
+        for key, _ in sizes:
+            jpeg = totals[key, 'JPEG']
+            row = f'{key:>10}'
+            for _, image_format, _, _ in formats:
+                size = totals[key, image_format]
+                cell = f'{size / 1024:.0f}'
+                if image_format != 'JPEG':
+                    cell += f' ({size / jpeg - 1:+.0%})'
+                row += f'{cell:>12}'
+            self.stdout.write(row)
+
+    @staticmethod
+    def render(image, image_key):
+        """ The same geometry as versatileimagefield's sizers. """
+        if image_key == 'url':
+            return image
+        sizer, size = image_key.split('__', 1)
+        width, height = (int(value) for value in size.split('x'))
+        if sizer == 'crop':
+            return ImageOps.fit(image, (width, height), Image.LANCZOS)
+        rendition = image.copy()
+        rendition.thumbnail((width, height), Image.LANCZOS)
+        return rendition
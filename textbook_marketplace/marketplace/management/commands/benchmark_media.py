@@ -0,0 +1,139 @@
+"""
+Management command comparing media throughput of django.views.static.serve
+(through the Django ASGI handler) against textbook_marketplace.media's
+MediaFilesApp.
+
+Both apps are driven in process, without a server or sockets, with
+--concurrency requests in flight, so the numbers compare per-request
+overhead and read path rather than network throughput. Files of each
+--sizes (KiB) are written below MEDIA_ROOT for the run and removed after.
+
+Usage:
+    python manage.py benchmark_media
+    python manage.py benchmark_media --sizes 16 256 4096 --requests 500
+"""
+
+import asyncio
+import os
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+
+from textbook_marketplace.media import MediaFilesApp
+
+
+async def not_found_app(scope, receive, send):
+    raise AssertionError(f'{scope["path"]} not answered by MediaFilesApp')
+
+
+async def asgi_get(app, path):
+    """ Body length and status of a GET on `app`. """
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': b'', 'root_path': '', 'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+    }
+    status, received = None, 0
+    request = {'type': 'http.request', 'body': b'', 'more_body': False}
+    # Django waits for http.disconnect after the body; it never comes here.
+    messages = asyncio.Queue()
+    messages.put_nowait(request)
+
+    async def receive():
+        return await messages.get()
+
+    async def send(message):
+        nonlocal status, received
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            received += len(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return status, received
+
+
+class Command(BaseCommand):
+    help = 'Benchmark media serving: static.serve vs MediaFilesApp'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            nargs='+',
+            type=int,
+            default=[16, 256, 2048],
+            help='File sizes in KiB (default: 16 256 2048)'
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=300,
+            help='Requests per size and app (default: 300)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=16,
+            help='Requests in flight (default: 16)'
+        )
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive.')
+        directory = f'benchmark-media-{uuid.uuid4().hex[:8]}'
+        root = os.path.join(settings.MEDIA_ROOT, directory)
+        os.makedirs(root)
+        try:
+            paths = {}
+            for size in options['sizes']:
+                name = f'{size}k.jpg'
+                with open(os.path.join(root, name), 'wb') as file:
+                    file.write(os.urandom(size * 1024))
+                paths[size] = f'{settings.MEDIA_URL}{directory}/{name}'
+
+            apps = [
+                ('static.serve', get_asgi_application()),
+                ('MediaFilesApp', MediaFilesApp(not_found_app)),
+            ]
+            self.stdout.write(
+                f'{options["requests"]} requests per row, '
+                f'concurrency {options["concurrency"]}'
+            )
+            self.stdout.write(
+                f'{"size KiB":>9} {"app":>14} {"req/s":>9} {"MB/s":>9}'
+            )
+            for size, path in paths.items():
+                for name, app in apps:
+                    elapsed = asyncio.run(self.run(
+                        app, path, size * 1024,
+                        options['requests'], options['concurrency']
+                    ))
+                    rate = options['requests'] / elapsed
+                    self.stdout.write(
+                        f'{size:>9} {name:>14} {rate:>9.0f} '
+                        f'{rate * size * 1024 / 1e6:>9.1f}'
+                    )
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    @staticmethod
+    async def run(app, path, size, requests, concurrency):
+        queue = iter(range(requests))
+
+        async def worker():
+            for _ in queue:
+                status, received = await asgi_get(app, path)
+                if status != 200 or received != size:
+                    raise CommandError(
+                        f'{path}: status {status}, {received} of {size} bytes'
+                    )
+
+        await asgi_get(app, path)  # warm up URL resolving and imports
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - started
@@ -0,0 +1,132 @@
+"""
+Management command comparing full-text search against the legacy
+icontains search for TextbookFilter.query.
+
+Synthetic listings are inserted inside a transaction that is rolled back
+at the end, so the database is left untouched. Requires PostgreSQL with
+migrations applied (the search_vector trigger fills the column on insert).
+
+Usage:
+    python manage.py benchmark_search
+    python manage.py benchmark_search --sizes 10000 100000 --runs 50
+"""
+
+import random
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from marketplace.filters import TextbookFilter
+from marketplace.models import Textbook
+
+User = get_user_model()
+
+SUBJECTS = ['Matematika', 'Srpski jezik', 'Engleski jezik', 'Istorija',
+            'Biologija', 'Geografija', 'Fizika', 'Hemija']
+PUBLISHERS = ['Klett', 'Zavod za udžbenike', 'Logos', 'Novi Logos',
+              'Data Status', 'Gerundijum']
+WORDS = ['udžbenik', 'zbirka', 'zadataka', 'radna', 'sveska', 'gimnazija',
+         'razred', 'novo', 'izdanje', 'testova', 'rešeni', 'osnovna',
+         'srednja', 'škola', 'priručnik', 'vežbanke', 'teorija', 'praksa']
+SEARCH_TERMS = ['matematika', 'zbirka zadataka', 'fizika gimnazija',
+                'radna sveska', 'klett', 'istorija udžbenik']
+
+
+class RollbackBenchmark(Exception):
+    """Raised to discard the synthetic listings after measuring."""
+
+
+class Command(BaseCommand):
+    help = 'Benchmark p50/p95 latency of full-text vs icontains textbook search'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[10_000, 100_000, 1_000_000],
+            help='Catalog sizes to measure (default: 10k 100k 1M)'
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=30,
+            help='Queries per search term and mode (default: 30)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='bulk_create batch size for synthetic listings'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Full-text search benchmark requires PostgreSQL.')
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise RollbackBenchmark
+        except RollbackBenchmark:
+            self.stdout.write('Synthetic listings rolled back.')
+
+    def run(self, options):
+        seller = User.objects.create_user(username='benchmark_search_seller',
+                                          password=None, is_seller=True)
+        inserted = 0
+        self.stdout.write(f'{"rows":>9} {"mode":>9} {"p50 ms":>9} {"p95 ms":>9}')
+        for size in sorted(options['sizes']):
+            self.insert_listings(seller, size - inserted, options['batch_size'])
+            inserted = size
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE marketplace_textbook')
+            for mode in ('icontains', 'fts'):
+                p50, p95 = self.measure(mode, options['runs'])
+                self.stdout.write(f'{size:>9} {mode:>9} {p50:>9.2f} {p95:>9.2f}')
+
+    def insert_listings(self, seller, count, batch_size):
+        while count > 0:
+            chunk = min(count, batch_size)
+            Textbook.objects.bulk_create([self.make_listing(seller)
+                                          for _ in range(chunk)])
+            count -= chunk
+
+    @staticmethod
+    def make_listing(seller):
+        subject = random.choice(SUBJECTS)
+        return Textbook(
+            title=f'{subject} {random.randint(1, 4)}, '
+                  f'{" ".join(random.sample(WORDS, 3))}',
+            author=f'Autor {random.randint(1, 5000)}',
+            school_class=str(random.randint(1, 12)),
+            publisher=random.choice(PUBLISHERS),
+            subject=subject,
+            price=random.randint(100, 5000),
+            seller=seller,
+            description=' '.join(random.choices(WORDS, k=30)),
+        )
+
+    @staticmethod
+    def measure(mode, runs):
+        """ Times the same work a list page does: COUNT(*) plus the first
+        page of 20 rows. """
+        timings = []
+        for term in SEARCH_TERMS:
+            for _ in range(runs):
+                filterset = TextbookFilter({'query': term},
+                                           queryset=Textbook.objects.all())
+                if mode == 'fts':
+                    queryset = filterset.qs
+                else:
+                    queryset = filterset.in_title_or_desc(
+                        Textbook.objects.all(), 'query', term
+                    ).order_by('-created_at')
+                start = time.perf_counter()
+                queryset.count()
+                list(queryset[:20])
+                timings.append((time.perf_counter() - start) * 1000)
+        quantiles = statistics.quantiles(timings, n=20)
+        return statistics.median(timings), quantiles[18]
@@ -0,0 +1,112 @@
+"""
+Management command measuring how long TextbookSerializer takes to
+serialize a listing page with precomputed rendition URLs versus resolving
+them per request (MEDIA_HOST urljoin plus a cache or storage lookup per
+rendition).
+
+Listings are inserted inside a transaction that is rolled back at the end;
+the sample image and its renditions are removed from storage afterwards.
+
+Usage:
+    python manage.py benchmark_serialization
+    python manage.py benchmark_serialization --page-size 50 --runs 500
+"""
+
+import statistics
+import time
+from io import BytesIO
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from PIL import Image
+
+from marketplace.images import update_image_renditions
+from marketplace.models import Textbook
+from marketplace.serializers import TextbookSerializer
+
+User = get_user_model()
+
+
+class RollbackBenchmark(Exception):
+    """Raised to discard the synthetic listings after measuring."""
+
+
+class Command(BaseCommand):
+    help = 'Benchmark per-page textbook serialization with and without precomputed rendition URLs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--page-size',
+            type=int,
+            default=20,
+            help='Textbooks per serialized page (default: 20)'
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=200,
+            help='Serializations per mode (default: 200)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise RollbackBenchmark
+        except RollbackBenchmark:
+            self.stdout.write('Synthetic listings rolled back.')
+
+    def run(self, options):
+        seller = User.objects.create_user(
+            username='benchmark_serialization_seller', password=None,
+            is_seller=True
+        )
+        first = Textbook.objects.create(**self.listing(seller),
+                                        image=self.sample_image())
+        update_image_renditions(first)
+        try:
+            Textbook.objects.bulk_create([
+                Textbook(**self.listing(seller), image=first.image.name,
+                         image_renditions=first.image_renditions)
+                for _ in range(options['page_size'] - 1)
+            ])
+            page = list(Textbook.objects.filter(seller=seller).select_related(
+                'seller'
+            ).only(*TextbookSerializer.queryset_fields()))
+            self.stdout.write(f'{"mode":>12} {"p50 ms":>9} {"p95 ms":>9}')
+            for mode in ('per-request', 'precomputed'):
+                for textbook in page:
+                    textbook.image_renditions = (
+                        first.image_renditions if mode == 'precomputed' else {}
+                    )
+                p50, p95 = self.measure(page, options['runs'])
+                self.stdout.write(f'{mode:>12} {p50:>9.3f} {p95:>9.3f}')
+        finally:
+            first.image.delete_all_created_images()
+            first.image.delete(save=False)
+
+    @staticmethod
+    def listing(seller):
+        return dict(title='Matematika 1', author='Autor', school_class='1',
+                    publisher='Klett', subject='Matematika', price=500,
+                    seller=seller)
+
+    @staticmethod
+    def sample_image():
+        buffer = BytesIO()
+        Image.new('RGB', (1200, 1600), color='gray').save(buffer, 'JPEG')
+        return SimpleUploadedFile('benchmark_serialization.jpg',
+                                  buffer.getvalue(),
+                                  content_type='image/jpeg')
+
+    @staticmethod
+    def measure(page, runs):
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            TextbookSerializer(page, many=True).data
+            timings.append((time.perf_counter() - start) * 1000)
+        quantiles = statistics.quantiles(timings, n=20)
+        return statistics.median(timings), quantiles[18]
@@ -0,0 +1,212 @@
+"""
+Management command measuring how API throughput scales with the number of
+ASGI worker processes.
+
+For each --workers count it starts that many daphne processes on one
+shared listening socket (`daphne --fd`, the same layout as the supervisor
+fcgi-program in deploy/), drives --path with keep-alive HTTP/1.1
+connections from --client-processes load generator processes for
+--duration seconds and reports requests/sec, p50/p95 latency and the
+speedup over the first row.
+
+The load generators run on the same machine and take cores away from the
+workers; with C client processes, scaling is only meaningful up to
+cpu_count - C workers.
+
+Usage:
+    python manage.py benchmark_workers
+    python manage.py benchmark_workers --workers 1 2 4 8 --path /api/textbooks/
+"""
+
+import asyncio
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def default_worker_counts():
+    counts, count = [], 1
+    while count < (os.cpu_count() or 1):
+        counts.append(count)
+        count *= 2
+    return counts + [os.cpu_count() or 1]
+
+
+def drive(port, path, connections, duration):
+    """ Load generator process: (responses, errors, latencies in seconds). """
+    return asyncio.run(drive_connections(port, path, connections, duration))
+
+
+async def drive_connections(port, path, connections, duration):
+    request = (f'GET {path} HTTP/1.1\r\nHost: localhost\r\n'
+               f'Connection: keep-alive\r\n\r\n').encode('latin-1')
+    deadline = time.perf_counter() + duration
+    latencies, errors = [], 0
+
+    async def connection():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                writer.write(request)
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                for line in head.split(b'\r\n'):
+                    name, _, value = line.partition(b':')
+                    if name.lower() == b'content-length':
+                        length = int(value)
+                await reader.readexactly(length)
+                if head[9:12] != b'200':
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(connection() for _ in range(connections)))
+    return len(latencies), errors, latencies
+
+
+class Command(BaseCommand):
+    help = 'Benchmark API requests/sec against the number of ASGI workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            nargs='+',
+            type=int,
+            default=default_worker_counts(),
+            help='Worker counts to measure (default: 1, 2, 4 ... cpu count)'
+        )
+        parser.add_argument(
+            '--path',
+            default='/api/health/',
+            help='Request path (default: /api/health/)'
+        )
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=10,
+            help='Seconds of load per worker count (default: 10)'
+        )
+        parser.add_argument(
+            '--connections',
+            type=int,
+            default=64,
+            help='Keep-alive connections in total (default: 64)'
+        )
+        parser.add_argument(
+            '--client-processes',
+            type=int,
+            default=2,
+            help='Load generator processes (default: 2)'
+        )
+
+    def handle(self, *args, **options):
+        if min(options['workers']) < 1:
+            raise CommandError('--workers must be positive.')
+        clients = max(1, options['client_processes'])
+        connections = max(clients, options['connections'])
+        self.stdout.write(
+            f'{options["path"]}, {connections} connections from {clients} '
+            f'client processes, {options["duration"]:g}s per row, '
+            f'{os.cpu_count()} CPUs'
+        )
+        self.stdout.write(f'{"workers":>8} {"req/s":>9} {"p50 ms":>8} '
+                          f'{"p95 ms":>8} {"errors":>7} {"speedup":>8}')
+
+        baseline = None
+        with ProcessPoolExecutor(
+            max_workers=clients,
+            mp_context=multiprocessing.get_context('spawn')
+        ) as pool:
+            for workers in options['workers']:
+                with socket.socket() as listener, \
+                        tempfile.TemporaryDirectory() as logs:
+                    listener.setsockopt(socket.SOL_SOCKET,
+                                        socket.SO_REUSEADDR, 1)
+                    listener.bind(('127.0.0.1', 0))
+                    listener.listen(1024)
+                    port = listener.getsockname()[1]
+                    processes = self.start_workers(listener, workers, logs)
+                    try:
+                        # a short run warms up every worker before measuring
+                        self.load(pool, port, options['path'], clients,
+                                  connections, min(2, options['duration']))
+                        requests, errors, latencies = self.load(
+                            pool, port, options['path'], clients,
+                            connections, options['duration']
+                        )
+                    finally:
+                        self.stop_workers(processes)
+
+                if not latencies:
+                    raise CommandError(f'No responses from {workers} workers.')
+                rate = requests / options['duration']
+                baseline = baseline or rate
+                p50, p95 = (statistics.quantiles(latencies, n=20)[i] * 1000
+                            for i in (9, 18))
+                self.stdout.write(
+                    f'{workers:>8} {rate:>9.0f} {p50:>8.1f} {p95:>8.1f} '
+                    f'{errors:>7} {rate / baseline:>7.2f}x'
+                )
+
+    @staticmethod
+    def load(pool, port, path, clients, connections, duration):
+        per_client = [connections // clients + (i < connections % clients)
+                      for i in range(clients)]
+        futures = [pool.submit(drive, port, path, count, duration)
+                   for count in per_client]
+        requests, errors, latencies = 0, 0, []
+        for future in futures:
+            count, failed, times = future.result()
+            requests += count
+            errors += failed
+            latencies += times
+        return requests, errors, latencies
+
+    @staticmethod
+    def start_workers(listener, workers, logs):
+        """ `workers` daphne processes accepting on `listener`, started and
+        listening. DJANGO_SETTINGS_MODULE is inherited. """
+        fd = listener.fileno()
+        processes = []
+        for index in range(workers):
+            log = open(os.path.join(logs, f'worker{index}.log'), 'wb')
+            processes.append((subprocess.Popen(
+                [sys.executable, '-m', 'daphne', '--fd', str(fd),
+                 '--access-log', os.devnull,
+                 'textbook_marketplace.asgi:application'],
+                pass_fds=[fd], stdout=subprocess.DEVNULL, stderr=log
+            ), log))
+
+        deadline = time.monotonic() + 60
+        for process, log in processes:
+            while b'Listening on' not in open(log.name, 'rb').read():
+                if process.poll() is not None or time.monotonic() > deadline:
+                    Command.stop_workers(processes)
+                    raise CommandError(
+                        f'Worker did not start:\n{open(log.name).read()}'
+                    )
+                time.sleep(0.1)
+        return processes
+
+    @staticmethod
+    def stop_workers(processes):
+        for process, _ in processes:
+            process.terminate()
+        for process, log in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
@@ -0,0 +1,39 @@
+"""
+Management command filling Textbook.image_renditions for existing rows.
+
+New uploads get their renditions on save; run this once after deploying
+the column, and with --all after changing MEDIA_HOST or the 'marketplace'
+rendition key set.
+
+Usage:
+    python manage.py build_image_renditions
+    python manage.py build_image_renditions --all
+"""
+
+from django.core.management.base import BaseCommand
+
+from marketplace.images import update_image_renditions
+from marketplace.models import Textbook
+
+
+class Command(BaseCommand):
+    help = 'Precompute image rendition URLs of textbooks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Rebuild every row, not only rows without renditions'
+        )
+
+    def handle(self, *args, **options):
+        textbooks = Textbook.objects.exclude(image='').exclude(image=None)
+        if not options['all']:
+            textbooks = textbooks.filter(image_renditions={})
+        updated = 0
+        for textbook in textbooks.only('id', 'image').iterator():
+            update_image_renditions(textbook)
+            updated += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendition URLs stored for {updated} textbooks.'
+        ))
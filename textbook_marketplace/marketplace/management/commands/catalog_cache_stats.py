@@ -0,0 +1,33 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from marketplace.caching import (
+    HITS_KEY,
+    MISSES_KEY,
+    cache_metrics,
+    catalog_cache_enabled,
+)
+
+
+class Command(BaseCommand):
+    help = 'Show hit/miss counters of the anonymous catalog response cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Reset the counters after printing them'
+        )
+
+    def handle(self, *args, **options):
+        metrics = cache_metrics()
+        total = metrics['hits'] + metrics['misses']
+        ratio = metrics['hits'] / total if total else 0
+        state = 'enabled' if catalog_cache_enabled() else 'disabled'
+        self.stdout.write(f'Catalog cache: {state}')
+        self.stdout.write(f'Hits: {metrics["hits"]}')
+        self.stdout.write(f'Misses: {metrics["misses"]}')
+        self.stdout.write(f'Hit ratio: {ratio:.1%}')
+        if options['reset']:
+            cache.delete_many([HITS_KEY, MISSES_KEY])
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
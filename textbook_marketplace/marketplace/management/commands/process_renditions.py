@@ -0,0 +1,181 @@
+"""
+Management command running the textbook image rendition worker.
+
+Textbooks whose image changed are marked 'pending' (see
+marketplace.images.request_image_renditions); the pending rows are the
+queue. The worker claims a batch with SELECT ... FOR UPDATE SKIP LOCKED,
+so several workers can share the queue, and marks it 'processing' in a
+short transaction. It then builds the renditions on a process pool outside
+any transaction, so sellers can edit the rows meanwhile, and stores each
+textbook's URLs with state 'ready' (or 'failed' after retries) in an
+update of its own. A result is dropped if the row was queued again in
+between, e.g. for a new image. Rows of a worker that died stay
+'processing' and are claimed again after --claim-timeout seconds.
+
+Usage:
+    python manage.py process_renditions
+    python manage.py process_renditions --workers 4 --poll-interval 2
+    python manage.py process_renditions --once --workers 0
+    python manage.py process_renditions --claim-timeout 300
+"""
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from marketplace.caching import bump_generations
+from marketplace.images import build_renditions
+from marketplace.models import Textbook
+from marketplace.signals import catalog_namespaces
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Build pending textbook image renditions on a local process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=2,
+            help='Pool processes; 0 builds renditions in this process'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Rows claimed per transaction (default: 2 per worker)'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the queue is empty'
+        )
+        parser.add_argument(
+            '--claim-timeout',
+            type=float,
+            default=600,
+            help='Seconds after which rows claimed by a worker that did not '
+                 'finish are claimed again'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit when the queue is empty'
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Queue failed rows again before starting'
+        )
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            Textbook.objects.filter(
+                image_renditions_state=Textbook.RENDITIONS_FAILED
+            ).update(image_renditions_state=Textbook.RENDITIONS_PENDING)
+        workers = options['workers']
+        batch_size = options['batch_size'] or max(workers, 1) * 2
+
+        pool = None
+        if workers > 0:
+            # spawn, not fork: children must not inherit database sockets
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+        processed = 0
+        try:
+            while True:
+                count = self.process_batch(pool, batch_size,
+                                           options['claim_timeout'])
+                processed += count
+                if count:
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        self.stdout.write(f'Processed {processed} textbooks.')
+
+    @staticmethod
+    def claim_batch(batch_size, claim_timeout):
+        """ Pending rows, and rows claimed more than `claim_timeout` seconds
+        ago, marked 'processing' by this worker. """
+        now = timezone.now()
+        stale = now - timedelta(seconds=claim_timeout)
+        queued = (
+            Q(image_renditions_state=Textbook.RENDITIONS_PENDING) |
+            Q(image_renditions_state=Textbook.RENDITIONS_PROCESSING,
+              image_renditions_claimed_at__lt=stale)
+        )
+        with transaction.atomic():
+            batch = list(
+                Textbook.objects.select_for_update(skip_locked=True)
+                .filter(queued)
+                .only('id', 'image', 'school_class', 'condition')
+                .order_by('id')[:batch_size]
+            )
+            Textbook.objects.filter(
+                pk__in=[textbook.pk for textbook in batch]
+            ).update(
+                image_renditions_state=Textbook.RENDITIONS_PROCESSING,
+                image_renditions_claimed_at=now,
+            )
+        return batch
+
+    @classmethod
+    def process_batch(cls, pool, batch_size, claim_timeout=600):
+        batch = cls.claim_batch(batch_size, claim_timeout)
+        if not batch:
+            return 0
+        if pool is None:
+            jobs = [(textbook, None) for textbook in batch]
+        else:
+            jobs = [(textbook, pool.submit(build_renditions, textbook.pk,
+                                           textbook.image.name))
+                    for textbook in batch]
+
+        names = {'list'}
+        for textbook, job in jobs:
+            try:
+                renditions = (
+                    job.result() if job is not None
+                    else build_renditions(textbook.pk, textbook.image.name)
+                )
+                state = Textbook.RENDITIONS_READY
+            except Exception:
+                logger.exception('Renditions of textbook %s failed',
+                                 textbook.pk)
+                renditions, state = {}, Textbook.RENDITIONS_FAILED
+            # only while the row is still ours and shows the same image;
+            # updated_at moves so ETags of the textbook change as well
+            Textbook.objects.filter(
+                pk=textbook.pk,
+                image=textbook.image.name,
+                image_renditions_state=Textbook.RENDITIONS_PROCESSING,
+            ).update(
+                image_renditions=renditions,
+                image_renditions_state=state,
+                image_renditions_claimed_at=None,
+                updated_at=timezone.now(),
+            )
+            names |= {f'textbook:{textbook.pk}',
+                      *catalog_namespaces(textbook)}
+        bump_generations(names)
+        return len(batch)
@@ -0,0 +1,61 @@
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# The 'simple' configuration must match marketplace.filters.SEARCH_CONFIG.
+CREATE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION marketplace_textbook_search_vector_update()
+RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(NEW.author, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(NEW.subject, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(NEW.publisher, '')), 'C') ||
+        setweight(to_tsvector('simple', coalesce(NEW.description, '')), 'D');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS marketplace_textbook_search_vector_trigger
+    ON marketplace_textbook;
+CREATE TRIGGER marketplace_textbook_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, author, subject, publisher, description
+    ON marketplace_textbook
+    FOR EACH ROW EXECUTE FUNCTION marketplace_textbook_search_vector_update();
+"""
+
+DROP_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS marketplace_textbook_search_vector_trigger
+    ON marketplace_textbook;
+DROP FUNCTION IF EXISTS marketplace_textbook_search_vector_update();
+"""
+
+
+def create_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(CREATE_TRIGGER_SQL)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(DROP_TRIGGER_SQL)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("marketplace", "0008_wishlist"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="textbook",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
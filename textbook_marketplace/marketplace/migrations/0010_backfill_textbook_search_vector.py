@@ -0,0 +1,64 @@
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+
+BATCH_SIZE = 1000
+
+INDEX_NAME = "marketplace_textbook_search_vector_gin"
+
+
+def backfill_search_vector(apps, schema_editor):
+    """ Fills search_vector for existing rows in pk batches, so each
+    batch commits on its own and no long lock is held on the table. """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Textbook = apps.get_model("marketplace", "Textbook")
+    vector = (
+        SearchVector('title', weight='A', config='simple') +
+        SearchVector('author', weight='B', config='simple') +
+        SearchVector('subject', weight='B', config='simple') +
+        SearchVector('publisher', weight='C', config='simple') +
+        SearchVector('description', weight='D', config='simple')
+    )
+    last_pk = 0
+    while True:
+        batch = list(
+            Textbook.objects.filter(pk__gt=last_pk)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        Textbook.objects.filter(pk__in=batch).update(search_vector=vector)
+        last_pk = batch[-1]
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDEX_NAME} "
+        f"ON marketplace_textbook USING gin (search_vector)"
+    )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+
+
+class Migration(migrations.Migration):
+    # Batches commit separately and CREATE INDEX CONCURRENTLY cannot run
+    # inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ("marketplace", "0009_textbook_search_vector"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_search_vector,
+                             migrations.RunPython.noop),
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,57 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+# Expression indexes over UPPER(column::text) match the SQL Django emits for
+# icontains on PostgreSQL, so both the icontains filters and the fuzzy
+# (trigram_word_similar) mode in TextbookFilter can use them.
+TRIGRAM_INDEXES = [
+    ('marketplace_textbook_author_trgm', 'marketplace_textbook', 'author'),
+    ('marketplace_textbook_publisher_trgm', 'marketplace_textbook', 'publisher'),
+    ('marketplace_textbook_subject_trgm', 'marketplace_textbook', 'subject'),
+    ('marketplace_user_username_trgm', 'marketplace_user', 'username'),
+]
+
+
+class PostgresTrigramExtension(TrigramExtension):
+    """ TrigramExtension whose reverse skips other databases too, as its
+    forward step does; Django's queries pg_extension on any vendor. """
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        super().database_backwards(app_label, schema_editor, from_state,
+                                   to_state)
+
+
+def create_trigram_indexes(apps, schema_editor, concurrently=True):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    concurrently = 'CONCURRENTLY ' if concurrently else ''
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} '
+            f'USING gin ((UPPER({column}::text)) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _, _ in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ("marketplace", "0010_backfill_textbook_search_vector"),
+    ]
+
+    operations = [
+        PostgresTrigramExtension(),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
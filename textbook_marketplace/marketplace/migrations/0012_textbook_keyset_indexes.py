@@ -0,0 +1,29 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0011_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='textbook',
+            name='marketplace_price_7c20cf_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='textbook',
+            name='marketplace_created_dabe9d_idx',
+        ),
+        migrations.AddIndex(
+            model_name='textbook',
+            index=models.Index(fields=['price', 'id'], name='marketplace_price_799e44_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='textbook',
+            index=models.Index(fields=['-created_at', '-id'], name='marketplace_created_9e2d6b_idx'),
+        ),
+    ]
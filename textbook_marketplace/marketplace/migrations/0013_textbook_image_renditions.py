@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0012_textbook_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textbook',
+            name='image_renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
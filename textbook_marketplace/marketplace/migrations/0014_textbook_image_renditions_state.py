@@ -0,0 +1,22 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0013_textbook_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textbook',
+            name='image_renditions_state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', editable=False, max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='textbook',
+            index=models.Index(condition=models.Q(('image_renditions_state', 'pending')), fields=['id'], name='textbook_renditions_pending'),
+        ),
+    ]
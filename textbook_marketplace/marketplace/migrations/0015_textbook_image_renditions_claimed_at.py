@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-17 06:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0014_textbook_image_renditions_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textbook',
+            name='image_renditions_claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='textbook',
+            name='image_renditions_state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', editable=False, max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='textbook',
+            index=models.Index(condition=models.Q(('image_renditions_state', 'processing')), fields=['image_renditions_claimed_at'], name='textbook_renditions_claimed'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.contrib.postgres.search import SearchVectorField
 from versatileimagefield.fields import VersatileImageField
 from django.contrib.auth.models import AbstractUser, AnonymousUser
 
@@ -27,6 +28,17 @@ class Textbook(models.Model):
         ('Used - Fair', 'Used - Fair'),
     ]
 
+    RENDITIONS_PENDING = 'pending'
+    RENDITIONS_PROCESSING = 'processing'
+    RENDITIONS_READY = 'ready'
+    RENDITIONS_FAILED = 'failed'
+    RENDITIONS_STATE_CHOICES = [
+        (RENDITIONS_PENDING, 'Pending'),
+        (RENDITIONS_PROCESSING, 'Processing'),
+        (RENDITIONS_READY, 'Ready'),
+        (RENDITIONS_FAILED, 'Failed'),
+    ]
+
     title = models.CharField(max_length=255)
     author = models.CharField(max_length=255)
     school_class = models.CharField(max_length=50, db_index=True) 
@@ -42,14 +54,40 @@ class Textbook(models.Model):
     phone_contact = models.CharField(max_length=100, blank=True, null=True)
     condition = models.CharField(max_length=50, choices=CONDITION_CHOICES, default='Used - Good')
     image = VersatileImageField(upload_to='textbook_images/', blank=True, null=True)
+    # Absolute URLs of the 'marketplace' renditions, set when the image
+    # changes (see marketplace.images) so serializers don't resolve them.
+    image_renditions = models.JSONField(default=dict, blank=True,
+                                        editable=False)
+    # Pending rows form the queue of the process_renditions worker.
+    image_renditions_state = models.CharField(
+        max_length=10, choices=RENDITIONS_STATE_CHOICES,
+        default=RENDITIONS_READY, editable=False
+    )
+    # When a worker claimed the row ('processing'), to requeue rows of
+    # workers that died
+    image_renditions_claimed_at = models.DateTimeField(null=True, blank=True,
+                                                       editable=False)
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)  
     updated_at = models.DateTimeField(auto_now=True) 
+    # Maintained by a PostgreSQL trigger (see migration 0009), GIN-indexed.
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         indexes = [
-            models.Index(fields=['price']),
+            # Keyset pagination sort keys, see marketplace.pagination
+            models.Index(fields=['price', 'id']),
             models.Index(fields=['condition']),
-            models.Index(fields=['-created_at']),
+            models.Index(fields=['-created_at', '-id']),
+            models.Index(
+                fields=['id'],
+                condition=models.Q(image_renditions_state='pending'),
+                name='textbook_renditions_pending',
+            ),
+            models.Index(
+                fields=['image_renditions_claimed_at'],
+                condition=models.Q(image_renditions_state='processing'),
+                name='textbook_renditions_claimed',
+            ),
         ]
 
     def __str__(self):
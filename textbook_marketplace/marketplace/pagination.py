@@ -0,0 +1,313 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .caching import queryset_signature
+
+
+class EstimatedCountPagination(LimitOffsetPagination):
+    """ Limit/offset pagination that avoids an exact COUNT(*) per page.
+
+    Unfiltered lists over large tables report the planner estimate from
+    pg_class.reltuples. Other counts are exact but cached for a short TTL,
+    keyed on the SQL of the filtered queryset, so the same filter set is
+    counted once per TTL instead of on every page. Responses carry
+    `count_exact` to tell the two apart.
+    """
+    count_cache_timeout = getattr(settings, 'PAGINATION_COUNT_CACHE_TIMEOUT', 30)
+    # Below this many rows an exact count is cheap and estimates are coarse.
+    count_estimate_threshold = getattr(
+        settings, 'PAGINATION_COUNT_ESTIMATE_THRESHOLD', 10_000
+    )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        self.count = self.get_count(queryset)
+        self.offset = self.get_offset(request)
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+
+        if self.count_exact:
+            if self.count == 0 or self.offset > self.count:
+                return []
+            return list(queryset[self.offset:self.offset + self.limit])
+
+        # An estimate may be off in either direction, so look one row ahead
+        # instead of trusting it to stop paging. A page that reaches the end
+        # of the table tells us the real count.
+        results = list(queryset[self.offset:self.offset + self.limit + 1])
+        if len(results) > self.limit:
+            self.count = max(self.count, self.offset + len(results))
+        elif results or self.offset == 0:
+            self.count = self.offset + len(results)
+            self.count_exact = True
+        return results[:self.limit]
+
+    def get_paginated_response(self, data):
+        return Response({
+            'count': self.count,
+            'count_exact': self.count_exact,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties']['count_exact'] = {
+            'type': 'boolean',
+            'description': 'False when count is a planner estimate.',
+        }
+        return response_schema
+
+    def get_count(self, queryset):
+        self.count_exact = True
+        if not queryset.query.has_filters():
+            estimate = self.estimate_count(queryset)
+            if estimate is not None and estimate >= self.count_estimate_threshold:
+                self.count_exact = False
+                return estimate
+        signature = queryset_signature(queryset)
+        if signature is None:
+            return 0
+        key = f'pagination:count:{signature}'
+        count = cache.get(key)
+        if count is None:
+            count = super().get_count(queryset)
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    @staticmethod
+    def estimate_count(queryset):
+        """ Row estimate of the model table, None when unavailable. """
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                [queryset.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+        # reltuples is -1 for a table that was never vacuumed or analyzed
+        if row is None or row[0] < 0:
+            return None
+        return int(row[0])
+
+
+class TextbookPagination(EstimatedCountPagination):
+    """ Keyset (cursor) pagination for the textbook listing.
+
+    Pages are fetched with a WHERE on the sort key instead of OFFSET, so
+    every page costs the same regardless of depth, and the total count is
+    only computed when asked for (?include_count=true). Cursors are opaque
+    base64 tokens holding the sort key of the boundary row.
+
+    Legacy limit/offset pagination is used when the request carries
+    ?pagination=offset or an offset parameter, and for ranked ?query=
+    searches without an explicit ordering, which keep relevance order.
+    """
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    count_query_param = 'include_count'
+    mode_query_param = 'pagination'
+    invalid_cursor_message = 'Invalid cursor'
+    # Every ordering ends with the primary key so the sort key is unique.
+    orderings = {
+        '-created_at': ('-created_at', '-id'),
+        'created_at': ('created_at', 'id'),
+        'price': ('price', 'id'),
+        '-price': ('-price', '-id'),
+    }
+    default_ordering = '-created_at'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_cursor = self.is_cursor_request(request)
+        if not self.use_cursor:
+            ordering = request.query_params.get(self.ordering_query_param)
+            if ordering in self.orderings:
+                queryset = queryset.order_by(*self.orderings[ordering])
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.ordering = self.orderings.get(
+            request.query_params.get(self.ordering_query_param),
+            self.orderings[self.default_ordering]
+        )
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'true':
+            self.count = self.get_count(queryset)
+
+        position, reverse = self.decode_cursor(request, queryset.model)
+        ordering = self.ordering
+        if reverse:
+            ordering = tuple(self.invert(field) for field in ordering)
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(ordering, position))
+
+        results = list(queryset[:self.limit + 1])
+        has_more = len(results) > self.limit
+        results = results[:self.limit]
+        if reverse:
+            results.reverse()
+
+        # Moving backwards we always came from a page that follows this one;
+        # moving forwards there is a previous page whenever we had a cursor.
+        if reverse:
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super().get_paginated_response(data)
+        response = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count is not None:
+            response = {'count': self.count,
+                        'count_exact': self.count_exact,
+                        **response}
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['required'] = ['results']
+        for field in ('count', 'count_exact'):
+            response_schema['properties'][field]['description'] = (
+                'Present in cursor mode only with include_count=true.'
+            )
+        return response_schema
+
+    def get_schema_operation_parameters(self, view):
+        parameters = super().get_schema_operation_parameters(view)
+        parameters.extend([
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Opaque cursor from a previous next/previous link.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.ordering_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Sort order (default: -created_at).',
+                'schema': {'type': 'string', 'enum': list(self.orderings)},
+            },
+            {
+                'name': self.count_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Include the total count in cursor mode.',
+                'schema': {'type': 'boolean'},
+            },
+            {
+                'name': self.mode_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Set to "offset" for legacy limit/offset pages.',
+                'schema': {'type': 'string', 'enum': ['cursor', 'offset']},
+            },
+        ])
+        return parameters
+
+    def is_cursor_request(self, request):
+        params = request.query_params
+        if (params.get(self.mode_query_param) == 'offset'
+                or self.offset_query_param in params):
+            return False
+        if 'query' in params and self.ordering_query_param not in params:
+            return False
+        return True
+
+    def get_next_link(self):
+        if not self.use_cursor:
+            return super().get_next_link()
+        if not self.has_next or not self.page:
+            return None
+        return self.cursor_link(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.use_cursor:
+            return super().get_previous_link()
+        if not self.has_previous or not self.page:
+            return None
+        return self.cursor_link(self.page[0], reverse=True)
+
+    def cursor_link(self, instance, reverse):
+        position = [self.field_value(instance, field)
+                    for field in self.ordering]
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.count_query_param)
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(position, reverse))
+
+    @staticmethod
+    def field_value(instance, field):
+        value = getattr(instance, field.lstrip('-'))
+        if isinstance(value, int):
+            return value
+        return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def after(ordering, position):
+        """ Rows strictly after `position` in `ordering` (key, id).
+
+        The non-strict bound on the leading column lets the database start
+        the index scan at the cursor; the OR only removes ties before it. """
+        (field, pk_field), (value, pk) = ordering, position
+        name, pk_name = field.lstrip('-'), pk_field.lstrip('-')
+        op = 'lt' if field.startswith('-') else 'gt'
+        return Q(**{f'{name}__{op}e': value}) & (
+            Q(**{f'{name}__{op}': value}) | Q(**{f'{pk_name}__{op}': pk})
+        )
+
+    def encode_cursor(self, position, reverse):
+        token = json.dumps({'p': position, 'r': int(reverse)},
+                           separators=(',', ':'))
+        return urlsafe_b64encode(token.encode()).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, request, model):
+        """ Returns (position, reverse); position is None without a cursor. """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            token = json.loads(urlsafe_b64decode(padded.encode('ascii')))
+            value, pk = token['p']
+            model_field = model._meta.get_field(self.ordering[0].lstrip('-'))
+            position = (model_field.to_python(value), int(pk))
+            reverse = bool(token.get('r'))
+        except (BinasciiError, UnicodeError, KeyError, TypeError,
+                ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
@@ -1,25 +1,39 @@
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 from django.contrib.auth import get_user_model
 
+from .images import TEXTBOOK_RENDITIONS, interim_renditions, rendition_urls
 from .models import Textbook, Order, Report, Wishlist
 from versatileimagefield.serializers import VersatileImageFieldSerializer
-from django.conf import settings
-from urllib.parse import urljoin
 import bleach
 
 
 class AbsoluteVersatileImageFieldSerializer(VersatileImageFieldSerializer):
+    """ Rendition URLs prefixed with MEDIA_HOST.
+
+    With `renditions_field`, URLs precomputed on the instance (see
+    marketplace.images) are returned as they are, and stand-in URLs while
+    its `<renditions_field>_state` is pending or failed. They are only
+    resolved here for rows that predate precomputed renditions. """
+
+    def __init__(self, sizes, *args, renditions_field=None, **kwargs):
+        self.renditions_field = renditions_field
+        super().__init__(sizes, *args, **kwargs)
+
     def to_representation(self, value):
-        data = super().to_representation(value)
-        if isinstance(data, dict):
-            return {
-                key: urljoin(settings.MEDIA_HOST, url)
-                for key, url in data.items()
-            }
-        return data
+        if self.renditions_field and value:
+            instance = value.instance
+            renditions = getattr(instance, self.renditions_field, None)
+            if renditions:
+                return renditions
+            state = getattr(instance, f'{self.renditions_field}_state',
+                            Textbook.RENDITIONS_READY)
+            if state != Textbook.RENDITIONS_READY:
+                return interim_renditions(value, state, self.sizes)
+        return rendition_urls(value, self.sizes)
 
 
 User = get_user_model()
@@ -27,7 +41,9 @@ User = get_user_model()
 
 class TextbookSerializer(serializers.ModelSerializer):
     seller = serializers.ReadOnlyField(source='seller.username')
-    image = AbsoluteVersatileImageFieldSerializer(sizes='marketplace')
+    image = AbsoluteVersatileImageFieldSerializer(
+        sizes=TEXTBOOK_RENDITIONS, renditions_field='image_renditions'
+    )
     price = serializers.DecimalField(
         max_digits=6,
         decimal_places=2,
@@ -36,7 +52,20 @@ class TextbookSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Textbook
-        fields = '__all__'
+        # image_renditions(_state) are emitted through the image field;
+        # image_renditions_claimed_at is process_renditions' bookkeeping
+        exclude = ['search_vector', 'image_renditions',
+                   'image_renditions_state', 'image_renditions_claimed_at']
+
+    @classmethod
+    def queryset_fields(cls, prefix=''):
+        """ Columns the serializer reads, for QuerySet.only(). The queryset
+        must select_related the seller (prefixed the same way). """
+        names = [field.name for field in Textbook._meta.concrete_fields
+                 if field.name not in cls.Meta.exclude]
+        names.extend(['image_renditions', 'image_renditions_state',
+                      'seller__username'])
+        return [prefix + name for name in names]
     
     def validate_description(self, value):
         # Sanitize HTML/XSS
@@ -69,6 +98,18 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'date_joined']
 
 
+class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """ Adds the username to the token claims (refreshed access tokens copy
+    it), so websocket handshakes can skip the user lookup
+    (CHAT_WS_AUTH_FROM_CLAIMS). """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['username'] = user.username
+        return token
+
+
 class SignupSerializer(serializers.ModelSerializer):
     email = serializers.EmailField(required=True)
     
@@ -0,0 +1,51 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .caching import NAMESPACED_FILTERS, bump_generations
+from .images import request_image_renditions
+from .models import Textbook
+
+
+def catalog_namespaces(instance):
+    # __dict__ rather than getattr so deferred fields are not loaded
+    return {f'{field}:{instance.__dict__[field]}'
+            for field in NAMESPACED_FILTERS if field in instance.__dict__}
+
+
+@receiver(post_init, sender=Textbook)
+def remember_loaded_state(sender, instance, **kwargs):
+    """ Keeps the namespaces the row was loaded under, so moving a textbook
+    to another school class also invalidates listings of the old one, and
+    the image name, to spot a new upload on save. """
+    instance._catalog_namespaces = catalog_namespaces(instance)
+    instance._image_name = image_name(instance)
+
+
+def image_name(instance):
+    # None when the image column was deferred and never loaded
+    image = instance.__dict__.get('image')
+    return getattr(image, 'name', image)
+
+
+@receiver(post_save, sender=Textbook)
+def queue_image_renditions(sender, instance, **kwargs):
+    """ Queues renditions once per uploaded image instead of resolving them
+    on every serialization. """
+    if 'image' not in instance.__dict__:
+        return
+    name = image_name(instance)
+    renditions = instance.__dict__.get('image_renditions')
+    state = instance.__dict__.get('image_renditions_state')
+    if name != instance._image_name or (
+            name and not renditions and state == Textbook.RENDITIONS_READY):
+        request_image_renditions(instance)
+    instance._image_name = name
+
+
+@receiver([post_save, post_delete], sender=Textbook)
+def invalidate_catalog_cache(sender, instance, **kwargs):
+    names = {'list', f'textbook:{instance.pk}',
+             *instance._catalog_namespaces, *catalog_namespaces(instance)}
+    instance._catalog_namespaces = catalog_namespaces(instance)
+    transaction.on_commit(lambda: bump_generations(names))
@@ -1,12 +1,21 @@
+import importlib
 import json
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from PIL import Image
-from io import BytesIO
+from io import BytesIO, StringIO
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
 from django.urls import reverse
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, transaction
+from django.http import Http404
+from django.utils import timezone
 
 from rest_framework.exceptions import ErrorDetail
 from rest_framework.response import Response
@@ -17,14 +26,34 @@ from rest_framework.test import (
 )
 # from rest_framework.permissions import IsAuthenticatedOrReadOnly
 
-from .models import Textbook, Block
+from .caching import generation_key, generation_timeout
+from .filters import TextbookFilter
+from .images import request_image_renditions, supported_formats
+from .management.commands import process_renditions
+from .models import Textbook, Block, Wishlist
+from .pagination import EstimatedCountPagination
 from .views import TextbookViewSet, IsAuthenticatedOrReadOnly
+from textbook_marketplace.media import MediaFilesApp, serve_media
 
 # TODO consider reworking model creation with model_bakery library
 # TODO mock db if possible in the future
 User = get_user_model()
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Cached counts, facets and responses must not leak between tests
+    cache.clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def media_root(settings, tmp_path):
+    # Uploads and their renditions go to a directory of each test's own
+    settings.MEDIA_ROOT = str(tmp_path)
+    yield
+
+
 @pytest.fixture
 def seller() -> User:
     yield User.objects.create_user(id=1,
@@ -129,7 +158,9 @@ def test_textbooks_retrieve_success(seller: User,
     assert response.status_code == 200
     data = response.data['results']
     assert len(data) == 3
-    test_textbook = data[0]
+    # newest first
+    assert [textbook['id'] for textbook in data] == [3, 2, 1]
+    test_textbook = data[-1]
     assert test_textbook['id'] == 1
     assert test_textbook['seller'] == seller.username
     assert test_textbook['title'] == 'Mathematics 101'
@@ -141,6 +172,490 @@ def test_textbooks_retrieve_success(seller: User,
             'A comprehensive guide to mathematics.')
 
 
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbooks_cursor_pagination_success(textbook1: Textbook,
+                                             textbook2: Textbook,
+                                             textbook3: Textbook,
+                                             client: APIClient):
+    response: Response = client.get(reverse('textbook-list'),
+                                    data={'limit': 2})
+    assert response.status_code == 200
+    assert 'count' not in response.data
+    assert response.data['previous'] is None
+    assert [t['id'] for t in response.data['results']] == [3, 2]
+
+    response = client.get(response.data['next'])
+    assert response.status_code == 200
+    assert [t['id'] for t in response.data['results']] == [1]
+    assert response.data['next'] is None
+
+    response = client.get(response.data['previous'])
+    assert [t['id'] for t in response.data['results']] == [3, 2]
+    assert response.data['previous'] is None
+    assert response.data['next']
+
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbooks_cursor_pagination_price_ordering(textbook1: Textbook,
+                                                    textbook2: Textbook,
+                                                    textbook3: Textbook,
+                                                    client: APIClient):
+    response: Response = client.get(reverse('textbook-list'),
+                                    data={'limit': 2, 'ordering': '-price',
+                                          'include_count': 'true'})
+    assert response.data['count'] == 3
+    assert [t['price'] for t in response.data['results']] == ['49.99',
+                                                              '39.99']
+    response = client.get(response.data['next'])
+    assert 'count' not in response.data
+    assert [t['price'] for t in response.data['results']] == ['29.99']
+
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbooks_offset_pagination_flag(textbook1: Textbook,
+                                          textbook2: Textbook,
+                                          textbook3: Textbook,
+                                          client: APIClient):
+    response: Response = client.get(reverse('textbook-list'),
+                                    data={'limit': 2, 'offset': 2})
+    assert response.status_code == 200
+    assert response.data['count'] == 3
+    assert len(response.data['results']) == 1
+
+    response = client.get(reverse('textbook-list'),
+                          data={'limit': 2, 'pagination': 'offset'})
+    assert response.data['count'] == 3
+    assert 'offset=2' in response.data['next']
+
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbooks_count_cached_per_filter_set(textbook1: Textbook,
+                                               textbook2: Textbook,
+                                               client: APIClient,
+                                               django_assert_num_queries):
+    params = {'pagination': 'offset', 'condition': 'New'}
+    response: Response = client.get(reverse('textbook-list'), data=params)
+    assert response.data['count'] == 1
+    assert response.data['count_exact'] is True
+    # second page of the same filter set: only the page query runs
+    with django_assert_num_queries(1):
+        response = client.get(reverse('textbook-list'),
+                              data={**params, 'offset': 1})
+    assert response.data['count'] == 1
+
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbooks_count_estimated_when_unfiltered(textbook1: Textbook,
+                                                   textbook2: Textbook,
+                                                   textbook3: Textbook,
+                                                   client: APIClient,
+                                                   monkeypatch):
+    if connection.vendor != 'postgresql':
+        pytest.skip('Count estimates require PostgreSQL.')
+    monkeypatch.setattr(EstimatedCountPagination,
+                        'count_estimate_threshold', 0)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE marketplace_textbook')
+    response: Response = client.get(reverse('textbook-list'),
+                                    data={'pagination': 'offset', 'limit': 1})
+    assert response.data['count_exact'] is False
+    assert response.data['count'] >= 2
+    assert response.data['next']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_database_pool_shared_across_threads():
+    if connection.vendor != 'postgresql' or connection.pool is None:
+        pytest.skip('Connection pooling requires PostgreSQL with DB_POOL.')
+
+    def backend_pid(_):
+        # what every database_sync_to_async call does on its executor thread
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT pg_backend_pid()')
+            pid = cursor.fetchone()[0]
+        connections['default'].close()
+        return pid
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pids = set(executor.map(backend_pid, range(64)))
+    assert len(pids) <= connection.pool.max_size
+
+
+@pytest.mark.django_db
+def test_textbooks_invalid_cursor(client: APIClient):
+    response: Response = client.get(reverse('textbook-list'),
+                                    data={'cursor': 'not-a-cursor'})
+    assert response.status_code == 404
+
+
+@pytest.fixture
+def many_sellers_textbooks(test_image) -> list[Textbook]:
+    textbooks = []
+    for i in range(5):
+        seller = User.objects.create_user(username=f'many_seller_{i}',
+                                          password='password',
+                                          is_seller=True)
+        textbooks.append(Textbook.objects.create(
+            title=f'Textbook {i}', author='Author', school_class='1',
+            publisher='Publisher', subject='Subject', price=10 + i,
+            seller=seller, image=test_image,
+        ))
+    yield textbooks
+
+
+def assert_pruned_textbook_query(sql: str):
+    """ Sellers are joined in, and unused columns are not loaded. """
+    assert 'JOIN "marketplace_user"' in sql
+    assert '"search_vector"' not in sql
+    assert '"marketplace_user"."password"' not in sql
+
+
+@pytest.mark.django_db
+def test_textbooks_list_single_query(many_sellers_textbooks: list,
+                                     client: APIClient,
+                                     django_assert_num_queries):
+    with django_assert_num_queries(1) as captured:
+        response: Response = client.get(reverse('textbook-list'))
+    assert response.status_code == 200
+    assert {t['seller'] for t in response.data['results']} == {
+        f'many_seller_{i}' for i in range(5)
+    }
+    assert_pruned_textbook_query(captured.captured_queries[0]['sql'])
+
+
+@pytest.mark.django_db
+def test_textbook_detail_single_query(many_sellers_textbooks: list,
+                                      client: APIClient,
+                                      django_assert_num_queries):
+    textbook = many_sellers_textbooks[0]
+    with django_assert_num_queries(1) as captured:
+        response: Response = client.get(reverse('textbook-detail',
+                                                kwargs={'pk': textbook.pk}))
+    assert response.data['seller'] == 'many_seller_0'
+    assert_pruned_textbook_query(captured.captured_queries[0]['sql'])
+
+    with django_assert_num_queries(1) as captured:
+        # TextbookViewSet.retrieve; its route name is shadowed by the view
+        response = client.get(f'/api/textbooks/{textbook.pk}/')
+    assert response.data['seller'] == 'many_seller_0'
+    assert_pruned_textbook_query(captured.captured_queries[0]['sql'])
+
+
+@pytest.mark.django_db
+def test_wishlist_single_query(user1: User,
+                               many_sellers_textbooks: list,
+                               client: APIClient,
+                               django_assert_num_queries):
+    for textbook in many_sellers_textbooks:
+        Wishlist.objects.create(user=user1, textbook=textbook)
+    client.force_authenticate(user=user1)
+    with django_assert_num_queries(1) as captured:
+        response: Response = client.get(reverse('wishlist-list'))
+    assert len(response.data) == 5
+    assert response.data[0]['textbook']['seller'].startswith('many_seller_')
+    assert_pruned_textbook_query(captured.captured_queries[0]['sql'])
+
+
+@pytest.mark.django_db
+def test_textbook_facets_success(textbook1: Textbook,
+                                 textbook2: Textbook,
+                                 textbook3: Textbook,
+                                 client: APIClient,
+                                 django_assert_num_queries):
+    with django_assert_num_queries(1):
+        response: Response = client.get(reverse('textbook-facets'))
+    assert response.status_code == 200
+    data = response.data
+    assert {item['value'] for item in data['condition']} == {
+        'New', 'Used - Excellent', 'Used - Good'
+    }
+    assert data['school_class'][0]['count'] == 1
+    assert data['price'][0] == {'min': 0, 'max': 500, 'count': 3}
+    assert sum(bucket['count'] for bucket in data['price']) == 3
+
+    # same filter set again is served from cache
+    with django_assert_num_queries(0):
+        client.get(reverse('textbook-facets'))
+
+
+@pytest.mark.django_db
+def test_textbook_facets_cache_invalidated(textbook1: Textbook,
+                                           client: APIClient,
+                                           settings,
+                                           django_assert_num_queries,
+                                           django_capture_on_commit_callbacks):
+    response: Response = client.get(reverse('textbook-facets'))
+    assert response.data['condition'] == [{'value': 'New', 'count': 1}]
+    with django_capture_on_commit_callbacks(execute=True):
+        textbook1.condition = 'Used - Good'
+        textbook1.save()
+    response = client.get(reverse('textbook-facets'))
+    assert response.data['condition'] == [{'value': 'Used - Good',
+                                           'count': 1}]
+
+    # the timeout is read when the facets are cached
+    settings.TEXTBOOK_FACETS_CACHE_TIMEOUT = 0
+    cache.clear()
+    client.get(reverse('textbook-facets'))
+    with django_assert_num_queries(1):
+        client.get(reverse('textbook-facets'))
+
+
+@pytest.mark.django_db
+def test_textbook_facets_filtered(textbook1: Textbook,
+                                  textbook2: Textbook,
+                                  textbook3: Textbook,
+                                  client: APIClient):
+    response: Response = client.get(reverse('textbook-facets'),
+                                    data={'min_price': 35,
+                                          'seller': 'seller'})
+    data = response.data
+    assert data['publisher'] == [
+        {'value': 'History Books', 'count': 1},
+        {'value': 'Science Publishers', 'count': 1},
+    ]
+    assert data['price'][0]['count'] == 2
+
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbook_response_cache_hit(textbook1: Textbook,
+                                     client: APIClient,
+                                     django_assert_num_queries):
+    url = reverse('textbook-list')
+    response: Response = client.get(url, data={'limit': 5, 'ordering': 'price'})
+    assert response['X-Cache'] == 'MISS'
+
+    # same query in another parameter order is the same cache entry
+    with django_assert_num_queries(0):
+        response = client.get(url, data={'ordering': 'price', 'limit': 5})
+    assert response['X-Cache'] == 'HIT'
+    assert response.data['results'][0]['title'] == 'Mathematics 101'
+
+    client.get(f'/api/textbooks/{textbook1.pk}/')
+    with django_assert_num_queries(0):
+        response = client.get(f'/api/textbooks/{textbook1.pk}/')
+    assert response['X-Cache'] == 'HIT'
+
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbook_response_cache_invalidated_on_save(textbook1: Textbook,
+                                                     textbook2: Textbook,
+                                                     client: APIClient):
+    list_url = reverse('textbook-list')
+    detail_url = reverse('textbook-detail', kwargs={'pk': textbook1.pk})
+    other_url = reverse('textbook-detail', kwargs={'pk': textbook2.pk})
+    grade_params = {'school_class': '11th Grade'}
+    for url, params in ((list_url, {}), (detail_url, {}),
+                        (other_url, {}), (list_url, grade_params)):
+        client.get(url, data=params)
+
+    textbook1.price = 10
+    textbook1.save()
+
+    response: Response = client.get(list_url)
+    assert response['X-Cache'] == 'MISS'
+    assert response.data['results'][-1]['price'] == '10.00'
+    response = client.get(detail_url)
+    assert response['X-Cache'] == 'MISS'
+    assert response.data['price'] == '10.00'
+    # neither textbook2 nor its school class changed
+    assert client.get(other_url)['X-Cache'] == 'HIT'
+    assert client.get(list_url, data=grade_params)['X-Cache'] == 'HIT'
+
+    # moving a textbook between classes invalidates both listings
+    textbook1.school_class = '11th Grade'
+    textbook1.save()
+    response = client.get(list_url, data=grade_params)
+    assert response['X-Cache'] == 'MISS'
+    assert len(response.data['results']) == 2
+
+    textbook2.delete()
+    response = client.get(list_url, data=grade_params)
+    assert response['X-Cache'] == 'MISS'
+    assert len(response.data['results']) == 1
+
+
+@pytest.mark.django_db
+def test_textbook_response_cache_counters_bounded(textbook1: Textbook,
+                                                  client: APIClient):
+    """ Filter values no textbook has get no generation counter, and the
+    counters that exist expire. """
+    cache.clear()
+    redis = cache._cache.get_client()
+
+    def counters():
+        return {key.decode() for key in
+                redis.keys(cache.make_key('catalog:generation:*'))}
+
+    url = reverse('textbook-list')
+    for value in ('no such grade', 'x' * 300, 'Used - Awful'):
+        client.get(url, data={'school_class': value, 'condition': value})
+    assert counters() == {cache.make_key(generation_key('list'))}
+
+    client.get(url, data={'school_class': textbook1.school_class,
+                          'condition': textbook1.condition})
+    assert counters() == {cache.make_key(generation_key(name)) for name in (
+        'list', f'school_class:{textbook1.school_class}',
+        f'condition:{textbook1.condition}',
+    )}
+    assert all(0 < redis.ttl(key) <= generation_timeout()
+               for key in counters())
+
+
+@pytest.mark.django_db
+def test_textbook_response_cache_skipped(textbook1: Textbook,
+                                         user1: User,
+                                         client: APIClient,
+                                         settings):
+    url = reverse('textbook-list')
+    client.force_authenticate(user=user1)
+    client.get(url)
+    response: Response = client.get(url)
+    assert 'X-Cache' not in response
+
+    client.force_authenticate(user=None)
+    settings.CATALOG_CACHE_ENABLED = False
+    client.get(url)
+    response = client.get(url)
+    assert 'X-Cache' not in response
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('route', ['view', 'viewset'])
+def test_textbook_detail_conditional_get(route: str,
+                                         textbook1: Textbook,
+                                         user1: User,
+                                         client: APIClient,
+                                         django_assert_num_queries):
+    if route == 'view':
+        url = reverse('textbook-detail', kwargs={'pk': textbook1.pk})
+    else:
+        url = f'/api/textbooks/{textbook1.pk}/'
+    # authenticated requests skip the response cache
+    client.force_authenticate(user=user1)
+    response: Response = client.get(url)
+    etag, last_modified = response['ETag'], response['Last-Modified']
+    assert etag.startswith('"')
+
+    with django_assert_num_queries(1):
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    response = client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+    assert response.status_code == 304
+
+    textbook1.price = 10
+    textbook1.save()
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbook_list_conditional_get(textbook1: Textbook,
+                                       textbook2: Textbook,
+                                       textbook3: Textbook,
+                                       client: APIClient,
+                                       django_assert_num_queries):
+    url = reverse('textbook-list')
+    response: Response = client.get(url, data={'limit': 2})
+    etag = response['ETag']
+    assert 'Last-Modified' not in response
+
+    # answered from the response cache without touching the database
+    with django_assert_num_queries(0):
+        response = client.get(url, data={'limit': 2}, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['X-Cache'] == 'HIT'
+
+    response = client.get(url, data={'limit': 2, 'ordering': 'price'})
+    assert response['ETag'] != etag
+
+    # deleting a row on the page changes its ETag
+    textbook2.delete()
+    response = client.get(url, data={'limit': 2}, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+    assert [t['id'] for t in response.data['results']] == [3, 1]
+
+
+@pytest.fixture
+def search_vector_trigger(db):
+    """ Installs the search_vector trigger from migration 0009 on PostgreSQL,
+    which pytest's --no-migrations database does not have. """
+    if connection.vendor == 'postgresql':
+        migration = importlib.import_module(
+            'marketplace.migrations.0009_textbook_search_vector'
+        )
+        with connection.schema_editor() as schema_editor:
+            migration.create_trigger(None, schema_editor)
+    yield
+
+
+@pytest.mark.django_db(reset_sequences=True, transaction=True)
+def test_textbooks_search_query_success(search_vector_trigger,
+                                        textbook1: Textbook,
+                                        textbook2: Textbook,
+                                        textbook3: Textbook,
+                                        client: APIClient):
+    response: Response = client.get(reverse('textbook-list'),
+                                    data={'query': 'history'})
+    assert response.status_code == 200
+    data = response.data['results']
+    assert len(data) == 1
+    assert data[0]['title'] == 'History 201'
+    assert 'search_vector' not in data[0]
+
+
+@pytest.fixture
+def trigram_indexes(db):
+    """ Creates the pg_trgm indexes from migration 0011, which pytest's
+    --no-migrations database does not have. """
+    if connection.vendor != 'postgresql':
+        pytest.skip('Trigram indexes require PostgreSQL.')
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions "
+                       "WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            pytest.skip('pg_trgm extension is not available.')
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    migration = importlib.import_module(
+        'marketplace.migrations.0011_trigram_indexes'
+    )
+    with connection.schema_editor() as schema_editor:
+        migration.create_trigram_indexes(None, schema_editor,
+                                         concurrently=False)
+    yield
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('params, index_name', [
+    ({'author': 'Doe'}, 'marketplace_textbook_author_trgm'),
+    ({'publisher': 'Books'}, 'marketplace_textbook_publisher_trgm'),
+    ({'subject': 'math'}, 'marketplace_textbook_subject_trgm'),
+    ({'seller': 'seller'}, 'marketplace_user_username_trgm'),
+    ({'author': 'Petrovic', 'fuzzy': 'true'},
+     'marketplace_textbook_author_trgm'),
+    ({'publisher': 'Bokos', 'fuzzy': 'true'},
+     'marketplace_textbook_publisher_trgm'),
+    ({'subject': 'Mathematcs', 'fuzzy': 'true'},
+     'marketplace_textbook_subject_trgm'),
+    ({'seller': 'seler', 'fuzzy': 'true'}, 'marketplace_user_username_trgm'),
+])
+def test_textbook_text_filters_use_trigram_index(trigram_indexes,
+                                                 textbook1: Textbook,
+                                                 params: dict,
+                                                 index_name: str):
+    queryset = TextbookFilter(params, queryset=Textbook.objects.all()).qs
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # The test table is tiny; make sure the plan shows whether an
+            # index *can* serve the predicate rather than the cheapest plan.
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+    assert index_name in plan
+
+
 @pytest.mark.django_db(reset_sequences=True, transaction=True)
 def test_textbook_detail_view_success(seller: User,
                                       textbook1: Textbook,
@@ -171,6 +686,163 @@ def test_textbook_image_view_success(textbook1: Textbook,
     assert 'detail' in image_data
 
 
+@pytest.mark.django_db(transaction=True)
+def test_textbook_image_renditions_precomputed(textbook1: Textbook,
+                                               client: APIClient,
+                                               settings,
+                                               monkeypatch):
+    # placeholders until the worker has built the renditions
+    response: Response = client.get(f'/api/textbooks/{textbook1.pk}/')
+    image = response.data['image']
+    assert image['full_size'].endswith(textbook1.image.url)
+    assert image['preview'].endswith('rendition-placeholder.png')
+    assert image['detail'] == image['preview']
+
+    call_command('process_renditions', once=True, workers=0,
+                 stdout=StringIO())
+    textbook = Textbook.objects.get(pk=textbook1.pk)
+    assert textbook.image_renditions_state == Textbook.RENDITIONS_READY
+    renditions = textbook.image_renditions
+    assert set(renditions) == {'full_size', 'preview', 'detail', 'sources'}
+    assert all(renditions[key].startswith(settings.MEDIA_HOST)
+               for key in ('full_size', 'preview', 'detail'))
+    # modern encodings of every rendition, best format first
+    for key in ('full_size', 'preview', 'detail'):
+        sources = renditions['sources'][key]
+        assert 'image/webp' in sources
+        assert list(sources) == [mime for mime, *_ in supported_formats()]
+    preview = renditions['sources']['preview']['image/webp']
+    with default_storage.open(preview.split(settings.MEDIA_URL)[1]) as f:
+        assert Image.open(f).size[0] <= 240
+
+    # served as stored, without resolving renditions per request
+    monkeypatch.setattr('marketplace.serializers.rendition_urls', None)
+    response = client.get(f'/api/textbooks/{textbook1.pk}/')
+    assert response.data['image'] == renditions
+    assert 'image_renditions' not in response.data
+
+
+@pytest.mark.django_db
+def test_process_renditions_on_process_pool(textbook1: Textbook,
+                                            textbook2: Textbook,
+                                            settings, monkeypatch):
+    # spawned workers read their settings from the environment
+    monkeypatch.setenv('MEDIA_ROOT', settings.MEDIA_ROOT)
+    call_command('process_renditions', once=True, workers=1,
+                 stdout=StringIO())
+    assert set(Textbook.objects.values_list('image_renditions_state',
+                                            flat=True)) == {'ready'}
+    textbook = Textbook.objects.get(pk=textbook2.pk)
+    assert 'preview' in textbook.image_renditions
+
+
+@pytest.mark.django_db(transaction=True)
+def test_process_renditions_failure(textbook1: Textbook,
+                                    client: APIClient,
+                                    monkeypatch):
+    def broken(pk, image_name):
+        raise OSError('cannot identify image file')
+
+    monkeypatch.setattr(
+        'marketplace.management.commands.process_renditions.build_renditions',
+        broken
+    )
+    call_command('process_renditions', once=True, workers=0,
+                 stdout=StringIO())
+    textbook1.refresh_from_db()
+    assert textbook1.image_renditions_state == Textbook.RENDITIONS_FAILED
+    # failed renditions fall back to the original image
+    data = client.get(f'/api/textbooks/{textbook1.pk}/').data
+    assert set(data['image'].values()) == {data['image']['full_size']}
+    assert 'image_renditions_claimed_at' not in data
+
+    monkeypatch.undo()
+    call_command('process_renditions', once=True, workers=0,
+                 retry_failed=True, stdout=StringIO())
+    textbook1.refresh_from_db()
+    assert textbook1.image_renditions_state == Textbook.RENDITIONS_READY
+
+
+@pytest.mark.django_db(transaction=True)
+def test_process_renditions_outside_transaction(textbook1: Textbook,
+                                                textbook2: Textbook,
+                                                monkeypatch):
+    """ Renditions are built with no transaction (or row lock) open; a
+    textbook queued again meanwhile keeps its new request. """
+    build = process_renditions.build_renditions
+    built = []
+
+    def building(pk, image_name):
+        assert not connection.in_atomic_block
+        assert Textbook.objects.get(pk=pk).image_renditions_state == \
+            Textbook.RENDITIONS_PROCESSING
+        if pk == textbook1.pk and pk not in built:
+            # a seller uploads another image while it is rendered
+            request_image_renditions(Textbook.objects.get(pk=pk))
+        built.append(pk)
+        return build(pk, image_name)
+
+    monkeypatch.setattr(process_renditions, 'build_renditions', building)
+    call_command('process_renditions', once=True, workers=0, batch_size=1,
+                 stdout=StringIO())
+    states = dict(Textbook.objects.values_list('pk',
+                                               'image_renditions_state'))
+    assert states == {textbook1.pk: Textbook.RENDITIONS_READY,
+                      textbook2.pk: Textbook.RENDITIONS_READY}
+    # the result for the replaced image was dropped and built again
+    assert built == [textbook1.pk, textbook1.pk, textbook2.pk]
+
+
+@pytest.mark.django_db
+def test_process_renditions_reclaims_stale_rows(textbook1: Textbook,
+                                                textbook2: Textbook):
+    """ Rows left 'processing' by a worker that died are claimed again
+    after --claim-timeout, rows of a live worker are not. """
+    now = timezone.now()
+    for textbook, claimed_at in ((textbook1, now - timedelta(hours=1)),
+                                 (textbook2, now)):
+        Textbook.objects.filter(pk=textbook.pk).update(
+            image_renditions_state=Textbook.RENDITIONS_PROCESSING,
+            image_renditions_claimed_at=claimed_at,
+        )
+    call_command('process_renditions', once=True, workers=0,
+                 claim_timeout=600, stdout=StringIO())
+    states = dict(Textbook.objects.values_list('pk',
+                                               'image_renditions_state'))
+    assert states == {textbook1.pk: Textbook.RENDITIONS_READY,
+                      textbook2.pk: Textbook.RENDITIONS_PROCESSING}
+
+
+@pytest.mark.django_db
+def test_image_renditions_built_in_request_when_sync(seller: User,
+                                                     test_image: Image,
+                                                     settings):
+    settings.IMAGE_RENDITIONS_ASYNC = False
+    textbook = Textbook.objects.create(title='Sync', author='A',
+                                       school_class='1', publisher='P',
+                                       price=1, seller=seller,
+                                       image=test_image)
+    assert textbook.image_renditions_state == Textbook.RENDITIONS_READY
+    assert 'preview' in textbook.image_renditions
+
+
+@pytest.mark.django_db
+def test_build_image_renditions_command(textbook1: Textbook,
+                                        client: APIClient):
+    Textbook.objects.filter(pk=textbook1.pk).update(
+        image_renditions={}, image_renditions_state=Textbook.RENDITIONS_READY
+    )
+    # rows from before precomputed renditions are resolved on the fly
+    response: Response = client.get(f'/api/textbooks/{textbook1.pk}/')
+    assert 'preview' in response.data['image']
+
+    call_command('build_image_renditions', stdout=StringIO())
+    textbook1.refresh_from_db()
+    sources = textbook1.image_renditions.pop('sources')
+    assert textbook1.image_renditions == response.data['image']
+    assert set(sources) == set(response.data['image'])
+
+
 @pytest.mark.django_db(reset_sequences=True, transaction=True)
 def test_textbook_create_success(seller: User,
                                  test_image: Image,
@@ -210,6 +882,7 @@ def test_token_obtain_pair_success(user1: User, client: APIClient):
     assert len(data) == 2
     assert data['refresh']
     assert data['access']
+    assert AccessToken(data['access'])['username'] == 'username1'
 
 
 @pytest.mark.django_db(reset_sequences=True, transaction=True)
@@ -491,3 +1164,117 @@ def test_auth_or_read_only_permission_anon_user(factory: APIRequestFactory):
     assert permission.has_permission(
         request=request, view=TextbookViewSet.as_view({'post': 'create'})
     ) is False
+
+
+@pytest.fixture
+def media_file(tmp_path, settings):
+    settings.MEDIA_ROOT = str(tmp_path)
+    (tmp_path / 'textbook_images').mkdir()
+    path = tmp_path / 'textbook_images' / 'cover.jpg'
+    path.write_bytes(bytes(range(256)) * 4)
+    yield path
+
+
+async def asgi_get(app, path, headers=(), method='GET', extensions=None):
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'headers': [(name.encode(), value.encode())
+                         for name, value in headers]}
+    if extensions is not None:
+        scope['extensions'] = extensions
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start, *body = messages
+    return start['status'], dict(
+        (name.decode(), value.decode()) for name, value in start['headers']
+    ), body
+
+
+@pytest.mark.asyncio
+async def test_media_files_app_serves_file(media_file):
+    async def django_app(scope, receive, send):
+        raise AssertionError('media request reached Django')
+
+    app = MediaFilesApp(django_app)
+    status, headers, body = await asgi_get(app, '/media/textbook_images/cover.jpg')
+    assert status == 200
+    assert headers['content-type'] == 'image/jpeg'
+    assert headers['content-length'] == '1024'
+    assert 'immutable' in headers['cache-control']
+    assert b''.join(message['body'] for message in body) == media_file.read_bytes()
+
+    status, _, _ = await asgi_get(app, '/media/textbook_images/cover.jpg',
+                                  headers=[('if-none-match', headers['etag'])])
+    assert status == 304
+
+    status, headers, body = await asgi_get(
+        app, '/media/textbook_images/cover.jpg', headers=[('range', 'bytes=10-19')]
+    )
+    assert status == 206
+    assert headers['content-range'] == 'bytes 10-19/1024'
+    assert b''.join(message['body'] for message in body) == bytes(range(10, 20))
+
+    status, headers, _ = await asgi_get(
+        app, '/media/textbook_images/cover.jpg', headers=[('range', 'bytes=5000-')]
+    )
+    assert status == 416
+    assert headers['content-range'] == 'bytes */1024'
+
+    for path in ('/media/../settings.py', '/media/textbook_images/missing.jpg'):
+        status, _, _ = await asgi_get(app, path)
+        assert status == 404
+
+
+@pytest.mark.asyncio
+async def test_media_files_app_zero_copy_and_passthrough(media_file):
+    passed = []
+
+    async def django_app(scope, receive, send):
+        passed.append(scope['path'])
+
+    app = MediaFilesApp(django_app)
+    status, _, body = await asgi_get(
+        app, '/media/textbook_images/cover.jpg', headers=[('range', 'bytes=-24')],
+        extensions={'http.response.zerocopysend': {}}
+    )
+    assert status == 206
+    assert body[0]['type'] == 'http.response.zerocopysend'
+    assert (body[0]['offset'], body[0]['count']) == (1000, 24)
+
+    await app({'type': 'http', 'path': '/api/textbooks/', 'method': 'GET',
+               'headers': []}, None, None)
+    assert passed == ['/api/textbooks/']
+
+
+@pytest.mark.parametrize('mode, header, value', [
+    ('x-accel', 'X-Accel-Redirect', '/protected-media/textbook_images/cover.jpg'),
+    ('x-sendfile', 'X-Sendfile', None),
+])
+def test_serve_media_proxy_handoff(mode: str,
+                                   header: str,
+                                   value: str,
+                                   media_file,
+                                   settings,
+                                   factory: APIRequestFactory):
+    settings.MEDIA_SERVE_MODE = mode
+    response = serve_media(factory.get('/media/textbook_images/cover.jpg'),
+                           'textbook_images/cover.jpg')
+    assert response.status_code == 200
+    assert response[header] == (value or str(media_file))
+    assert response.content == b''
+    assert 'immutable' in response['Cache-Control']
+
+    response = serve_media(
+        factory.get('/media/textbook_images/cover.jpg',
+                    HTTP_IF_NONE_MATCH=response['ETag']),
+        'textbook_images/cover.jpg'
+    )
+    assert response.status_code == 304
+    with pytest.raises(Http404):
+        serve_media(factory.get('/media/x'), '../../etc/passwd')
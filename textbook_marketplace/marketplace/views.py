@@ -4,7 +4,6 @@ from rest_framework.response import Response
 from rest_framework import status, viewsets, permissions
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from rest_framework.decorators import action, api_view
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework.permissions import (
     IsAuthenticated,
     IsAuthenticatedOrReadOnly,
@@ -18,6 +17,7 @@ from django.contrib.auth import get_user_model
 
 from .models import Textbook, Order, Block, Wishlist
 from .serializers import (
+    CustomTokenObtainPairSerializer,
     TextbookSerializer,
     SignupSerializer,
     UserSerializer,
@@ -25,7 +25,17 @@ from .serializers import (
     ReportSerializer,
     WishlistSerializer,
 )
+from .caching import (
+    cache_anonymous_response,
+    detail_generations,
+    listing_generations,
+    not_modified,
+    textbook_etag,
+    validator_headers,
+)
+from .facets import textbook_facets
 from .filters import TextbookFilter
+from .pagination import TextbookPagination
 
 User = get_user_model()
 
@@ -42,17 +52,28 @@ class HealthCheckView(APIView):
 
 class TextbookDetailView(APIView):
 
+    @cache_anonymous_response(detail_generations)
     def get(self, request, pk):
         """ Returns full description of a textbook by pk url parameter. """
-        textbook = get_object_or_404(Textbook, pk=pk)
+        textbook = get_object_or_404(
+            Textbook.objects.select_related('seller').only(
+                *TextbookSerializer.queryset_fields()
+            ),
+            pk=pk
+        )
+        headers = validator_headers(textbook_etag([textbook]),
+                                    textbook.updated_at)
+        response = not_modified(request, headers)
+        if response is not None:
+            return response
         serializer = TextbookSerializer(textbook)
-        return Response(serializer.data)
+        return Response(serializer.data, headers=headers)
 
 
 class TextbookImageView(APIView):
     def get(self, request, pk):
         """ Returns full-sized image of a textbook. """
-        textbook = get_object_or_404(Textbook, pk=pk)
+        textbook = get_object_or_404(Textbook.objects.only('image'), pk=pk)
         return Response({'image': textbook.image.url})
 
 
@@ -85,7 +106,7 @@ class PersonalCabinetView(APIView):
 
 class CustomTokenObtainPairView(TokenObtainPairView):
     """ Returns refresh_token and access_token, tied to a user. """
-    serializer_class = TokenObtainPairSerializer
+    serializer_class = CustomTokenObtainPairSerializer
 
     @method_decorator(ratelimit(key='ip', rate='10/m', method='POST', block=True))
     def post(self, request, *args, **kwargs):
@@ -110,19 +131,63 @@ class IsOwner(BasePermission):
 
 class TextbookViewSet(viewsets.ModelViewSet):
     """Unified ViewSet for all textbook operations."""
-    queryset = Textbook.objects.all()
+    queryset = Textbook.objects.select_related('seller').only(
+        *TextbookSerializer.queryset_fields()
+    )
     serializer_class = TextbookSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     filterset_class = TextbookFilter
+    pagination_class = TextbookPagination
     
     def get_permissions(self):
         if self.action in ['update', 'partial_update', 'destroy']:
             return [IsAuthenticated(), IsOwner()]
         return super().get_permissions()
     
+    @cache_anonymous_response(listing_generations)
+    def list(self, request, *args, **kwargs):
+        """ Paginated listing with a page-level ETag; conditional requests
+        get a 304 before the page is serialized. """
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return super().list(request, *args, **kwargs)
+        # Count and links of the page, i.e. everything but the results.
+        envelope = self.paginator.get_paginated_response([]).data
+        # No Last-Modified: deleting a row changes the page without
+        # changing max(updated_at) of what is left.
+        headers = validator_headers(textbook_etag(page, envelope))
+        response = not_modified(request, headers)
+        if response is not None:
+            return response
+        serializer = self.get_serializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    @cache_anonymous_response(detail_generations)
+    def retrieve(self, request, *args, **kwargs):
+        textbook = self.get_object()
+        headers = validator_headers(textbook_etag([textbook]),
+                                    textbook.updated_at)
+        response = not_modified(request, headers)
+        if response is not None:
+            return response
+        serializer = self.get_serializer(textbook)
+        return Response(serializer.data, headers=headers)
+
     def perform_create(self, serializer):
         serializer.save(seller=self.request.user)
 
+    @action(detail=False, methods=['get'])
+    def facets(self, request):
+        """ Counts per subject, school_class, condition, publisher and price
+        bucket for the listings matching the same filters as the list. """
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(textbook_facets(queryset,
+                                        listing_generations(request)))
+
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
@@ -198,13 +263,16 @@ class WishlistView(APIView):
 
     def get(self, request):
         """List all textbooks in user's wishlist."""
-        items = Wishlist.objects.filter(user=request.user).select_related('textbook', 'textbook__seller')
+        items = Wishlist.objects.filter(user=request.user).select_related(
+            'textbook', 'textbook__seller'
+        ).only('id', 'created_at',
+               *TextbookSerializer.queryset_fields(prefix='textbook__'))
         serializer = WishlistSerializer(items, many=True)
         return Response(serializer.data)
 
     def post(self, request, textbook_id):
         """Add a textbook to wishlist."""
-        textbook = get_object_or_404(Textbook, pk=textbook_id)
+        textbook = get_object_or_404(Textbook.objects.only('id'), pk=textbook_id)
         _, created = Wishlist.objects.get_or_create(user=request.user, textbook=textbook)
         if not created:
             return Response({'detail': 'Already in wishlist.'}, status=status.HTTP_200_OK)
@@ -12,9 +12,15 @@ django_asgi_app = get_asgi_application()
 from channels.routing import ProtocolTypeRouter, URLRouter
 from chat.jwt_middleware import CustomJWTAuthMiddlewareStack
 from chat import routing
+from textbook_marketplace.media import MediaFilesApp, media_serve_mode
+
+# Uploaded media is answered before it reaches Django (MEDIA_SERVE_MODE)
+http_app = django_asgi_app
+if media_serve_mode() == 'asgi':
+    http_app = MediaFilesApp(django_asgi_app)
 
 application = ProtocolTypeRouter({
-    "http": django_asgi_app,
+    "http": http_app,
     "websocket": CustomJWTAuthMiddlewareStack(
         URLRouter(
             routing.websocket_urlpatterns,
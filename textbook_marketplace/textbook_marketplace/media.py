@@ -0,0 +1,211 @@
+"""
+Serving of uploaded media (MEDIA_URL) outside django.views.static.serve.
+
+MEDIA_SERVE_MODE selects how:
+    'asgi'       - MediaFilesApp answers media requests in front of Django,
+                   with Range, ETag and immutable cache headers
+    'x-accel'    - Django only resolves the file and hands it to nginx with
+                   X-Accel-Redirect (MEDIA_ACCEL_REDIRECT_PREFIX)
+    'x-sendfile' - the same with X-Sendfile (Apache, lighttpd, Caddy)
+    'django'     - django.views.static.serve, as before
+"""
+
+import asyncio
+import mimetypes
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+# Uploaded files never change under the same name (storage renames
+# clashes, renditions embed their size), so clients may cache for a year.
+MEDIA_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def media_serve_mode():
+    return getattr(settings, 'MEDIA_SERVE_MODE', 'django')
+
+
+def resolve_media_path(path, root=None):
+    """ Absolute path of the regular file `path` below MEDIA_ROOT, or None
+    for missing files and paths escaping the root. """
+    root = os.path.realpath(root or settings.MEDIA_ROOT)
+    full_path = os.path.realpath(os.path.join(root, path))
+    if not full_path.startswith(root + os.sep) or not os.path.isfile(full_path):
+        return None
+    return full_path
+
+
+def media_headers(full_path, stat):
+    content_type, encoding = mimetypes.guess_type(full_path)
+    headers = {
+        'Content-Type': content_type or 'application/octet-stream',
+        'ETag': quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}'),
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': MEDIA_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+    }
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return headers
+
+
+def serve_media(request, path):
+    """ Media view for the X-Accel-Redirect / X-Sendfile modes: Django
+    checks the path and conditional headers, the proxy sends the bytes
+    (including Range requests). """
+    full_path = resolve_media_path(path)
+    if full_path is None:
+        raise Http404('File not found')
+    stat = os.stat(full_path)
+    headers = media_headers(full_path, stat)
+    response = get_conditional_response(
+        request, etag=headers['ETag'], last_modified=int(stat.st_mtime)
+    )
+    if response is None:
+        response = HttpResponse(content_type=headers['Content-Type'])
+        if media_serve_mode() == 'x-accel':
+            response['X-Accel-Redirect'] = (
+                settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(path)
+            )
+        else:
+            response['X-Sendfile'] = full_path
+    for name in ('ETag', 'Last-Modified', 'Cache-Control'):
+        response[name] = headers[name]
+    return response
+
+
+def parse_range(header, size):
+    """ (start, end) of a single 'bytes=' range, inclusive. None when the
+    header should be ignored (absent, malformed or several ranges) and
+    False when it can't be satisfied. """
+    unit, _, spec = (header or '').partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+class MediaFilesApp:
+    """ ASGI app serving MEDIA_URL from MEDIA_ROOT, passing every other
+    request on to `app`.
+
+    Files are sent with the http.response.zerocopysend extension when the
+    server offers it (the server then sendfile()s from the descriptor),
+    otherwise in chunks read off the event loop. """
+    chunk_size = 256 * 1024
+
+    def __init__(self, app, root=None, prefix=None):
+        self.app = app
+        self.root = root or settings.MEDIA_ROOT
+        self.prefix = prefix or settings.MEDIA_URL
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self.respond(send, 405, {'Allow': 'GET, HEAD'})
+            return
+        full_path = resolve_media_path(scope['path'][len(self.prefix):],
+                                       self.root)
+        if full_path is None:
+            await self.respond(send, 404, {'Content-Type': 'text/plain'},
+                               b'Not Found')
+            return
+
+        request_headers = {
+            name.decode('latin-1').lower(): value.decode('latin-1')
+            for name, value in scope['headers']
+        }
+        stat = os.stat(full_path)
+        headers = media_headers(full_path, stat)
+        if self.not_modified(request_headers, headers['ETag'], stat):
+            await self.respond(send, 304, {
+                name: headers[name]
+                for name in ('ETag', 'Last-Modified', 'Cache-Control')
+            })
+            return
+
+        status, start, length = 200, 0, stat.st_size
+        if request_headers.get('if-range', headers['ETag']) == headers['ETag']:
+            byte_range = parse_range(request_headers.get('range'), stat.st_size)
+            if byte_range is False:
+                await self.respond(send, 416, {
+                    'Content-Range': f'bytes */{stat.st_size}'
+                })
+                return
+            if byte_range is not None:
+                status, (start, end) = 206, byte_range
+                length = end - start + 1
+                headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        headers['Content-Length'] = str(length)
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': self.encode_headers(headers),
+        })
+        if scope['method'] == 'HEAD' or not length:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        with open(full_path, 'rb') as file:
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({
+                    'type': 'http.response.zerocopysend',
+                    'file': file,
+                    'offset': start,
+                    'count': length,
+                })
+                return
+            file.seek(start)
+            while length > 0:
+                chunk = await asyncio.to_thread(
+                    file.read, min(self.chunk_size, length)
+                )
+                if not chunk:
+                    break
+                length -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': length > 0})
+            if length > 0:
+                # the file shrank under us; close the response cleanly
+                await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    def not_modified(request_headers, etag, stat):
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix('W/')
+                    for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+        since = parse_http_date_safe(request_headers.get('if-modified-since'))
+        return since is not None and int(stat.st_mtime) <= since
+
+    @staticmethod
+    def encode_headers(headers):
+        return [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers.items()]
+
+    async def respond(self, send, status, headers, body=b''):
+        headers = {**headers, 'Content-Length': str(len(body))}
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': self.encode_headers(headers)})
+        await send({'type': 'http.response.body', 'body': body})
@@ -106,9 +106,42 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD'),
         'HOST': config('DB_HOST'),
         'PORT': config('DB_PORT', default='5432'),  # Значение по умолчанию для порта
+        'OPTIONS': {
+            # Threshold for fuzzy (?fuzzy=true) textbook filters, see
+            # marketplace.filters.TextbookFilter.text_match
+            'options': '-c pg_trgm.word_similarity_threshold={}'.format(
+                config('DB_TRGM_WORD_SIMILARITY_THRESHOLD', default=0.5,
+                       cast=float)
+            ),
+        },
     }
 }
 
+# Connection pooling (psycopg 3). Under ASGI every request and every
+# database_sync_to_async call may run on a different executor thread, so
+# persistent per-thread connections (CONN_MAX_AGE) would be opened per
+# thread and leak; the pool hands connections out to whichever thread asks
+# and takes them back when Django closes them. The pool is per process:
+# PostgreSQL sees up to BACKEND_WORKERS * DB_POOL_MAX_SIZE connections.
+if config('DB_POOL', default=True, cast=bool):
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': config('DB_POOL_MIN_SIZE', default=2, cast=int),
+        'max_size': config('DB_POOL_MAX_SIZE', default=10, cast=int),
+        # Seconds a request waits for a free connection before failing
+        'timeout': config('DB_POOL_TIMEOUT', default=10, cast=float),
+        # Idle connections above min_size are closed after this many seconds
+        'max_idle': config('DB_POOL_MAX_IDLE', default=300, cast=float),
+        'max_lifetime': config('DB_POOL_MAX_LIFETIME', default=3600, cast=float),
+    }
+else:
+    # Without the pool (e.g. behind pgbouncer), keep connections of
+    # long-lived threads (WSGI, management commands) open between requests
+    DATABASES['default']['CONN_MAX_AGE'] = config('DB_CONN_MAX_AGE', default=60, cast=int)
+# Pooled connections are checked on checkout and persistent ones when
+# reused, so connections dropped by a server restart are replaced instead
+# of failing a request
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
 
 
 
@@ -153,6 +186,11 @@ STATIC_ROOT = config('STATIC_ROOT', default=os.path.join(BASE_DIR, 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = config("MEDIA_ROOT", default=os.path.join(BASE_DIR, "media"))
 MEDIA_HOST = config("MEDIA_HOST", default="http://127.0.0.1:8000")
+# How MEDIA_URL is served: 'asgi', 'x-accel', 'x-sendfile' or 'django'
+# (see textbook_marketplace.media)
+MEDIA_SERVE_MODE = config("MEDIA_SERVE_MODE", default="asgi")
+# nginx `internal` location aliased to MEDIA_ROOT, for 'x-accel'
+MEDIA_ACCEL_REDIRECT_PREFIX = config("MEDIA_ACCEL_REDIRECT_PREFIX", default="/protected-media/")
 
 STATICFILES_DIRS = [
     BASE_DIR / 'static',
@@ -171,13 +209,22 @@ REST_FRAMEWORK = {
     #     'rest_framework.permissions.IsAuthenticated',
     # ],
     'DEFAULT_PAGINATION_CLASS':
-        'rest_framework.pagination.LimitOffsetPagination',
+        'marketplace.pagination.EstimatedCountPagination',
     'PAGE_SIZE': 20,
     'DEFAULT_FILTER_BACKENDS':
         ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
+# Paginated list counts: exact counts are cached per filter set for this many
+# seconds; unfiltered tables above the threshold report the planner estimate.
+PAGINATION_COUNT_CACHE_TIMEOUT = config('PAGINATION_COUNT_CACHE_TIMEOUT',
+                                        default=30, cast=int)
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = 10_000
+# Cache lifetime of /api/textbooks/facets/ results per filter set, seconds
+TEXTBOOK_FACETS_CACHE_TIMEOUT = config('TEXTBOOK_FACETS_CACHE_TIMEOUT',
+                                       default=60, cast=int)
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'SecondBook API',
     'DESCRIPTION': 'Textbook marketplace API',
@@ -201,6 +248,78 @@ CHANNEL_LAYERS = {
         },
     }
 
+# Shared cache (same Redis as the channel layer, separate database)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://{}:{}/{}".format(
+            config("REDIS_HOST"), config("REDIS_PORT"),
+            config("REDIS_CACHE_DB", default=1, cast=int),
+        ),
+    },
+}
+
+# Response cache for anonymous textbook list/detail reads, invalidated by
+# Textbook saves and deletes (see marketplace.caching)
+CATALOG_CACHE_ENABLED = config('CATALOG_CACHE_ENABLED', default=True, cast=bool)
+CATALOG_CACHE_TIMEOUT = config('CATALOG_CACHE_TIMEOUT', default=300, cast=int)
+
+# Unseen messages sent on websocket connect (see ChatConsumer.send_unseen):
+# per frame, in total, and conversations listed with unread counts
+CHAT_UNSEEN_CHUNK_SIZE = config('CHAT_UNSEEN_CHUNK_SIZE', default=50, cast=int)
+CHAT_UNSEEN_MAX_MESSAGES = config('CHAT_UNSEEN_MAX_MESSAGES', default=200, cast=int)
+CHAT_UNREAD_CONVERSATIONS_LIMIT = config('CHAT_UNREAD_CONVERSATIONS_LIMIT',
+                                         default=50, cast=int)
+# Seconds recipient ids, blocks and websocket users are cached for
+# ChatConsumer (see chat.caching); changes are pushed to the caches right away
+CHAT_LOOKUP_CACHE_TIMEOUT = config('CHAT_LOOKUP_CACHE_TIMEOUT', default=300,
+                                   cast=int)
+# Authenticate websocket handshakes from the token's user_id and username
+# claims alone, without a cache or database lookup; deactivated or renamed
+# users keep their access until the token expires
+CHAT_WS_AUTH_FROM_CLAIMS = config('CHAT_WS_AUTH_FROM_CLAIMS', default=False,
+                                  cast=bool)
+
+# Presence of chat users (see chat.presence): connections renew their entry
+# every CHAT_PRESENCE_HEARTBEAT_INTERVAL seconds and count as gone after
+# CHAT_PRESENCE_TIMEOUT seconds without one
+CHAT_PRESENCE_HEARTBEAT_INTERVAL = config('CHAT_PRESENCE_HEARTBEAT_INTERVAL',
+                                          default=30, cast=int)
+CHAT_PRESENCE_TIMEOUT = config('CHAT_PRESENCE_TIMEOUT', default=90, cast=int)
+# Users one presence query or websocket connection may ask about
+CHAT_PRESENCE_QUERY_LIMIT = config('CHAT_PRESENCE_QUERY_LIMIT', default=100,
+                                   cast=int)
+CHAT_PRESENCE_REDIS_URL = config(
+    'CHAT_PRESENCE_REDIS_URL',
+    default='redis://{}:{}/0'.format(config('REDIS_HOST'), config('REDIS_PORT'))
+)
+
+# Write-behind persistence of chat messages through a Redis stream journal
+# (see chat.journal): messages are fanned out first and stored in batches
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_FLUSH_INTERVAL_MS = config('CHAT_FLUSH_INTERVAL_MS', default=100, cast=int)
+CHAT_FLUSH_BATCH_SIZE = config('CHAT_FLUSH_BATCH_SIZE', default=500, cast=int)
+CHAT_JOURNAL_STREAM = config('CHAT_JOURNAL_STREAM', default='chat:journal')
+CHAT_JOURNAL_CLAIM_IDLE_MS = config('CHAT_JOURNAL_CLAIM_IDLE_MS', default=30000,
+                                    cast=int)
+CHAT_JOURNAL_REDIS_URL = config(
+    'CHAT_JOURNAL_REDIS_URL',
+    default='redis://{}:{}/0'.format(config('REDIS_HOST'), config('REDIS_PORT'))
+)
+
+# Read receipts and delivery acknowledgements sent over the chat websocket
+# are coalesced per conversation and applied once per window (milliseconds)
+CHAT_RECEIPT_FLUSH_MS = config('CHAT_RECEIPT_FLUSH_MS', default=200, cast=int)
+
+# Ephemeral chat events (typing indicators, presence pings) never touch the
+# database. A connection relays the same event at most once per
+# CHAT_EPHEMERAL_INTERVAL_MS, and at most CHAT_EPHEMERAL_RATE events per
+# second overall after a burst of CHAT_EPHEMERAL_BURST
+CHAT_EPHEMERAL_INTERVAL_MS = config('CHAT_EPHEMERAL_INTERVAL_MS', default=3000,
+                                    cast=int)
+CHAT_EPHEMERAL_RATE = config('CHAT_EPHEMERAL_RATE', default=5, cast=float)
+CHAT_EPHEMERAL_BURST = config('CHAT_EPHEMERAL_BURST', default=20, cast=int)
+
 # This is where uploaded files will be stored
 
 # AUTHENTICATION_BACKENDS = (
@@ -234,6 +353,10 @@ VERSATILEIMAGEFIELD_SETTINGS = {
     'jpeg_resize_quality': 90,
 }
 
+# Build textbook image renditions on the process_renditions worker; when
+# False they are built inside the upload request
+IMAGE_RENDITIONS_ASYNC = config('IMAGE_RENDITIONS_ASYNC', default=True, cast=bool)
+
 # Structured logging configuration
 import structlog
 
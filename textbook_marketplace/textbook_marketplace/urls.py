@@ -5,6 +5,8 @@ from django.conf import settings
 from django.views.static import serve
 from django.urls import re_path
 
+from .media import media_serve_mode, serve_media
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
@@ -13,8 +15,14 @@ urlpatterns = [
 # Serve media files in development
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+elif media_serve_mode() in ('x-accel', 'x-sendfile'):
+    # Hand the file over to the front proxy (see textbook_marketplace.media)
+    urlpatterns += [
+        re_path(r'^media/(?P<path>.*)$', serve_media),
+    ]
 else:
-    # Serve media files even when DEBUG=False (for development)
+    # Serve media files even when DEBUG=False; in 'asgi' mode only reached
+    # when running under WSGI, MediaFilesApp answers first otherwise
     urlpatterns += [
         re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
     ]
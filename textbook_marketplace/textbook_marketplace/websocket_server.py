@@ -0,0 +1,67 @@
+"""
+daphne, accepting permessage-deflate (RFC 7692) from websocket clients that
+offer it, with little memory per connection (see accept_deflate()); chat
+frames repeat usernames and field names, which compress well. Takes
+daphne's arguments:
+
+    python -m textbook_marketplace.websocket_server --fd 0 --proxy-headers \
+        textbook_marketplace.asgi:application
+"""
+
+from autobahn.websocket.compress import (PerMessageDeflateOffer,
+                                         PerMessageDeflateOfferAccept)
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+
+
+# zlib state of each direction of a connection: (1 << (bits + 2)) +
+# (1 << (level + 9)) bytes, 16 KiB instead of 256 KiB with zlib's defaults
+DEFLATE_WINDOW_BITS = 11
+DEFLATE_MEM_LEVEL = 4
+
+
+def accept_deflate(offers):
+    """ Accepts the first permessage-deflate offer with a 2 KiB window and a
+    low memory level both ways, keeping the context between messages.
+
+    Accepted as offered, each open connection would hold zlib's default
+    state (a 32 KiB window, 256 KiB in all) in both directions; across
+    thousands of mostly idle chat connections that is gigabytes. Without
+    context takeover autobahn still keeps the compressor between messages,
+    so it would save no memory, while chat frames of a few dozen bytes
+    only compress against the frames before them (see
+    benchmark_chat_protocol). """
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(
+                offer,
+                request_max_window_bits=(DEFLATE_WINDOW_BITS
+                                         if offer.accept_max_window_bits
+                                         else 0),
+                window_bits=min(filter(None, (DEFLATE_WINDOW_BITS,
+                                              offer.request_max_window_bits))),
+                mem_level=DEFLATE_MEM_LEVEL,
+            )
+    return None
+
+
+class DeflateServer(Server):
+    """ daphne's Server, its websocket factory set up for compression as
+    soon as run() creates it. """
+
+    @property
+    def ws_factory(self):
+        return self._ws_factory
+
+    @ws_factory.setter
+    def ws_factory(self, factory):
+        factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+        self._ws_factory = factory
+
+
+class DeflateCommandLineInterface(CommandLineInterface):
+    server_class = DeflateServer
+
+
+if __name__ == '__main__':
+    DeflateCommandLineInterface.entrypoint()